@@ -0,0 +1,68 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+
+
+# Throwaway PostgreSQL cluster for offline benchmarking.
+# initdb into a temp dir, start it on a free localhost port with trust auth, remove it on exit.
+# Binaries are taken from $PG_BIN if set, otherwise from PATH.
+# Benchmarks run in their own database, not 'postgres', so template resets can drop and recreate it.
+class LocalPostgres:
+    def __init__(self, user='bench', database='bench'):
+        self.user = user
+        self.database = database
+        self.dir = None
+        self.port = None
+
+    @staticmethod
+    def _bin(name):
+        pg_bin = os.getenv('PG_BIN')
+        path = os.path.join(pg_bin, name) if pg_bin else shutil.which(name)
+        if not path or not os.path.exists(path):
+            raise RuntimeError(f"{name} not found; install PostgreSQL or set PG_BIN")
+        return path
+
+    @staticmethod
+    def _free_port():
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            return s.getsockname()[1]
+
+    @property
+    def dsn(self):
+        return f"postgresql://{self.user}@127.0.0.1:{self.port}/{self.database}"
+
+    def start(self):
+        # fail before creating anything when PostgreSQL isn't installed
+        for name in ('initdb', 'pg_ctl', 'createdb'):
+            self._bin(name)
+        self.dir = tempfile.mkdtemp(prefix='dc_bench_pg_')
+        data = os.path.join(self.dir, 'data')
+        self.port = self._free_port()
+        subprocess.run([self._bin('initdb'), '-D', data, '-U', self.user, '--auth=trust', '-E', 'UTF8'],
+                       check=True, stdout=subprocess.DEVNULL)
+        # durability off: this cluster is thrown away, we measure the code not the disk
+        opts = f"-p {self.port} -k {self.dir} -c listen_addresses=127.0.0.1 -c fsync=off -c synchronous_commit=off -c full_page_writes=off"
+        subprocess.run([self._bin('pg_ctl'), '-D', data, '-o', opts, '-l', os.path.join(self.dir, 'pg.log'), '-w', 'start'],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([self._bin('createdb'), '-h', '127.0.0.1', '-p', str(self.port), '-U', self.user, self.database],
+                       check=True, stdout=subprocess.DEVNULL)
+        return self
+
+    def stop(self):
+        if self.dir is None:
+            return
+        try:
+            subprocess.run([self._bin('pg_ctl'), '-D', os.path.join(self.dir, 'data'), '-m', 'immediate', 'stop'],
+                           check=False, stdout=subprocess.DEVNULL)
+        finally:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
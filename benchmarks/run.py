@@ -0,0 +1,295 @@
+# Benchmark suite
+#
+#   python -m benchmarks.run                          # throwaway local PostgreSQL (initdb), default sizes
+#   python -m benchmarks.run --dsn postgresql://...   # existing database (its tables get truncated!)
+#   python -m benchmarks.run --sizes 1000,10000 --concurrency 1,4,16 --out results.json
+#   python -m benchmarks.run --repeats 10                # more runs of generation / seeding / history reads
+#
+# Results are written as JSON (one record per benchmark/size/concurrency) so runs can be diffed
+# between commits.
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+
+from benchmarks.local_pg import LocalPostgres
+from src.data_layer.metrics import FLUSH_SIZE
+from src.data_layer.processor import DataProcessor
+from src.generator import TransactionGenerator, generate_customers, generate_merchants, to_records
+from src.logging_setup import setup_logger
+
+
+# Constants
+SIZES = [1000, 10000]
+CONCURRENCY = [1, 4, 16]
+TX_PER_CUSTOMER = 2
+MERCHANT_RATIO = 10
+GENERATION_SIZES = [100000, 1000000]
+REPEATS = 5   # runs of the single-shot benchmarks (generation, seeding, history), reported as percentiles
+START_DATE = datetime(2025, 1, 1)
+END_DATE = datetime(2025, 9, 30)
+LOCK_SAMPLE_INTERVAL = 0.005
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def percentiles(samples):
+    if not samples:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    s = sorted(samples)
+    pick = lambda q: s[min(len(s) - 1, int(q * len(s)))]
+    return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': s[-1]}
+
+
+# latencies: per-operation times; runs: whole-run times of a repeated benchmark, in which case
+# elapsed/ops_per_s come from the median run
+def result(name, size, concurrency, ops, elapsed, latencies=None, runs=None):
+    if runs:
+        elapsed = statistics.median(runs)
+    rec = {
+        'benchmark': name,
+        'size': size,
+        'concurrency': concurrency,
+        'ops': ops,
+        'elapsed_s': elapsed,
+        'ops_per_s': ops / elapsed if elapsed else None,
+    }
+    if latencies is not None:
+        rec['latency_ms'] = {k: v * 1000 if v is not None else None for k, v in percentiles(latencies).items()}
+    if runs:
+        rec['repeats'] = len(runs)
+        rec['run_ms'] = {k: v * 1000 for k, v in percentiles(runs).items()}
+    spread = f"  run p50/p95/p99 {rec['run_ms']['p50']:.1f}/{rec['run_ms']['p95']:.1f}/{rec['run_ms']['p99']:.1f} ms" if runs else ''
+    print(f"{name:<24} size={size:<8} conc={concurrency:<4} {rec['ops_per_s'] or 0:>12.0f} ops/s{spread}")
+    return rec
+
+
+async def reset(dp):
+    await dp.clear_db()
+
+
+# Seeded population saved as a template database once per size, so iterations reset by cloning it
+# instead of truncating and re-seeding. Falls back to re-seeding when the role can't create databases.
+async def snapshot(dp):
+    try:
+        return await dp.snapshot_template()
+    except Exception as e:
+        print(f"template snapshot unavailable, re-seeding between runs: {e}")
+        return None
+
+
+async def reseed(dp, size, template):
+    if template:
+        try:
+            await dp.reset_from_template(template)
+            return
+        except Exception as e:
+            print(f"template reset failed, re-seeding instead: {e}")
+    await reset(dp)
+    await bench_seeding(dp, size)
+
+
+def timed(fn, repeats):
+    runs = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - started)
+    return runs
+
+
+# ------------------- Benchmarks -------------------
+# Same seed every run, so every run draws the same transactions
+def bench_generation(n, repeats=REPEATS):
+    customers = generate_customers(5000, seed=1)
+    merchants = generate_merchants(500, seed=1)
+    runs = timed(lambda: TransactionGenerator(customers, merchants, START_DATE, END_DATE, seed=1).generate(n), repeats)
+    return result('generate_transactions', n, 1, n, None, runs=runs)
+
+
+# Seeds into emptied tables each run; the last run's population stays
+async def bench_seeding(dp, size, repeats=1):
+    customers = generate_customers(size, seed=size)
+    merchants = generate_merchants(max(1, size // MERCHANT_RATIO), seed=size)
+    cust_runs, merch_runs = [], []
+    for i in range(repeats):
+        if i:
+            await reset(dp)
+        started = time.perf_counter()
+        await dp.save_customers_bulk(customers)
+        cust_runs.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        await dp.save_merchants_bulk(merchants)
+        merch_runs.append(time.perf_counter() - started)
+    out = [result('save_customers_bulk', size, 1, len(customers), None, runs=cust_runs),
+           result('save_merchants_bulk', size, 1, len(merchants), None, runs=merch_runs)]
+    return out, customers, merchants
+
+
+async def bench_make_transaction(dp, size, concurrency, transactions, name='make_transaction'):
+    latencies = []
+    per_worker = [transactions[i::concurrency] for i in range(concurrency)]
+
+    async def worker(txs):
+        for tx in txs:
+            t0 = time.perf_counter()
+            await dp.make_transaction(tx['customer_id'], tx['merchant_id'], tx['amount'])
+            latencies.append(time.perf_counter() - t0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(txs) for txs in per_worker))
+    return result(name, size, concurrency, len(transactions), time.perf_counter() - started, latencies)
+
+
+# One hot merchant: one small payment per customer, all to the same merchant, `concurrency` at a time.
+# Customers don't repeat, so the only shared rows are the merchant's. Direct credits serialize on its
+# merchants row and on its merch_daily row for the day; deferred credits append to merchant_ledger /
+# merch_daily_pending instead. Same payments from the same seeded state in both modes.
+# lock_waiters is the mean number of sessions blocked on a lock, sampled every LOCK_SAMPLE_INTERVAL.
+async def bench_hot_merchant(dp, size, concurrency, customers, merchants, template):
+    hot = [{'customer_id': c['id'], 'merchant_id': merchants[0]['merchant_id'], 'amount': 1.0} for c in customers]
+    out = []
+    for defer in (False, True):
+        await reseed(dp, size, template)
+        mode = DataProcessor(dsn=dp.db_url, max_size=concurrency, defer_merchant_credit=defer)
+        await mode.init()
+        samples = []
+        sampler = asyncio.create_task(sample_lock_waiters(dp, samples))
+        try:
+            name = f"hot_merchant_{'deferred' if defer else 'direct'}"
+            rec = await bench_make_transaction(mode, size, concurrency, hot, name)
+        finally:
+            sampler.cancel()
+            await asyncio.gather(sampler, return_exceptions=True)
+            await mode.close()
+        rec['lock_waiters'] = sum(samples) / len(samples) if samples else None
+        print(f"{'':<24} lock waiters {rec['lock_waiters'] or 0:.2f} (mean of {len(samples)} samples)")
+        out.append(rec)
+    return out
+
+
+async def sample_lock_waiters(dp, samples):
+    while True:
+        async with dp.pool.acquire() as conn:
+            samples.append(await conn.fetchval(
+                "SELECT COUNT(*) FROM pg_stat_activity WHERE datname = current_database() AND wait_event_type = 'Lock'"))
+        await asyncio.sleep(LOCK_SAMPLE_INTERVAL)
+
+
+async def bench_batch(dp, size, transactions):
+    started = time.perf_counter()
+    await dp.make_transactions_batch(transactions)
+    return result('make_transactions_batch', size, 1, len(transactions), time.perf_counter() - started)
+
+
+# Enqueue-to-written: updates go in rounds of the aggregator's FLUSH_SIZE, each round ends with a flush,
+# and every update's latency runs until the flush that wrote it has finished. Timing only
+# update_metrics() would measure queue.put.
+async def bench_update_metrics(dp, size, customers):
+    latencies = []
+    n = size * TX_PER_CUSTOMER
+    started = time.perf_counter()
+    for start in range(0, n, FLUSH_SIZE):
+        enqueued = []
+        for i in range(start, min(n, start + FLUSH_SIZE)):
+            enqueued.append(time.perf_counter())
+            await dp.update_metrics(customers[i % len(customers)]['id'], 10.0, 1000.0)
+        await dp.metrics.flush()
+        written = time.perf_counter()
+        latencies.extend(written - t0 for t0 in enqueued)
+    return result('update_metrics', size, 1, n, time.perf_counter() - started, latencies)
+
+
+async def bench_history(dp, size, repeats=REPEATS):
+    runs = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        rows = await dp.get_historical_data()
+        runs.append(time.perf_counter() - started)
+    return result('get_historical_data', size, 1, len(rows), None, runs=runs)
+
+
+async def run_suite(dsn, sizes, concurrency, repeats=REPEATS):
+    results = []
+    dp = DataProcessor(dsn=dsn, max_size=max(concurrency))
+    await dp.init()
+    try:
+        for size in sizes:
+            await reset(dp)
+            seeded, customers, merchants = await bench_seeding(dp, size, repeats)
+            results.extend(seeded)
+            template = await snapshot(dp)
+            gen = TransactionGenerator(customers, merchants, START_DATE, END_DATE, seed=size)
+            transactions = to_records(gen.generate(size * TX_PER_CUSTOMER))
+            for i, conc in enumerate(concurrency):
+                if i:
+                    await reseed(dp, size, template)
+                results.append(await bench_make_transaction(dp, size, conc, transactions))
+                await dp.metrics.flush()
+
+            await reseed(dp, size, template)
+            results.append(await bench_batch(dp, size, transactions))
+            await dp.metrics.flush()
+            results.append(await bench_history(dp, size, repeats))
+            random.shuffle(customers)
+            results.append(await bench_update_metrics(dp, size, customers))
+            results.extend(await bench_hot_merchant(dp, size, max(concurrency), customers, merchants, template))
+            if template:
+                await dp.drop_template(template)
+    finally:
+        await dp.close()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DC Research benchmarks")
+    parser.add_argument('--dsn', default=None, help="use this database instead of a throwaway local cluster")
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)), help="customer population sizes")
+    parser.add_argument('--concurrency', default=','.join(map(str, CONCURRENCY)))
+    parser.add_argument('--repeats', type=int, default=REPEATS, help="runs of generation, seeding and history reads")
+    parser.add_argument('--out', default=None, help="JSON output path (default: benchmarks/results/<time>-<commit>.json)")
+    args = parser.parse_args()
+
+    setup_logger('bench')
+    sizes = [int(x) for x in args.sizes.split(',')]
+    concurrency = [int(x) for x in args.concurrency.split(',')]
+
+    results = [bench_generation(n, args.repeats) for n in GENERATION_SIZES]
+    if args.dsn:
+        results.extend(asyncio.run(run_suite(args.dsn, sizes, concurrency, args.repeats)))
+    else:
+        with LocalPostgres() as pg:
+            results.extend(asyncio.run(run_suite(pg.dsn, sizes, concurrency, args.repeats)))
+
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    out = args.out
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out = os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{commit or 'nogit'}.json")
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Results written to {out}")
+
+
+if __name__ == "__main__":
+    main()
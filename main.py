@@ -1,20 +1,24 @@
+import argparse
 import logging
 import time
 from datetime import datetime 
 import os 
 import asyncio
-from src.data_layer.processor import DataProcessor
-from src.logging_setup import setup_logger
-from tests.test_1_customer import Test1
-from tests.test_2_50k import Test2
+from src.logging_setup import PROFILES, setup_logger
 #from src.incentive import Incentive
 
+# Heavier modules (numpy/pandas via the tests, generator and driver) are imported where they're used,
+# so startup only pays for what the chosen mode runs
+SCENARIO_NAMES = ['50k', '5m']
+ARRIVAL_PROFILES = ['poisson', 'bursty', 'diurnal', 'payday']   # src.loadgen.PROFILES
 
 
-async def main():
+async def main(log_profile=None, engine='db', load=None, population=None, checkpoint=None,
+               dashboard=False, anomaly=False, seed=None):
     #initialize processor
+    started = time.perf_counter()
 
-    setup_logger()
+    setup_logger(log_profile)
     
     logger = logging.getLogger(__name__)
     
@@ -22,26 +26,112 @@ async def main():
 
     logger.info("Welcome to DC Research!")
     
-    await asyncio.sleep(1)
-    
     #logger.info("Launching test1")
     
-    processor = DataProcessor()
-    test = Test1()
+    from src.data_layer.processor import close_shared_processor, get_shared_processor
+    from tests.test_1_customer import Test1
+
+    # one pool and one schema check shared by both tests
+    # 'memory' runs payments in the array-backed ledger and writes them behind to the same tables
+    if engine == 'memory':
+        from src.data_layer.ledger import MemoryLedger
+        processor = await get_shared_processor(MemoryLedger)
+    else:
+        processor = await get_shared_processor()
+    logger.info(f"Processor ready in {(time.perf_counter() - started) * 1000:.0f} ms")
+    test = Test1(processor)
 
     #Test 1
     await test.testing()
 
-    logger.info("Launching test2 in 1 second...")
-
-    await asyncio.sleep(1)
+    logger.info("Launching test2...")
 
+    from tests.test_2_50k import Test2
     
-    test2 = Test2(processor)
+    # checkpoint: {'checkpoint_dir', 'checkpoint_weeks', 'resume'} for the simulated replay
+    checkpoint = dict(checkpoint or {})
+    resume = checkpoint.pop('resume', False)
+    test2 = Test2(processor, seed=seed, **(population or {}), **checkpoint, anomaly=anomaly)
+
+    # dashboard views refreshed in the background while test2 writes, read back once it's done
+    dash = None
+    if dashboard:
+        from src.data_layer.aggregates import DashboardAggregates
+        dash = DashboardAggregates(processor)
+        await dash.start()
 
-    await test2.run()
+    if load:
+        # open loop at a target rate instead of the simulated-time replay
+        await test2.run_load(**load)
+    else:
+        await test2.run(resume=resume)
+
+    if dash:
+        await dash.refresh(force=True)
+        for row in await dash.category_totals():
+            logger.info(f"Dashboard category {row['category']}: {row['tx_count']} tx, {row['total_amount']:.2f}")
+        for row in await dash.top_merchants():
+            logger.info(f"Dashboard top merchant {row['merchant_id']}: {row['total_amount']:.2f}")
+        days = await dash.rejection_rates()
+        accepted = sum(row['accepted'] for row in days)
+        rejected = sum(row['rejected'] for row in days)
+        logger.info(f"Dashboard over {len(days)} days: {accepted} accepted, {rejected} rejected")
+        await dash.close()
+
+    await close_shared_processor()
     
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="DC Research simulation")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="run the scenario sharded across this many processes (0 = single-process tests)")
+    parser.add_argument('--scenario', choices=SCENARIO_NAMES, default='50k')
+    parser.add_argument('--seed', type=int, default=None, help="seed for the generated population and transactions")
+    parser.add_argument('--engine', choices=['db', 'memory'], default='db',
+                        help="payment engine for test2: PostgreSQL per batch, or in-memory ledger with write-behind")
+    parser.add_argument('--customers', type=int, default=None, help="test2 population size (default 5000)")
+    parser.add_argument('--merchants', type=int, default=None, help="test2 merchant count (default 500)")
+    parser.add_argument('--transactions', type=int, default=None, help="test2 simulated transactions (default 50000)")
+    parser.add_argument('--tps', type=int, default=None,
+                        help="run test2 open-loop at this target arrival rate instead of the simulated replay")
+    parser.add_argument('--duration', type=float, default=60.0, help="open-loop run length in seconds")
+    parser.add_argument('--arrivals', choices=ARRIVAL_PROFILES, default='poisson', help="open-loop arrival profile")
+    parser.add_argument('--max-in-flight', type=int, default=None, help="open-loop concurrency cap")
+    parser.add_argument('--sweep-to', type=int, default=None,
+                        help="step the open-loop rate up by --tps until this rate, stopping at saturation")
+    parser.add_argument('--checkpoint-dir', default=None,
+                        help="save test2's simulation state here (.npy columns) every --checkpoint-weeks simulated weeks")
+    parser.add_argument('--checkpoint-weeks', type=int, default=4)
+    parser.add_argument('--resume', action='store_true', help="continue test2 from the checkpoint in --checkpoint-dir")
+    parser.add_argument('--dashboard', action='store_true',
+                        help="keep the dashboard aggregates refreshed during test2 and log them at the end")
+    parser.add_argument('--anomaly', action='store_true',
+                        help="score test2's replayed payments for anomalies (IsolationForest, needs scikit-learn)")
+    parser.add_argument('--log-profile', choices=sorted(PROFILES), default=None,
+                        help="logging verbosity profile (default: $LOG_PROFILE or 'default')")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
-    
\ No newline at end of file
+    args = parse_args()
+    if args.workers:
+        from src.driver import SCENARIOS, run_sharded
+        if args.log_profile:
+            os.environ['LOG_PROFILE'] = args.log_profile
+        setup_logger()
+        run_sharded(**SCENARIOS[args.scenario], workers=args.workers, seed=args.seed)
+    else:
+        population = {k: v for k, v in (('customers', args.customers), ('merchants', args.merchants),
+                                        ('transactions', args.transactions)) if v is not None}
+        load = None
+        if args.tps:
+            load = {'target_tps': args.tps, 'duration': args.duration, 'profile': args.arrivals,
+                    'max_in_flight': args.max_in_flight, 'sweep_to': args.sweep_to}
+        checkpoint = None
+        if args.checkpoint_dir:
+            checkpoint = {'checkpoint_dir': args.checkpoint_dir, 'checkpoint_weeks': args.checkpoint_weeks,
+                          'resume': args.resume}
+        elif args.resume:
+            raise SystemExit("--resume needs --checkpoint-dir")
+        asyncio.run(main(args.log_profile, args.engine, load, population, checkpoint, args.dashboard,
+                         args.anomaly, args.seed))
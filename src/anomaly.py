@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from src.data_layer.money import SCALE
+from src.data_layer.processor import DataProcessor
+from src.generator import CATEGORIES
+
+
+logger = logging.getLogger(__name__)
+
+# Constants
+QUEUE_SIZE = 100000
+BATCH_SIZE = 2000
+FLUSH_INTERVAL = 0.5
+WORKERS = 2
+FIT_SAMPLE = 50000
+CONTAMINATION = 0.01
+MAX_RATIO = 100.0
+
+CATEGORY_CODES = {c: i for i, c in enumerate(CATEGORIES)}
+
+FIT_QUERY = '''
+SELECT h.amount::float8 / $2::float8 AS amount, h.b_old::float8 / $2::float8 AS b_old, h.is_rejected,
+       EXTRACT(HOUR FROM h.time AT TIME ZONE 'UTC')::int AS hour, m.category, f.avg_tr_val::float8 AS avg_tr_val
+FROM history h
+JOIN merchants m ON m.merchant_id = h.merchant_id
+LEFT JOIN freqvol f ON f.cust_id = h.customer_id
+ORDER BY h.time DESC
+LIMIT $1
+'''
+
+
+# Feature matrix, shared by fitting and scoring:
+#   log amount, amount / customer's average payment (freqvol.avg_tr_val), amount / balance before,
+#   merchant category code, hour of day, rejected flag
+def features(amount, b_old, rejected, hour, category, avg_tr_val):
+    amount = np.asarray(amount, dtype=np.float64)
+    avg = np.asarray(avg_tr_val, dtype=np.float64)
+    avg = np.where(np.isnan(avg) | (avg <= 0), amount, avg)
+    rel_amount = np.divide(amount, avg, out=np.ones_like(amount), where=avg > 0)
+    b_old = np.asarray(b_old, dtype=np.float64)
+    bal_ratio = np.divide(amount, b_old, out=np.full_like(amount, MAX_RATIO), where=b_old > 0)
+    return np.column_stack([
+        np.log1p(np.maximum(amount, 0)),
+        np.minimum(rel_amount, MAX_RATIO),
+        np.minimum(bal_ratio, MAX_RATIO),
+        np.asarray(category, dtype=np.float64),
+        np.asarray(hour, dtype=np.float64),
+        np.asarray(rejected, dtype=np.float64),
+    ])
+
+
+# Process pool side: the fitted model is shipped once per worker through the initializer,
+# batches only carry the feature matrix
+_model = None
+
+
+def _init_worker(model):
+    global _model
+    _model = model
+
+
+def _score(X):
+    return _model.decision_function(X), _model.predict(X) == -1
+
+
+def _fit(X, contamination, seed):
+    from sklearn.ensemble import IsolationForest
+    return IsolationForest(contamination=contamination, random_state=seed).fit(X)
+
+
+# Streaming anomaly scoring, off the payment path.
+# DataProcessor hands every recorded payment (accepted or rejected, as history rows) to submit(),
+# which only appends to a bounded queue; when the queue is full rows are dropped and counted rather
+# than slowing payments down. A consumer task cuts micro-batches of up to batch_size rows (or
+# whatever arrived within flush_interval), looks up the features it needs with two ANY() queries,
+# and scores them with a pre-fit IsolationForest in a process pool, with up to `workers` batches in
+# flight. Flagged rows go to tx_flags with one COPY per batch.
+# Lag (enqueue to flags written, oldest row in the batch) is recorded as "anomaly_lag" in dp.stats,
+# with anomaly_scored / anomaly_flagged / anomaly_dropped counters.
+class AnomalyScorer:
+    def __init__(self, dp: DataProcessor, model=None, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, workers=WORKERS, contamination=CONTAMINATION, seed=None):
+        self.dp = dp
+        self.model = model
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.workers = workers
+        self.contamination = contamination
+        self.seed = seed
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.categories = {}   # merchant_id -> category code, merchants don't change category
+        self._pool = None
+        self._task = None
+        self._slots = asyncio.Semaphore(workers)
+        self._inflight = set()
+
+    # Fit on the most recent history rows (default FIT_SAMPLE), in the process pool
+    async def fit(self, sample_size=FIT_SAMPLE):
+        scale = SCALE if self.dp.money_minor else 1
+        async with self.dp.acquire('anomaly_fit') as conn:
+            rows = await conn.fetch(FIT_QUERY, sample_size, scale)
+        if not rows:
+            raise ValueError("no history to fit the anomaly model on")
+        X = features([r['amount'] for r in rows], [r['b_old'] for r in rows], [r['is_rejected'] for r in rows],
+                     [r['hour'] for r in rows], [CATEGORY_CODES.get(r['category'], -1) for r in rows],
+                     [r['avg_tr_val'] if r['avg_tr_val'] is not None else np.nan for r in rows])
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            self.model = await loop.run_in_executor(pool, _fit, X, self.contamination, self.seed)
+        logger.info(f"Anomaly model fitted on {len(rows)} history rows")
+        return self.model
+
+    async def start(self):
+        if self.model is None:
+            await self.fit()
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(self.model,))
+        self._task = asyncio.create_task(self._run())
+        self.dp.stats.gauge('anomaly_queue_depth', self.queue.qsize)
+        self.dp.scorer = self
+
+    # rows: history tuples (history_id, customer_id, merchant_id, amount, time, is_rejected, b_old, b_new)
+    # in storage units. Never waits.
+    def submit(self, rows):
+        now = time.monotonic()
+        for row in rows:
+            try:
+                self.queue.put_nowait((now, row))
+            except asyncio.QueueFull:
+                self.dp.stats.incr('anomaly_dropped')
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._slots.acquire()
+            task = asyncio.create_task(self._score_batch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _score_batch(self, batch):
+        try:
+            enqueued = batch[0][0]
+            rows = [row for _, row in batch]
+            X = await self._features(rows)
+            loop = asyncio.get_running_loop()
+            scores, flagged = await loop.run_in_executor(self._pool, _score, X)
+            flags = [(row[0], row[1], row[2], row[4], float(score))
+                     for row, score, flag in zip(rows, scores, flagged) if flag]
+            if flags:
+                async with self.dp.acquire('anomaly_flags') as conn:
+                    await conn.copy_records_to_table('tx_flags', records=flags,
+                                                     columns=['history_id', 'customer_id', 'merchant_id', 'tx_time', 'score'])
+            self.dp.stats.incr('anomaly_scored', len(rows))
+            self.dp.stats.incr('anomaly_flagged', len(flags))
+            self.dp.stats.observe('anomaly_lag', time.monotonic() - enqueued)
+        except Exception as e:
+            logger.error(f"Anomaly scoring failed for a batch of {len(batch)}: {e}")
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+            self._slots.release()
+
+    async def _features(self, rows):
+        cust_ids = list({row[1] for row in rows})
+        merch_ids = list({row[2] for row in rows if row[2] not in self.categories})
+        async with self.dp.acquire('anomaly_features') as conn:
+            rows_avg = await conn.fetch('SELECT cust_id, avg_tr_val::float8 FROM freqvol WHERE cust_id = ANY($1::text[])', cust_ids)
+            avgs = {r[0]: r[1] for r in rows_avg}
+            if merch_ids:
+                for r in await conn.fetch('SELECT merchant_id, category FROM merchants WHERE merchant_id = ANY($1::text[])', merch_ids):
+                    self.categories[r['merchant_id']] = CATEGORY_CODES.get(r['category'], -1)
+        scale = SCALE if self.dp.money_minor else 1
+        amount = np.array([float(row[3]) for row in rows]) / scale
+        b_old = np.array([float(row[6]) for row in rows]) / scale
+        return features(amount, b_old, [row[5] for row in rows], [row[4].hour for row in rows],
+                        [self.categories.get(row[2], -1) for row in rows],
+                        [avgs.get(row[1], np.nan) for row in rows])
+
+    # Score everything submitted so far
+    async def drain(self):
+        await self.queue.join()
+
+    async def close(self):
+        if self._task is None:
+            return
+        await self.drain()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._pool.shutdown()
+        if self.dp.scorer is self:
+            self.dp.scorer = None
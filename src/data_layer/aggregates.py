@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import time
+
+import asyncpg
+
+from src.data_layer.cache import RESULT_CACHE_SIZE, RESULT_MAX_LAG, RESULT_TTL, ResultCache
+from src.data_layer.money import SCALE
+from src.data_layer.processor import VIEWS, DataProcessor
+
+
+logger = logging.getLogger(__name__)
+
+# Constants
+POOL_SIZE = 2
+REFRESH_INTERVAL = 30.0
+VELOCITY_BUCKETS = 20
+TOP_MERCHANTS = 10
+ROLLUPS = ['cust_daily', 'merch_daily']   # what the views are built from
+
+# Query texts are constant and take everything as parameters, so asyncpg prepares each one once per
+# connection and reuses it from its statement cache. Money comes back as float8 in currency units.
+CATEGORY_QUERY = '''
+SELECT category, SUM(tx_count)::BIGINT AS tx_count, SUM(total_amount)::float8 / $3::float8 AS total_amount
+FROM mv_category_daily
+WHERE ($1::date IS NULL OR day >= $1) AND ($2::date IS NULL OR day <= $2)
+GROUP BY category
+ORDER BY 3 DESC
+'''
+TOP_MERCHANTS_QUERY = '''
+SELECT merchant_id, category, tx_count, total_amount::float8 / $3::float8 AS total_amount, last_day
+FROM mv_merchant_totals
+WHERE $2::text IS NULL OR category = $2
+ORDER BY mv_merchant_totals.total_amount DESC
+LIMIT $1
+'''
+REJECTIONS_QUERY = '''
+SELECT day, accepted, rejected, rejected::float8 / NULLIF(accepted + rejected, 0) AS rejection_rate
+FROM mv_daily_rejections
+WHERE ($1::date IS NULL OR day >= $1) AND ($2::date IS NULL OR day <= $2)
+ORDER BY day
+'''
+# Row changes to the rollups from every process, as counted by the cumulative statistics system. Each
+# backend flushes its counts after committing (within seconds), so no payment has to touch a shared
+# counter row to announce itself.
+ROLLUP_CHANGES_QUERY = '''
+SELECT COALESCE(SUM(n_tup_ins + n_tup_upd + n_tup_del), 0)::BIGINT
+FROM pg_stat_user_tables
+WHERE schemaname = current_schema() AND relname = ANY($1::text[])
+'''
+# Live, freqvol is one row per customer; upper defaults to the largest velocity
+VELOCITY_QUERY = '''
+WITH bound AS (SELECT GREATEST(COALESCE($2::float8, MAX(velocity)::float8), 1e-9) AS upper FROM freqvol)
+SELECT LEAST(GREATEST(width_bucket(f.velocity::float8, 0, b.upper, $1::int), 1), $1::int) AS bucket,
+       COUNT(*) AS customers, b.upper
+FROM freqvol f CROSS JOIN bound b
+GROUP BY 1, b.upper
+ORDER BY 1
+'''
+
+
+# Read API for dashboards: category totals, top merchants, daily rejection rates and the velocity
+# distribution, off the payment path.
+# - Own small pool (pool_size connections), so dashboard reads never queue for the connections
+#   payments use.
+# - The first three read materialized views over the daily rollups, refreshed CONCURRENTLY (readers
+#   aren't blocked) every refresh_interval seconds, and only when the rollups changed since the last
+#   refresh: dp.watermark for this process's payments, ROLLUP_CHANGES_QUERY for everyone's (sharded
+#   driver workers, other processes). Their results are cached until the next refresh. When dp's
+#   tables are replaced (clear_db, template reset, restore) dp refreshes the views itself and every
+#   cached result is dropped.
+# - The velocity distribution is live and cached against dp.watermark: exact while no payment has
+#   been recorded, otherwise reused for up to ttl seconds / max_lag payments.
+# Concurrent misses on the same query share one database round trip. Timings go to dp.stats as
+# "dashboard.<query>", with dashboard_cache_hit/miss counters.
+class DashboardAggregates:
+    def __init__(self, dp: DataProcessor, pool_size=POOL_SIZE, refresh_interval=REFRESH_INTERVAL,
+                 cache_size=RESULT_CACHE_SIZE, ttl=RESULT_TTL, max_lag=RESULT_MAX_LAG):
+        self.dp = dp
+        self.pool_size = pool_size
+        self.refresh_interval = refresh_interval
+        self.views = ResultCache(max_size=cache_size, max_lag=0)
+        self.live = ResultCache(max_size=cache_size, ttl=ttl, max_lag=max_lag)
+        self.generation = 0          # bumped by every view refresh
+        self.pool = None
+        self._refreshed_at = None    # (dp.watermark, rollup changes) the views were last refreshed from
+        self._resets = dp.resets
+        self._task = None
+        self._inflight = {}
+
+    async def start(self):
+        if self.pool is not None:
+            return
+        self.pool = await asyncpg.create_pool(dsn=self.dp.db_url, min_size=1, max_size=self.pool_size)
+        await self.refresh(force=True)
+        self._task = asyncio.create_task(self._refresh_loop())
+        self.dp.stats.gauge('dashboard_cache_size', lambda: len(self.views) + len(self.live))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    # Returns whether the views were refreshed
+    async def refresh(self, force=False):
+        started = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                marker = (self.dp.watermark, await conn.fetchval(ROLLUP_CHANGES_QUERY, ROLLUPS))
+                if not force and marker == self._refreshed_at:
+                    return False
+                for view in VIEWS:
+                    await conn.execute(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {view}')
+        except Exception as e:
+            logger.error(f"Dashboard view refresh failed: {e}")
+            raise
+        self._refreshed_at = marker
+        self.generation += 1
+        self.views.clear()
+        self.dp.stats.observe('dashboard_refresh', time.perf_counter() - started)
+        return True
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception:
+                pass   # logged by refresh(), retried next interval
+
+    # Queries
+    # start/end: inclusive date bounds, None for open-ended
+    async def category_totals(self, start=None, end=None):
+        return await self._view('category_totals', CATEGORY_QUERY, start, end, self._scale())
+
+    async def top_merchants(self, limit=TOP_MERCHANTS, category=None):
+        return await self._view('top_merchants', TOP_MERCHANTS_QUERY, limit, category, self._scale())
+
+    async def rejection_rates(self, start=None, end=None):
+        return await self._view('rejection_rates', REJECTIONS_QUERY, start, end)
+
+    # Customers per velocity bucket: buckets equal-width bins over [0, upper], values outside clamp
+    # into the first/last bin
+    async def velocity_distribution(self, buckets=VELOCITY_BUCKETS, upper=None):
+        self._check_reset()
+        rows = await self._cached(self.live, self.dp.watermark, 'velocity_distribution', VELOCITY_QUERY, buckets, upper)
+        out = []
+        for r in rows:
+            width = r['upper'] / buckets
+            out.append({'bucket': r['bucket'], 'low': (r['bucket'] - 1) * width, 'high': r['bucket'] * width,
+                        'customers': r['customers']})
+        return out
+
+    def _scale(self):
+        return SCALE if self.dp.money_minor else 1
+
+    async def _view(self, name, query, *args):
+        self._check_reset()
+        return await self._cached(self.views, self.generation, name, query, *args)
+
+    def _check_reset(self):
+        if self.dp.resets != self._resets:
+            self._resets = self.dp.resets
+            self.generation += 1
+            self.views.clear()
+            self.live.clear()
+
+    # Misses run as one task per key and version that every concurrent caller awaits (shielded), so a
+    # cancelled caller neither cancels the query for the others nor leaves them waiting on it
+    async def _cached(self, cache, version, name, query, *args):
+        key = (name, args)
+        hit, value = cache.get(key, version)
+        if hit:
+            self.dp.stats.incr('dashboard_cache_hit')
+            return value
+        self.dp.stats.incr('dashboard_cache_miss')
+        # a query started before a refresh mustn't answer callers arriving after it
+        flight = (key, version)
+        task = self._inflight.get(flight)
+        if task is None:
+            task = asyncio.create_task(self._fetch(cache, version, name, key, query, args))
+            self._inflight[flight] = task
+            task.add_done_callback(lambda t: self._fetched(flight, t))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, cache, version, name, key, query, args):
+        try:
+            started = time.perf_counter()
+            async with self.pool.acquire() as conn:
+                rows = [dict(r) for r in await conn.fetch(query, *args)]
+            self.dp.stats.observe(f'dashboard.{name}', time.perf_counter() - started)
+        except Exception as e:
+            logger.error(f"Dashboard query {name} failed: {e}")
+            raise
+        cache.put(key, rows, version)
+        return rows
+
+    def _fetched(self, key, task):
+        self._inflight.pop(key, None)
+        # mark retrieved, so a failure whose callers were all cancelled isn't reported as unhandled
+        if not task.cancelled():
+            task.exception()
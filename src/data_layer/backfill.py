@@ -0,0 +1,171 @@
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from src.data_layer.money import SCALE
+from src.data_layer.processor import BONUS_RATE, TARGET_VELOCITY, DataProcessor, as_utc
+
+
+logger = logging.getLogger(__name__)
+
+# Constants
+CHUNK_SIZE = 200000
+DAYS_PER_WEEK = 7
+
+COLUMNS = ['customer_id', 'merchant_id', 'amount', 'time', 'b_new']
+# money comes back as float8 in currency units whatever the storage representation
+HISTORY_QUERY = '''
+SELECT customer_id, merchant_id, amount::float8 / $2::float8 AS amount, time, b_new::float8 / $2::float8 AS b_new
+FROM history
+WHERE NOT is_rejected AND customer_id IS NOT NULL AND time <= $1
+ORDER BY customer_id, time
+'''
+
+
+# Rebuilds cust_core, freqvol and cust_incentives from history, with the same definitions the
+# write-behind aggregator (metrics.py) maintains incrementally:
+#   cust_core        mean/max/min/std of post-payment balances, days since the last payment
+#   freqvol          payments on the as_of day and in the 7 days ending with it, mean/total/std of
+#                    payment amounts, velocity = total / target velocity
+#   cust_incentives  accrued cashback (total * bonus rate) and decay cycles from the incentive rows
+#                    (merchant_id NULL, negative amount) in history. incentive_resp isn't in history,
+#                    so it is left as it is (new rows get the column default)
+# History is read through a server-side cursor ordered by (customer_id, time), chunk_size rows at a
+# time. Rows of the last customer in a chunk are carried into the next one, so every customer is
+# aggregated from complete data and memory stays at about one chunk. Each chunk's customers are
+# written with one bulk upsert per table.
+# Run it while no payments are in flight: the aggregator's cached state is dropped afterwards.
+class MetricsBackfill:
+    def __init__(self, dp: DataProcessor, chunk_size=CHUNK_SIZE, bonus_rate=BONUS_RATE, target_velocity=TARGET_VELOCITY):
+        self.dp = dp
+        self.chunk_size = chunk_size
+        self.bonus_rate = bonus_rate
+        self.target_velocity = target_velocity
+
+    # as_of: metrics as of this time (default: the latest history row); later rows are ignored
+    async def run(self, as_of=None):
+        started = time.perf_counter()
+        await self.dp.metrics.flush()
+        async with self.dp.acquire('backfill') as conn:
+            if as_of is None:
+                as_of = await conn.fetchval('SELECT MAX(time) FROM history')
+                if as_of is None:
+                    logger.info("Backfill: history is empty, nothing to do")
+                    return {'rows': 0, 'customers': 0, 'elapsed': time.perf_counter() - started}
+        as_of = as_utc(as_of)
+        day_start = pd.Timestamp(as_of.replace(hour=0, minute=0, second=0, microsecond=0))
+        week_start = day_start - timedelta(days=DAYS_PER_WEEK - 1)
+        scale = SCALE if self.dp.money_minor else 1
+
+        rows = 0
+        customers = 0
+        carry = None
+        try:
+            async with self.dp.acquire('backfill_read') as conn:
+                async with conn.transaction():
+                    cursor = await conn.cursor(HISTORY_QUERY, as_of, scale)
+                    while True:
+                        records = await cursor.fetch(self.chunk_size)
+                        if not records:
+                            break
+                        rows += len(records)
+                        df = pd.DataFrame([tuple(r) for r in records], columns=COLUMNS)
+                        if carry is not None:
+                            df = pd.concat([carry, df], ignore_index=True)
+                        # the last customer may continue in the next chunk
+                        tail = df['customer_id'].iat[-1]
+                        last = df['customer_id'] == tail
+                        carry = df[last]
+                        customers += await self._write(self._aggregate(df[~last], day_start, week_start))
+                        logger.info(f"Backfill: {rows} history rows, {customers} customers written")
+            if carry is not None:
+                customers += await self._write(self._aggregate(carry, day_start, week_start))
+        except Exception as e:
+            logger.error(f"Backfill failed after {rows} history rows: {e}")
+            raise
+
+        # the aggregator reloads from the rebuilt tables on next use
+        await self.dp.metrics.reset()
+        elapsed = time.perf_counter() - started
+        logger.info(f"Backfill done as of {as_of}: {rows} history rows, {customers} customers in {elapsed:.1f}s")
+        return {'rows': rows, 'customers': customers, 'as_of': as_of, 'elapsed': elapsed}
+
+    def _aggregate(self, df, day_start, week_start):
+        if df.empty:
+            return None
+        payments = df[df['merchant_id'].notna()]
+        g = payments.groupby('customer_id', sort=False)
+        out = pd.DataFrame({
+            'n': g.size(),
+            'total': g['amount'].sum(),
+            'avg': g['amount'].mean(),
+            'std': g['amount'].std(ddof=0),
+            'bal_avg': g['b_new'].mean(),
+            'bal_max': g['b_new'].max(),
+            'bal_min': g['b_new'].min(),
+            'bal_std': g['b_new'].std(ddof=0),
+            'num_day': (payments['time'] >= day_start).groupby(payments['customer_id'], sort=False).sum(),
+            'num_week': (payments['time'] >= week_start).groupby(payments['customer_id'], sort=False).sum(),
+            'last': g['time'].max(),
+        })
+        out['inactive_days'] = (day_start - out['last'].dt.floor('D')).dt.days.clip(lower=0)
+        out['velocity'] = out['total'] / self.target_velocity
+        out['cashback'] = out['total'] * self.bonus_rate
+
+        decays = df[df['merchant_id'].isna() & (df['amount'] < 0)].groupby('customer_id', sort=False).size()
+        out = out.join(decays.rename('decay_cnt'), how='outer')
+        out['decay_cnt'] = out['decay_cnt'].fillna(0).astype(int)
+        out['cashback'] = out['cashback'].fillna(0.0)
+        return out
+
+    async def _write(self, out):
+        if out is None or out.empty:
+            return 0
+        paid = out[out['n'].notna()]
+        ids = paid.index.tolist()
+        if ids:
+            await self._write_paid(paid, ids)
+        await self.dp.bulk_upsert(
+            'cust_incentives', ['cust_id', 'cashback_earned', 'decay_loss_cnt'],
+            'cashback_earned=EXCLUDED.cashback_earned, decay_loss_cnt=EXCLUDED.decay_loss_cnt',
+            list(zip(out.index.tolist(), out['cashback'].tolist(), out['decay_cnt'].tolist())), len(out))
+        return len(out)
+
+    async def _write_paid(self, paid, ids):
+        await self.dp.bulk_upsert(
+            'cust_core', ['cust_id', 'avg_daily_bal', 'max_bal', 'min_bal', 'bal_std', 'inactive_days'],
+            'avg_daily_bal=EXCLUDED.avg_daily_bal, max_bal=EXCLUDED.max_bal, min_bal=EXCLUDED.min_bal, '
+            'bal_std=EXCLUDED.bal_std, inactive_days=EXCLUDED.inactive_days',
+            list(zip(ids, paid['bal_avg'].tolist(), paid['bal_max'].tolist(), paid['bal_min'].tolist(),
+                     paid['bal_std'].tolist(), paid['inactive_days'].astype(int).tolist())), len(ids))
+        await self.dp.bulk_upsert(
+            'freqvol', ['cust_id', 'num_tr_day', 'num_tr_week', 'avg_tr_val', 'total_tr_val', 'tr_std', 'velocity'],
+            'num_tr_day=EXCLUDED.num_tr_day, num_tr_week=EXCLUDED.num_tr_week, avg_tr_val=EXCLUDED.avg_tr_val, '
+            'total_tr_val=EXCLUDED.total_tr_val, tr_std=EXCLUDED.tr_std, velocity=EXCLUDED.velocity',
+            list(zip(ids, paid['num_day'].astype(int).tolist(), paid['num_week'].astype(int).tolist(),
+                     paid['avg'].tolist(), paid['total'].tolist(), paid['std'].tolist(), paid['velocity'].tolist())), len(ids))
+
+
+async def main(as_of=None, chunk_size=CHUNK_SIZE):
+    dp = DataProcessor()
+    await dp.init()
+    try:
+        return await MetricsBackfill(dp, chunk_size=chunk_size).run(as_of)
+    finally:
+        await dp.close()
+
+
+if __name__ == "__main__":
+    from src.logging_setup import setup_logger
+
+    parser = argparse.ArgumentParser(description="Rebuild customer metric tables from history")
+    parser.add_argument('--as-of', type=datetime.fromisoformat, default=None,
+                        help="ISO timestamp to compute metrics as of (default: latest history row)")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    setup_logger()
+    print(asyncio.run(main(args.as_of, args.chunk_size)))
@@ -0,0 +1,136 @@
+import time
+from collections import OrderedDict
+
+
+# Constants
+CACHE_SIZE = 100000
+RESULT_CACHE_SIZE = 1000
+RESULT_TTL = 5.0
+RESULT_MAX_LAG = 1000
+
+
+# Bounded LRU of customer balances, kept in step with this process's own writes.
+# Writers bracket each write with begin()/end(); end() stores the committed balance, unless another
+# write to the same customer overlapped it (commit order unknown), in which case the entry is dropped.
+# Misses are filled through fill() with the generation read before the query, so a read that raced
+# a write can't put back a value older than that write. Writes made by other processes are not seen.
+class BalanceCache:
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._data = OrderedDict()
+        self._inflight = {}   # customer_id -> [writes in flight, overlapped]
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        value = self._data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def fill(self, key, value, generation):
+        if value is None or generation != self.generation or key in self._inflight:
+            return
+        self._put(key, value)
+
+    def begin(self, keys):
+        self.generation += 1
+        for key in keys:
+            entry = self._inflight.get(key)
+            if entry is None:
+                self._inflight[key] = [1, False]
+            else:
+                entry[0] += 1
+                entry[1] = True
+
+    # balances: customer_id -> committed balance, or None when the outcome is unknown (failed write)
+    def end(self, balances):
+        self.generation += 1
+        for key, value in balances.items():
+            entry = self._inflight.get(key)
+            overlapped = False
+            if entry is not None:
+                entry[0] -= 1
+                overlapped = entry[1]
+                if entry[0] <= 0:
+                    del self._inflight[key]
+            if value is None or overlapped:
+                self._data.pop(key, None)
+            else:
+                self._put(key, value)
+
+    def invalidate(self, key):
+        self.generation += 1
+        self._data.pop(key, None)
+
+    # Balances changed wholesale (incentive cycle, reset): drop everything, and don't let writes
+    # already in flight store what they saw
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+        for entry in self._inflight.values():
+            entry[1] = True
+
+    def _put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def snapshot(self):
+        total = self.hits + self.misses
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else None}
+
+
+# Bounded LRU of query results, each tagged with the version it was computed at (a write counter such
+# as DataProcessor.watermark, or a refresh generation). While the version hasn't moved the entry is
+# exact and served as long as it stays in the LRU. Once it has, the entry is still served while it is
+# younger than ttl seconds and fewer than max_lag versions behind, so staleness is bounded under load
+# without recomputing on every write. max_lag=0 invalidates on any version change.
+class ResultCache:
+    def __init__(self, max_size=RESULT_CACHE_SIZE, ttl=RESULT_TTL, max_lag=RESULT_MAX_LAG):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_lag = max_lag
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()   # key -> (value, version, stored at)
+
+    def __len__(self):
+        return len(self._data)
+
+    # (True, value) on a hit, (False, None) otherwise
+    def get(self, key, version):
+        entry = self._data.get(key)
+        if entry is not None:
+            value, stored_version, stored_at = entry
+            if stored_version == version or (version - stored_version < self.max_lag
+                                             and time.monotonic() - stored_at < self.ttl):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True, value
+            del self._data[key]
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value, version):
+        self._data[key] = (value, version, time.monotonic())
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def snapshot(self):
+        total = self.hits + self.misses
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else None}
@@ -0,0 +1,355 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from src.data_layer.money import SCALE
+from src.data_layer.processor import TABLES, DataProcessor
+
+
+logger = logging.getLogger(__name__)
+
+# Constants
+CHECKPOINT_VERSION = 1
+CHUNK_ROWS = 200000
+MANIFEST = 'manifest.json'
+STREAM_DIR = 'stream'
+NULL = '\\N'
+
+# Column kinds and how they're stored:
+#   text, uuid  fixed-width unicode (numpy 'U<n>', n = longest value)
+#   int         int64
+#   bool        bool
+#   money       int64 minor units (SCALE per currency unit), whatever the database representation
+#   fixed       NUMERIC(20,4) metric columns, int64 units of 1/SCALE as well
+#   time        datetime64[us] (UTC)
+#   date        datetime64[D]
+#   float       float64
+# NULLs are kept in a <column>.null.npy mask next to the column, only written when there are any.
+SCHEMA = {
+    'customers': [('customer_id', 'text'), ('age', 'int'), ('name_full', 'text'), ('profession', 'text'),
+                  ('salary', 'money'), ('level', 'int'), ('acc_balance', 'money'), ('description', 'text'),
+                  ('industry', 'text'), ('behavior', 'text'), ('created_at', 'time'), ('updated_at', 'time')],
+    'merchants': [('merchant_id', 'text'), ('category', 'text'), ('description', 'text'), ('acc_balance', 'money'),
+                  ('created_at', 'time'), ('updated_at', 'time')],
+    'history': [('history_id', 'uuid'), ('customer_id', 'text'), ('merchant_id', 'text'), ('amount', 'money'),
+                ('time', 'time'), ('is_rejected', 'bool'), ('b_old', 'money'), ('b_new', 'money')],
+    'cust_daily': [('customer_id', 'text'), ('day', 'date'), ('tx_count', 'int'), ('rejected_count', 'int'),
+                   ('total_amount', 'money')],
+    'merch_daily': [('merchant_id', 'text'), ('day', 'date'), ('tx_count', 'int'), ('total_amount', 'money')],
+    'cust_core': [('cust_id', 'text'), ('avg_daily_bal', 'fixed'), ('max_bal', 'fixed'), ('min_bal', 'fixed'),
+                  ('bal_std', 'fixed'), ('inactive_days', 'int'), ('updated_at', 'time')],
+    'freqvol': [('cust_id', 'text'), ('num_tr_day', 'int'), ('num_tr_week', 'int'), ('avg_tr_val', 'fixed'),
+                ('total_tr_val', 'fixed'), ('tr_std', 'fixed'), ('velocity', 'fixed'), ('updated_at', 'time')],
+    'cust_incentives': [('cust_id', 'text'), ('cashback_earned', 'fixed'), ('decay_loss_cnt', 'int'),
+                        ('incentive_resp', 'fixed'), ('updated_at', 'time')],
+    'merchant_ledger': [('merchant_id', 'text'), ('amount', 'money'), ('created_at', 'time')],
+    'tx_flags': [('history_id', 'uuid'), ('customer_id', 'text'), ('merchant_id', 'text'), ('tx_time', 'time'),
+                 ('score', 'float'), ('flagged_at', 'time')],
+}
+# parents before children, for the foreign keys on restore
+ORDER = ['customers', 'merchants', 'history', 'cust_daily', 'merch_daily', 'cust_core', 'freqvol',
+         'cust_incentives', 'merchant_ledger', 'tx_flags']
+# dump order within a table: history by time, so a memory-mapped history reads chronologically
+SORT = {'customers': 'customer_id', 'merchants': 'merchant_id', 'history': 'time, history_id',
+        'cust_daily': 'customer_id, day', 'merch_daily': 'merchant_id, day', 'cust_core': 'cust_id',
+        'freqvol': 'cust_id', 'cust_incentives': 'cust_id', 'merchant_ledger': 'created_at',
+        'tx_flags': 'tx_time'}
+STAGE_TYPES = {'text': 'TEXT', 'uuid': 'TEXT', 'int': 'BIGINT', 'bool': 'BOOLEAN', 'money': 'BIGINT',
+               'fixed': 'BIGINT', 'time': 'BIGINT', 'date': 'INT', 'float': 'FLOAT8'}
+DTYPES = {'int': np.int64, 'bool': np.bool_, 'money': np.int64, 'fixed': np.int64,
+          'time': 'datetime64[us]', 'date': 'datetime64[D]', 'float': np.float64}
+
+
+# Checkpoint / restore of the simulation state as memory-mappable .npy columns.
+# Layout of a checkpoint directory:
+#   manifest.json              version, row counts, column kinds, money scale, caller state (RNG, stream position)
+#   <table>/<column>.npy       one array per column, see SCHEMA for the storage kinds
+#   <table>/<column>.null.npy  NULL mask, only for columns that have NULLs
+#   stream/<name>.npy          caller arrays, e.g. the transactions not yet applied
+# save() reads every table in one REPEATABLE READ snapshot with COPY ... TO (CSV), converted to columns
+# chunk by chunk, and writes to <dir>.tmp before swapping it in, so a crash mid-save leaves the last
+# checkpoint intact. restore() truncates the tables and loads them back with COPY ... FROM into
+# staging tables in a single transaction; the history rollup trigger is disabled meanwhile, since the
+# rollup tables are restored as they were.
+class Checkpointer:
+    def __init__(self, dp: DataProcessor, chunk_rows=CHUNK_ROWS):
+        self.dp = dp
+        self.chunk_rows = chunk_rows
+
+    # state: JSON-serializable dict stored in the manifest; arrays: name -> 1-D array, saved under stream/
+    async def save(self, path, state=None, arrays=None):
+        started = time.perf_counter()
+        await self.dp.sync()
+        if self.dp.metrics:
+            await self.dp.metrics.flush()
+        if self.dp.scorer:
+            await self.dp.scorer.drain()
+        if self.dp.defer_merchant_credit:
+            # folds merch_daily_pending too, which checkpoints don't carry
+            await self.dp.consolidate_merchant_credits()
+
+        tmp = path.rstrip(os.sep) + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        tables = {}
+        try:
+            async with self.dp.acquire('checkpoint_save') as conn:
+                async with conn.transaction(isolation='repeatable_read', readonly=True):
+                    for table in ORDER:
+                        tables[table] = await self._dump_table(conn, table, tmp)
+            names = []
+            if arrays:
+                os.makedirs(os.path.join(tmp, STREAM_DIR))
+                for name, values in arrays.items():
+                    values = np.asarray(values)
+                    if values.dtype == object:
+                        values = values.astype(str)
+                    np.save(os.path.join(tmp, STREAM_DIR, f'{name}.npy'), values)
+                    names.append(name)
+            manifest = {
+                'version': CHECKPOINT_VERSION,
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'scale': SCALE,
+                'money_minor': self.dp.money_minor,
+                'partitioned': self.dp.partition_history,
+                'tables': tables,
+                'arrays': names,
+                'state': state or {},
+            }
+            with open(os.path.join(tmp, MANIFEST), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            _swap(tmp, path)
+        except Exception as e:
+            logger.error(f"Checkpoint to {path} failed: {e}")
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        rows = sum(t['rows'] for t in tables.values())
+        logger.info(f"Checkpoint saved to {path}: {rows} rows in {time.perf_counter() - started:.1f}s")
+        return manifest
+
+    async def _dump_table(self, conn, table, tmp):
+        columns = SCHEMA[table]
+        names = [c for c, _ in columns]
+        texts = [c for c, kind in columns if kind in ('text', 'uuid')]
+        stats = await conn.fetchrow(f"SELECT COUNT(*){''.join(f', MAX(LENGTH({c}::text))' for c in texts)} FROM {table}")
+        n = stats[0]
+        widths = {c: max(1, stats[i + 1] or 0) for i, c in enumerate(texts)}
+
+        out = os.path.join(tmp, table)
+        os.makedirs(out)
+        arrays = {c: _allocate(os.path.join(out, f'{c}.npy'), f'U{widths[c]}' if c in widths else DTYPES[kind], n)
+                  for c, kind in columns}
+        nulls = {c: np.zeros(n, dtype=bool) for c in names}
+        if n:
+            import pandas as pd
+            csv = os.path.join(tmp, f'{table}.csv')
+            exprs = ', '.join(self._dump_expr(c, kind) for c, kind in columns)
+            await conn.copy_from_query(f'SELECT {exprs} FROM {table} ORDER BY {SORT[table]}', output=csv,
+                                       format='csv', null=NULL)
+            pos = 0
+            for chunk in pd.read_csv(csv, header=None, names=names, dtype=str, keep_default_na=False,
+                                     na_values=[NULL], chunksize=self.chunk_rows):
+                end = pos + len(chunk)
+                for c, kind in columns:
+                    mask = chunk[c].isna().to_numpy()
+                    nulls[c][pos:end] = mask
+                    _fill(arrays[c], pos, end, chunk[c], mask, kind)
+                pos = end
+            os.remove(csv)
+        for c in names:
+            if isinstance(arrays[c], np.memmap):
+                arrays[c].flush()
+            if nulls[c].any():
+                np.save(os.path.join(out, f'{c}.null.npy'), nulls[c])
+        return {'rows': n, 'columns': dict(columns)}
+
+    def _dump_expr(self, column, kind):
+        if kind == 'money' and self.dp.money_minor:
+            return column
+        if kind in ('money', 'fixed'):
+            return f'ROUND({column} * {SCALE})::bigint'
+        if kind == 'time':
+            return f'(EXTRACT(EPOCH FROM {column}) * 1000000)::bigint'
+        if kind == 'date':
+            return f"({column} - DATE '1970-01-01')"
+        if kind == 'uuid':
+            return f'{column}::text'
+        if kind == 'float':
+            return f'{column}::float8'
+        return column
+
+    def _restore_expr(self, column, kind):
+        if kind == 'money' and self.dp.money_minor:
+            return column
+        if kind in ('money', 'fixed'):
+            return f'{column}::numeric / {SCALE}'
+        if kind == 'time':
+            return f"TIMESTAMPTZ 'epoch' + {column} * INTERVAL '1 microsecond'"
+        if kind == 'date':
+            return f"DATE '1970-01-01' + {column}"
+        if kind == 'uuid':
+            return f'{column}::uuid'
+        return column
+
+    # Replaces the database contents with the checkpoint. Returns the manifest (with the caller's state)
+    # and the stream arrays.
+    async def restore(self, path):
+        started = time.perf_counter()
+        manifest = read_manifest(path)
+        if manifest['version'] != CHECKPOINT_VERSION:
+            raise ValueError(f"checkpoint {path} has version {manifest['version']}, expected {CHECKPOINT_VERSION}")
+        if manifest['scale'] != SCALE:
+            raise ValueError(f"checkpoint {path} stores money in 1/{manifest['scale']} units, expected 1/{SCALE}")
+        if self.dp.scorer:
+            await self.dp.scorer.drain()
+
+        history = load_table(path, 'history')
+        if len(history['time']):
+            first, last = history['time'][[0, -1]].astype(datetime)
+            await self.dp.ensure_history_partitions(first.replace(tzinfo=timezone.utc), last.replace(tzinfo=timezone.utc))
+        try:
+            async with self.dp.acquire('checkpoint_restore') as conn:
+                async with conn.transaction():
+                    await conn.execute(f"TRUNCATE {', '.join(TABLES)} RESTART IDENTITY CASCADE")
+                    await conn.execute('ALTER TABLE history DISABLE TRIGGER history_rollup_trg')
+                    for table in ORDER:
+                        await self._load_table(conn, path, table)
+                    await conn.execute('ALTER TABLE history ENABLE TRIGGER history_rollup_trg')
+        except Exception as e:
+            logger.error(f"Restore from {path} failed: {e}")
+            raise
+        await self.dp._reset_state()
+
+        arrays = {name: np.load(os.path.join(path, STREAM_DIR, f'{name}.npy')) for name in manifest['arrays']}
+        rows = sum(t['rows'] for t in manifest['tables'].values())
+        logger.info(f"Restored {rows} rows from checkpoint {path} in {time.perf_counter() - started:.1f}s")
+        return manifest, arrays
+
+    async def _load_table(self, conn, path, table):
+        columns = SCHEMA[table]
+        arrays = load_table(path, table)
+        n = len(arrays[columns[0][0]])
+        if not n:
+            return
+        import pandas as pd
+        nulls = {c: _load_nulls(path, table, c) for c, _ in columns}
+        stage = f'checkpoint_{table}'
+        await conn.execute(f"CREATE TEMP TABLE {stage} ({', '.join(f'{c} {STAGE_TYPES[kind]}' for c, kind in columns)}) "
+                           f"ON COMMIT DROP")
+
+        async def chunks():
+            for start in range(0, n, self.chunk_rows):
+                end = min(n, start + self.chunk_rows)
+                frame = pd.DataFrame({c: _stage_column(arrays[c][start:end], kind, nulls[c], start, end)
+                                      for c, kind in columns})
+                yield frame.to_csv(header=False, index=False, na_rep=NULL).encode()
+
+        await conn.copy_to_table(stage, source=chunks(), columns=[c for c, _ in columns], format='csv', null=NULL)
+        await conn.execute(f"INSERT INTO {table} ({', '.join(c for c, _ in columns)}) "
+                           f"SELECT {', '.join(self._restore_expr(c, kind) for c, kind in columns)} FROM {stage}")
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST)) as f:
+        return json.load(f)
+
+
+# Columns of one table as read-only memory maps, no database needed. Money and metric columns are
+# int64 in 1/scale units (manifest['scale']), times are UTC datetime64[us].
+def load_table(path, table, mmap=True):
+    mode = 'r' if mmap else None
+    return {c: np.load(os.path.join(path, table, f'{c}.npy'), mmap_mode=mode) for c, _ in SCHEMA[table]}
+
+
+# History for analysis: memory-mapped columns, or a DataFrame with money in currency units
+def read_history(path, as_frame=False):
+    columns = load_table(path, 'history')
+    if not as_frame:
+        return columns
+    import pandas as pd
+    scale = read_manifest(path)['scale']
+    df = pd.DataFrame({c: np.asarray(v) for c, v in columns.items()})
+    for c in ('amount', 'b_old', 'b_new'):
+        df[c] = df[c] / scale
+    for c in ('customer_id', 'merchant_id'):
+        mask = _load_nulls(path, 'history', c)
+        if mask is not None:
+            df.loc[mask, c] = None
+    return df
+
+
+def _load_nulls(path, table, column):
+    mask = os.path.join(path, table, f'{column}.null.npy')
+    return np.load(mask) if os.path.exists(mask) else None
+
+
+# open_memmap can't map an empty file
+def _allocate(path, dtype, n):
+    if not n:
+        values = np.empty(0, dtype=dtype)
+        np.save(path, values)
+        return values
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n,))
+
+
+def _fill(target, start, end, values, mask, kind):
+    if kind in ('text', 'uuid'):
+        target[start:end] = values.fillna('').to_numpy(dtype=str)
+    elif kind == 'bool':
+        target[start:end] = (values == 't').to_numpy(dtype=bool)
+    elif kind == 'float':
+        target[start:end] = values.fillna('0').to_numpy(dtype=np.float64)
+    else:
+        # int64 payload for ints, money, times and dates
+        target[start:end].view(np.int64)[:] = values.fillna('0').to_numpy(dtype=np.int64)
+
+
+# One chunk of a stored column as staging-table values: NULLs as None, times/dates as int64 offsets
+def _stage_column(values, kind, mask, start, end):
+    values = np.asarray(values)
+    if kind in ('time', 'date'):
+        values = values.view(np.int64)
+    if mask is None or not mask[start:end].any():
+        return values
+    out = values.astype(object)
+    out[mask[start:end]] = None
+    return out
+
+
+def _swap(tmp, path):
+    old = path.rstrip(os.sep) + '.old'
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+async def main(command, path):
+    dp = DataProcessor()
+    await dp.init()
+    try:
+        if command == 'save':
+            return (await Checkpointer(dp).save(path))['tables']
+        manifest, _ = await Checkpointer(dp).restore(path)
+        return manifest['tables']
+    finally:
+        await dp.close()
+
+
+if __name__ == "__main__":
+    from src.logging_setup import setup_logger
+
+    parser = argparse.ArgumentParser(description="Save or restore the simulation database as .npy columns")
+    parser.add_argument('command', choices=['save', 'restore'])
+    parser.add_argument('path', help="checkpoint directory")
+    args = parser.parse_args()
+    setup_logger()
+    print(asyncio.run(main(args.command, args.path)))
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import random
+from bisect import bisect_left
+
+
+logger = logging.getLogger(__name__)
+
+# Constants
+# Upper bounds in seconds, Prometheus-style; the last bucket is +Inf
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SAMPLE_RATE = 1.0
+LOG_INTERVAL = 60.0
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    # Upper bound of the bucket holding the q-th observation
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+# In-process instrumentation for DataProcessor.
+# Counters and histograms are plain ints/floats touched only from the event loop thread, with no
+# await in between, so they need no locks. Timings are sampled (sample_rate) to keep the hot path
+# cheap; counters are always exact. Gauges are callables read at snapshot time.
+class Stats:
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self._log_task = None
+
+    def sampled(self):
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def observe(self, name, seconds):
+        hist = self.histograms.get(name)
+        if hist is None:
+            hist = self.histograms[name] = Histogram()
+        hist.observe(seconds)
+
+    def incr(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def snapshot(self):
+        gauges = {}
+        for name, fn in self.gauges.items():
+            try:
+                gauges[name] = fn()
+            except Exception:
+                gauges[name] = None
+        return {
+            'sample_rate': self.sample_rate,
+            'counters': dict(self.counters),
+            'gauges': gauges,
+            'timings': {name: {
+                'count': h.count,
+                'mean_ms': h.total / h.count * 1000 if h.count else None,
+                'p50_ms': _ms(h.quantile(0.50)),
+                'p95_ms': _ms(h.quantile(0.95)),
+                'p99_ms': _ms(h.quantile(0.99)),
+            } for name, h in self.histograms.items()},
+        }
+
+    # Prometheus text exposition format
+    def to_prometheus(self, prefix='dc'):
+        lines = [f'# TYPE {prefix}_op_seconds histogram']
+        for name, h in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, n in zip(BUCKETS + ('+Inf',), h.counts):
+                cumulative += n
+                lines.append(f'{prefix}_op_seconds_bucket{{op="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_op_seconds_sum{{op="{name}"}} {h.total}')
+            lines.append(f'{prefix}_op_seconds_count{{op="{name}"}} {h.count}')
+        lines.append(f'# TYPE {prefix}_events_total counter')
+        for name, n in sorted(self.counters.items()):
+            lines.append(f'{prefix}_events_total{{event="{name}"}} {n}')
+        lines.append(f'# TYPE {prefix}_gauge gauge')
+        for name, value in sorted(self.snapshot()['gauges'].items()):
+            if value is not None:
+                lines.append(f'{prefix}_gauge{{name="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    # Optional periodic one-line summary in the log
+    def start_logging(self, interval=LOG_INTERVAL):
+        if self._log_task is None:
+            self._log_task = asyncio.create_task(self._log_loop(interval))
+
+    async def stop_logging(self):
+        if self._log_task is not None:
+            self._log_task.cancel()
+            await asyncio.gather(self._log_task, return_exceptions=True)
+            self._log_task = None
+
+    async def _log_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            snap = self.snapshot()
+            timings = ', '.join(f"{name} n={t['count']} p50={t['p50_ms']}ms p99={t['p99_ms']}ms"
+                                for name, t in sorted(snap['timings'].items()))
+            logger.info(f"Stats: counters={snap['counters']} gauges={snap['gauges']} timings: {timings}")
+
+
+def _ms(seconds):
+    return seconds * 1000 if seconds is not None else None
@@ -0,0 +1,357 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from src.data_layer.money import SCALE, from_minor, to_minor, to_minor_array
+from src.data_layer.processor import BATCH_SIZE, BULK_CHUNK_SIZE, DataProcessor, as_utc
+
+
+logger = logging.getLogger(__name__)
+
+# Constants
+HISTORY_CAPACITY = 1_000_000
+FLUSH_INTERVAL = 5.0
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def _micros(dt):
+    return (as_utc(dt) - EPOCH) // MICROSECOND
+
+
+# n UUIDv7 history ids (the layout of processor.new_tr_id) as their high and low 64-bit halves
+def _new_ids(n):
+    ms = np.uint64(time.time_ns() // 1_000_000)
+    rand = np.frombuffer(os.urandom(16 * n), dtype=np.uint64).reshape(n, 2) if n else np.zeros((0, 2), dtype=np.uint64)
+    hi = (ms << np.uint64(16)) | np.uint64(0x7000) | (rand[:, 0] & np.uint64(0x0FFF))              # version 7
+    lo = (rand[:, 1] & np.uint64(0x3FFFFFFFFFFFFFFF)) | np.uint64(0x8000000000000000)               # RFC 4122 variant
+    return hi, lo
+
+
+def _uuids(hi, lo):
+    return [uuid.UUID(int=h << 64 | l) for h, l in zip(hi.tolist(), lo.tolist())]
+
+
+# In-memory ledger engine with write-behind persistence.
+# Same API and payment semantics as DataProcessor (balance check, rejected payments recorded,
+# debit/credit, metrics), but balances live in NumPy int64 arrays of minor units indexed by dense
+# ids (cust_index / merch_index map 'c123' / 'm45' to positions), and history is appended to
+# preallocated columnar buffers. A batch is applied in rounds by each customer's occurrence rank:
+# a round holds at most one payment per customer, so it is checked and debited with a handful of
+# array operations, and rounds run in input order so every customer's payments keep their order.
+# Buffered history and changed balances are written to the usual tables with COPY / one UPDATE
+# each every flush_interval seconds, when the buffer fills, and on sync()/close(). The database is
+# only complete after sync(); operations that read or change it directly (history readers, the
+# incentive cycle through sync()/reload_balances()) sync first. No other process may write
+# balances while a ledger is running.
+# Merchant balances are written back as absolute values, so deferred merchant credits don't apply:
+# consolidation would add ledger rows to a balance the ledger then overwrites. Credits already in
+# merchant_ledger are folded in before the balances are loaded.
+class MemoryLedger(DataProcessor):
+    def __init__(self, *args, history_capacity=HISTORY_CAPACITY, flush_interval=FLUSH_INTERVAL, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.defer_merchant_credit:
+            logger.warning("MemoryLedger credits merchants in memory; ignoring defer_merchant_credit")
+            self.defer_merchant_credit = False
+        self.history_capacity = history_capacity
+        self.flush_interval = flush_interval
+        self.cust_ids = []
+        self.merch_ids = []
+        self.cust_index = {}
+        self.merch_index = {}
+        self.cust_bal = np.zeros(0, dtype=np.int64)
+        self.merch_bal = np.zeros(0, dtype=np.int64)
+        self._cust_dirty = np.zeros(0, dtype=bool)
+        self._merch_dirty = np.zeros(0, dtype=bool)
+        self._alloc_history()
+        self._flush_lock = asyncio.Lock()
+        self._flusher = None
+        self._h_retry = None   # history columns from a failed sync, written ahead of the buffer next time
+
+    def _alloc_history(self):
+        n = self.history_capacity
+        self._h_len = 0
+        self._h_cust = np.empty(n, dtype=np.int64)
+        self._h_merch = np.empty(n, dtype=np.int64)
+        self._h_amount = np.empty(n, dtype=np.int64)
+        self._h_time = np.empty(n, dtype=np.int64)     # microseconds since epoch
+        self._h_rejected = np.empty(n, dtype=bool)
+        self._h_old = np.empty(n, dtype=np.int64)
+        self._h_new = np.empty(n, dtype=np.int64)
+        # history_id, generated here so rows handed to the anomaly scorer match what gets written
+        self._h_id_hi = np.empty(n, dtype=np.uint64)
+        self._h_id_lo = np.empty(n, dtype=np.uint64)
+
+    # Idempotent like DataProcessor.init(): a second call must not reload over unsynced balances
+    # or start another flusher
+    async def init(self):
+        if self.pool is not None:
+            return
+        await super().init()
+        # left behind by an earlier deferred-credit run
+        await self.consolidate_merchant_credits()
+        await self._load()
+        self._flusher = asyncio.create_task(self._flush_loop())
+        self.stats.gauge('ledger_history_buffered', lambda: self._h_len + (len(self._h_retry[0]) if self._h_retry else 0))
+
+    # Balances from the database; anything not yet written must be synced first
+    async def _load(self):
+        async with self.acquire('ledger_load') as conn:
+            customers = await conn.fetch('SELECT customer_id, acc_balance FROM customers ORDER BY customer_id')
+            merchants = await conn.fetch('SELECT merchant_id, acc_balance FROM merchants ORDER BY merchant_id')
+        convert = (lambda v: v) if self.money_minor else to_minor
+        self.cust_ids = [r[0] for r in customers]
+        self.merch_ids = [r[0] for r in merchants]
+        self.cust_index = {c: i for i, c in enumerate(self.cust_ids)}
+        self.merch_index = {m: i for i, m in enumerate(self.merch_ids)}
+        self.cust_bal = np.array([convert(r[1] or 0) for r in customers], dtype=np.int64)
+        self.merch_bal = np.array([convert(r[1] or 0) for r in merchants], dtype=np.int64)
+        self._cust_dirty = np.zeros(len(self.cust_ids), dtype=bool)
+        self._merch_dirty = np.zeros(len(self.merch_ids), dtype=bool)
+        logger.info(f"Ledger loaded {len(self.cust_ids)} customers and {len(self.merch_ids)} merchants")
+
+    # Population writes go through the database, then the arrays are reloaded from it
+    async def save_customer(self, customer: dict):
+        await self.sync()
+        await super().save_customer(customer)
+        await self._load()
+
+    async def save_merchant(self, merchant: dict):
+        await self.sync()
+        await super().save_merchant(merchant)
+        await self._load()
+
+    async def save_customers_bulk(self, customers, chunk_size=BULK_CHUNK_SIZE, progress=None):
+        await self.sync()
+        await super().save_customers_bulk(customers, chunk_size, progress)
+        await self._load()
+
+    async def save_merchants_bulk(self, merchants, chunk_size=BULK_CHUNK_SIZE, progress=None):
+        await self.sync()
+        await super().save_merchants_bulk(merchants, chunk_size, progress)
+        await self._load()
+
+    # Payments
+    async def make_transaction(self, customer_id, merchant_id, amount: float, at=None):
+        return (await self.make_transactions_batch([{'customer_id': customer_id, 'merchant_id': merchant_id,
+                                                     'amount': amount, 'time': at}]))[0]
+
+    async def make_transactions_batch(self, transactions, chunk_size=BATCH_SIZE):
+        transactions = list(transactions)
+        n = len(transactions)
+        if not n:
+            return []
+        now = _micros(datetime.now(timezone.utc))
+        ci = np.fromiter((self.cust_index.get(tx['customer_id'], -1) for tx in transactions), dtype=np.int64, count=n)
+        mi = np.fromiter((self.merch_index.get(tx['merchant_id'], -1) for tx in transactions), dtype=np.int64, count=n)
+        amt = to_minor_array([tx['amount'] for tx in transactions])
+        at = np.fromiter((_micros(t) if t is not None else now
+                          for t in (tx.get('time') or tx.get('date') for tx in transactions)), dtype=np.int64, count=n)
+
+        t_decide = time.perf_counter()
+        known = np.nonzero((ci >= 0) & (mi >= 0))[0]
+        ok = np.zeros(n, dtype=bool)
+        b_old = np.zeros(n, dtype=np.int64)
+        b_new = np.zeros(n, dtype=np.int64)
+        for rnd in self._rounds(ci[known]):
+            idx = known[rnd]
+            cust = ci[idx]
+            old = self.cust_bal[cust]
+            accept = old >= amt[idx]
+            new = np.where(accept, old - amt[idx], old)
+            self.cust_bal[cust] = new
+            np.add.at(self.merch_bal, mi[idx[accept]], amt[idx[accept]])
+            ok[idx] = accept
+            b_old[idx] = old
+            b_new[idx] = new
+        self._cust_dirty[ci[ok]] = True
+        self._merch_dirty[mi[ok]] = True
+        self.stats.observe('make_transactions_batch.decide', time.perf_counter() - t_decide)
+
+        accepted = int(ok.sum())
+        missing = n - len(known)
+        self.stats.incr('tx_accepted', accepted)
+        self.stats.incr('tx_rejected', len(known) - accepted)
+        self.stats.incr('tx_not_found', missing)
+        if missing:
+            logger.warning(f"Batch skipped {missing} transactions with unknown customer or merchant")
+
+        id_hi, id_lo = _new_ids(len(known))
+        await self._append_history(known, ci, mi, amt, at, ~ok[known], b_old, b_new, id_hi, id_lo)
+        if self.scorer is not None and len(known):
+            # accepted and rejected alike, as history rows in storage units, like DataProcessor._apply_batch
+            money = (lambda v: v) if self.money_minor else from_minor
+            cust_ids, merch_ids = self.cust_ids, self.merch_ids
+            self.scorer.submit([(h, cust_ids[c], merch_ids[m], money(a), EPOCH + t * MICROSECOND, not o, money(b0), money(b1))
+                                for h, c, m, a, t, o, b0, b1 in zip(_uuids(id_hi, id_lo), ci[known].tolist(), mi[known].tolist(),
+                                                                     amt[known].tolist(), at[known].tolist(), ok[known].tolist(),
+                                                                     b_old[known].tolist(), b_new[known].tolist())])
+
+        done = np.nonzero(ok)[0]
+        cust_ids = self.cust_ids
+        await self.metrics.record_many([(cust_ids[c], a / SCALE, b / SCALE)
+                                        for c, a, b in zip(ci[done].tolist(), amt[done].tolist(), b_new[done].tolist())])
+        return ok.tolist()
+
+    # Positions (into the given customer index array) grouped by each customer's occurrence rank:
+    # round r holds every customer's r-th payment, in input order
+    @staticmethod
+    def _rounds(cust):
+        n = len(cust)
+        if not n:
+            return []
+        order = np.argsort(cust, kind='stable')
+        sorted_cust = cust[order]
+        pos = np.arange(n)
+        starts = np.ones(n, dtype=bool)
+        starts[1:] = sorted_cust[1:] != sorted_cust[:-1]
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = pos - np.maximum.accumulate(np.where(starts, pos, 0))
+        by_rank = np.argsort(rank, kind='stable')
+        return np.split(by_rank, np.cumsum(np.bincount(rank))[:-1])
+
+    async def _append_history(self, idx, ci, mi, amt, at, rejected, b_old, b_new, id_hi, id_lo):
+        k = len(idx)
+        if k > self.history_capacity:
+            # larger than the whole buffer: write it straight through
+            await self._write_history(ci[idx], mi[idx], amt[idx], at[idx], rejected, b_old[idx], b_new[idx], id_hi, id_lo)
+            return
+        # checked again after every sync: other batches can refill the buffer while it runs
+        while self._h_len + k > self.history_capacity:
+            await self.sync()
+        s = slice(self._h_len, self._h_len + k)
+        self._h_cust[s] = ci[idx]
+        self._h_merch[s] = mi[idx]
+        self._h_amount[s] = amt[idx]
+        self._h_time[s] = at[idx]
+        self._h_rejected[s] = rejected
+        self._h_old[s] = b_old[idx]
+        self._h_new[s] = b_new[idx]
+        self._h_id_hi[s] = id_hi
+        self._h_id_lo[s] = id_lo
+        self._h_len += k
+
+    # Balances
+    async def balance_query(self, customer_id):
+        i = self.cust_index.get(customer_id)
+        return None if i is None else from_minor(int(self.cust_bal[i]))
+
+    async def merchant_balance(self, merchant_id):
+        i = self.merch_index.get(merchant_id)
+        return None if i is None else from_minor(int(self.merch_bal[i]))
+
+    # Write-behind
+    # Everything buffered goes out in one transaction: history by COPY, changed balances by one
+    # unnest UPDATE per table (absolute values, the arrays are authoritative)
+    async def sync(self):
+        async with self._flush_lock:
+            k = self._h_len
+            history = (self._h_cust[:k].copy(), self._h_merch[:k].copy(), self._h_amount[:k].copy(), self._h_time[:k].copy(),
+                       self._h_rejected[:k].copy(), self._h_old[:k].copy(), self._h_new[:k].copy(),
+                       self._h_id_hi[:k].copy(), self._h_id_lo[:k].copy())
+            self._h_len = 0
+            if self._h_retry is not None:
+                history = tuple(np.concatenate([old, new]) for old, new in zip(self._h_retry, history))
+                self._h_retry = None
+            k = len(history[0])
+            cust = np.nonzero(self._cust_dirty)[0]
+            merch = np.nonzero(self._merch_dirty)[0]
+            cust_bal = self.cust_bal[cust]
+            merch_bal = self.merch_bal[merch]
+            self._cust_dirty[cust] = False
+            self._merch_dirty[merch] = False
+            if not k and not len(cust) and not len(merch):
+                return
+            try:
+                await self._write_history(*history, cust=cust, cust_bal=cust_bal, merch=merch, merch_bal=merch_bal)
+            except Exception as e:
+                # nothing was committed: keep the balances marked and the history rows, the next sync retries both
+                self._cust_dirty[cust] = True
+                self._merch_dirty[merch] = True
+                self._h_retry = history
+                logger.error(f"Ledger write-behind of {k} history rows failed: {e}")
+                raise
+            logger.info(f"Ledger synced {k} history rows, {len(cust)} customers, {len(merch)} merchants",
+                        extra={'sample': 'ledger_sync'})
+
+    async def _write_history(self, h_cust, h_merch, h_amount, h_time, h_rejected, h_old, h_new, h_id_hi, h_id_lo,
+                             cust=(), cust_bal=(), merch=(), merch_bal=()):
+        money = (lambda v: v) if self.money_minor else from_minor
+        cust_ids, merch_ids = self.cust_ids, self.merch_ids
+        records = [(h, cust_ids[c], merch_ids[m], money(a), EPOCH + t * MICROSECOND, r, money(o), money(b))
+                   for h, c, m, a, t, r, o, b in zip(_uuids(h_id_hi, h_id_lo), h_cust.tolist(), h_merch.tolist(),
+                                                     h_amount.tolist(), h_time.tolist(), h_rejected.tolist(),
+                                                     h_old.tolist(), h_new.tolist())]
+        if records:
+            await self._cover_history(EPOCH + int(h_time.min()) * MICROSECOND, EPOCH + int(h_time.max()) * MICROSECOND)
+        async with self.acquire('ledger_sync') as conn:
+            async with conn.transaction():
+                if records:
+                    await conn.copy_records_to_table('history', records=records,
+                        columns=['history_id', 'customer_id', 'merchant_id', 'amount', 'time', 'is_rejected', 'b_old', 'b_new'])
+                if len(cust):
+                    await conn.execute(f'''
+                    UPDATE customers c SET acc_balance=d.acc_balance, updated_at=NOW()
+                    FROM unnest($1::text[], $2::{self.money_sql}[]) AS d(customer_id, acc_balance)
+                    WHERE c.customer_id=d.customer_id
+                    ''', [cust_ids[i] for i in cust.tolist()], [money(v) for v in cust_bal.tolist()])
+                if len(merch):
+                    await conn.execute(f'''
+                    UPDATE merchants m SET acc_balance=d.acc_balance, updated_at=NOW()
+                    FROM unnest($1::text[], $2::{self.money_sql}[]) AS d(merchant_id, acc_balance)
+                    WHERE m.merchant_id=d.merchant_id
+                    ''', [merch_ids[i] for i in merch.tolist()], [money(v) for v in merch_bal.tolist()])
+        # the database, which is what aggregate readers see, only has these rows now
+        self.watermark += len(records)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.error(f"Ledger background sync failed: {e}")
+
+    # Balances were changed in the database (incentive cycle): write ours out first, then reload
+    async def reload_balances(self):
+        await self.sync()
+        await self._load()
+        await super().reload_balances()
+
+    # History readers see the database, so bring it up to date first
+    async def get_historical_data(self):
+        await self.sync()
+        return await super().get_historical_data()
+
+    async def get_history_page(self, *args, **kwargs):
+        await self.sync()
+        return await super().get_history_page(*args, **kwargs)
+
+    async def iter_history(self, *args, **kwargs):
+        await self.sync()
+        async for row in super().iter_history(*args, **kwargs):
+            yield row
+
+    # clear_db / reset_from_template replace the tables under us: drop the buffers, reload the arrays
+    async def _reset_state(self):
+        self._h_len = 0
+        self._h_retry = None
+        self._cust_dirty[:] = False
+        self._merch_dirty[:] = False
+        await super()._reset_state()
+
+    async def close(self):
+        if self._flusher:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        try:
+            await self.sync()
+        except Exception as e:
+            logger.warning(f"Final ledger sync failed: {e}")
+        await super().close()
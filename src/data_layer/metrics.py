@@ -0,0 +1,298 @@
+import asyncio
+import logging
+import math
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Constants
+QUEUE_SIZE = 10000
+FLUSH_SIZE = 1000
+FLUSH_INTERVAL = 1.0
+RESP_STEP = 0.01
+
+
+# Running count/mean/variance (Welford) plus min/max
+class RunningStats:
+    __slots__ = ('n', 'mean', 'm2', 'lo', 'hi')
+
+    def __init__(self, n=0, mean=0.0, m2=0.0, lo=math.inf, hi=-math.inf):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+        self.lo = lo
+        self.hi = hi
+
+    def add(self, x):
+        self.n += 1
+        d = x - self.mean
+        self.mean += d / self.n
+        self.m2 += d * (x - self.mean)
+        if x < self.lo:
+            self.lo = x
+        if x > self.hi:
+            self.hi = x
+
+    # Chan et al. pairwise combination, so deltas can be folded into seeded state
+    def merge(self, other):
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        d = other.mean - self.mean
+        self.mean += d * other.n / n
+        self.m2 += other.m2 + d * d * self.n * other.n / n
+        self.n = n
+        self.lo = min(self.lo, other.lo)
+        self.hi = max(self.hi, other.hi)
+
+    def copy(self):
+        return RunningStats(self.n, self.mean, self.m2, self.lo, self.hi)
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.n) if self.n else 0.0
+
+
+class CustomerMetrics:
+    __slots__ = ('tr', 'bal', 'total', 'num_day', 'num_week', 'cashback', 'resp')
+
+    def __init__(self):
+        self.tr = RunningStats()
+        self.bal = RunningStats()
+        self.total = 0.0
+        self.num_day = 0
+        self.num_week = 0
+        self.cashback = 0.0
+        self.resp = 1.0
+
+    def copy(self):
+        out = CustomerMetrics()
+        out.tr = self.tr.copy()
+        out.bal = self.bal.copy()
+        out.total = self.total
+        out.num_day = self.num_day
+        out.num_week = self.num_week
+        out.cashback = self.cashback
+        out.resp = self.resp
+        return out
+
+    # Fold a delta (payments since the last flush) in. Also combines two deltas, whose counters
+    # and resp are derived from tr.n when they finally reach a state.
+    def merge(self, delta):
+        self.tr.merge(delta.tr)
+        self.bal.merge(delta.bal)
+        self.total += delta.total
+        self.num_day += delta.tr.n
+        self.num_week += delta.tr.n
+        self.cashback += delta.cashback
+        self.resp = min(1.0, self.resp + RESP_STEP * delta.tr.n)
+
+
+# Write-behind aggregator for cust_core, freqvol and cust_incentives.
+# Payments only enqueue (cust_id, amount, b_new); a single consumer task folds them into per-customer
+# running state and flushes dirty customers with one batched upsert per table.
+class MetricsAggregator:
+    def __init__(self, dp, bonus_rate, target_velocity, queue_size=QUEUE_SIZE, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.dp = dp
+        self.bonus_rate = bonus_rate
+        self.target_velocity = target_velocity
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+        self._state = {}      # cust_id -> CustomerMetrics, as last written
+        self._pending = {}    # cust_id -> CustomerMetrics delta since last flush
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._last_flush = time.monotonic()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    # Producers wait here when the queue is full (backpressure)
+    async def record(self, cust_id, amount, b_new):
+        await self.queue.put((cust_id, float(amount), float(b_new)))
+
+    async def record_many(self, items):
+        for cust_id, amount, b_new in items:
+            await self.queue.put((cust_id, float(amount), float(b_new)))
+
+    def _apply(self, cust_id, amount, b_new):
+        delta = self._pending.get(cust_id)
+        if delta is None:
+            delta = self._pending[cust_id] = CustomerMetrics()
+        delta.tr.add(amount)
+        delta.bal.add(b_new)
+        delta.total += amount
+        delta.cashback += amount * self.bonus_rate
+
+    async def _run(self):
+        while True:
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout=self.flush_interval)
+                self._apply(*item)
+                self.queue.task_done()
+                # drain what is already queued without yielding
+                while not self.queue.empty() and len(self._pending) < self.flush_size:
+                    self._apply(*self.queue.get_nowait())
+                    self.queue.task_done()
+            except asyncio.TimeoutError:
+                pass
+
+            if len(self._pending) >= self.flush_size or time.monotonic() - self._last_flush >= self.flush_interval:
+                try:
+                    await self._flush_pending()
+                except Exception as e:
+                    logger.error(f"Error flushing metrics: {e}")
+
+    # Wait for everything queued so far, then write it out
+    async def flush(self):
+        await self.queue.join()
+        await self._flush_pending()
+
+    # Day boundary: customers without a payment today get one more inactive day, active ones reset
+    # to 0, then daily counts restart. `at` is the boundary time, for hooks that pass it.
+    async def close_day(self, at=None):
+        await self.flush()
+        async with self._lock:
+            async with self.dp.acquire('metrics_close_day') as conn:
+                async with conn.transaction():
+                    await conn.execute('''
+                    UPDATE cust_core c SET
+                        inactive_days = CASE WHEN f.num_tr_day > 0 THEN 0 ELSE c.inactive_days + 1 END,
+                        updated_at = NOW()
+                    FROM freqvol f
+                    WHERE f.cust_id = c.cust_id
+                    ''')
+                    await conn.execute('UPDATE freqvol SET num_tr_day = 0 WHERE num_tr_day <> 0')
+            for state in self._state.values():
+                state.num_day = 0
+
+    # Week boundary: weekly counts restart
+    async def close_week(self, at=None):
+        await self.flush()
+        async with self._lock:
+            async with self.dp.acquire('metrics_close_week') as conn:
+                await conn.execute('UPDATE freqvol SET num_tr_week = 0 WHERE num_tr_week <> 0')
+            for state in self._state.values():
+                state.num_week = 0
+
+    # Drop cached state after the metrics tables were changed behind our back (truncate, backfill)
+    async def reset(self):
+        await self.queue.join()
+        async with self._lock:
+            self._pending.clear()
+            self._state.clear()
+
+    async def close(self):
+        if self._task is not None:
+            await self.flush()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _flush_pending(self):
+        async with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            # new states are built on copies and only replace _state once written, so a failed
+            # flush leaves _state as committed and the deltas can simply be retried
+            try:
+                async with self.dp.acquire('metrics_flush') as conn:
+                    loaded = await self._load_state(conn, [c for c in pending if c not in self._state])
+                    states = {}
+                    for cust_id, delta in pending.items():
+                        state = loaded.get(cust_id) or self._state[cust_id].copy()
+                        state.merge(delta)
+                        states[cust_id] = state
+                    await self._write(conn, states)
+            except Exception:
+                # put the deltas back, ahead of anything recorded meanwhile
+                for cust_id, later in self._pending.items():
+                    if cust_id in pending:
+                        pending[cust_id].merge(later)
+                    else:
+                        pending[cust_id] = later
+                self._pending = pending
+                raise
+            self._state.update(states)
+            logger.info(f"Metrics flushed for {len(pending)} customers", extra={'sample': 'metrics_flush'})
+
+    # Running state for customers this process hasn't written yet, in one query (fresh state for
+    # customers without metrics rows). Returned, not stored: the caller keeps it once written.
+    async def _load_state(self, conn, cust_ids):
+        if not cust_ids:
+            return {}
+        rows = await conn.fetch('''
+        SELECT f.cust_id, f.num_tr_day, f.num_tr_week, f.avg_tr_val, f.total_tr_val, f.tr_std,
+               c.avg_daily_bal, c.max_bal, c.min_bal, c.bal_std, i.cashback_earned, i.incentive_resp
+        FROM freqvol f
+        LEFT JOIN cust_core c ON c.cust_id=f.cust_id
+        LEFT JOIN cust_incentives i ON i.cust_id=f.cust_id
+        WHERE f.cust_id = ANY($1::text[])
+        ''', cust_ids)
+        loaded = {cust_id: CustomerMetrics() for cust_id in cust_ids}
+        for r in rows:
+            state = loaded[r['cust_id']]
+            total = float(r['total_tr_val'] or 0)
+            avg = float(r['avg_tr_val'] or 0)
+            # the tables keep no lifetime count, but total/avg recovers it
+            n = round(total / avg) if avg else 0
+            tr_std = float(r['tr_std'] or 0)
+            state.tr = RunningStats(n, avg, tr_std * tr_std * n)
+            state.total = total
+            if r['avg_daily_bal'] is not None:
+                bal_std = float(r['bal_std'] or 0)
+                state.bal = RunningStats(n, float(r['avg_daily_bal']), bal_std * bal_std * n, float(r['min_bal']), float(r['max_bal']))
+            state.num_day = r['num_tr_day'] or 0
+            state.num_week = r['num_tr_week'] or 0
+            state.cashback = float(r['cashback_earned'] or 0)
+            state.resp = float(r['incentive_resp']) if r['incentive_resp'] is not None else 1.0
+        return loaded
+
+    # states: cust_id -> CustomerMetrics to persist
+    async def _write(self, conn, states):
+        cust_ids = list(states)
+        states = list(states.values())
+        async with conn.transaction():
+            await conn.execute('''
+            INSERT INTO cust_core(cust_id, avg_daily_bal, max_bal, min_bal, bal_std)
+            SELECT * FROM unnest($1::text[], $2::float8[], $3::float8[], $4::float8[], $5::float8[])
+            ON CONFLICT(cust_id) DO UPDATE SET
+                avg_daily_bal=EXCLUDED.avg_daily_bal,
+                max_bal=EXCLUDED.max_bal,
+                min_bal=EXCLUDED.min_bal,
+                bal_std=EXCLUDED.bal_std,
+                updated_at=NOW()
+            ''', cust_ids, [s.bal.mean for s in states], [s.bal.hi for s in states], [s.bal.lo for s in states], [s.bal.std for s in states])
+
+            await conn.execute('''
+            INSERT INTO freqvol(cust_id, num_tr_day, num_tr_week, avg_tr_val, total_tr_val, tr_std, velocity)
+            SELECT * FROM unnest($1::text[], $2::int[], $3::int[], $4::float8[], $5::float8[], $6::float8[], $7::float8[])
+            ON CONFLICT(cust_id) DO UPDATE SET
+                num_tr_day=EXCLUDED.num_tr_day,
+                num_tr_week=EXCLUDED.num_tr_week,
+                avg_tr_val=EXCLUDED.avg_tr_val,
+                total_tr_val=EXCLUDED.total_tr_val,
+                tr_std=EXCLUDED.tr_std,
+                velocity=EXCLUDED.velocity,
+                updated_at=NOW()
+            ''', cust_ids, [s.num_day for s in states], [s.num_week for s in states], [s.tr.mean for s in states],
+            [s.total for s in states], [s.tr.std for s in states], [s.total / self.target_velocity for s in states])
+
+            # decay_loss_cnt is owned by the incentive cycle, never overwritten here
+            await conn.execute('''
+            INSERT INTO cust_incentives(cust_id, cashback_earned, incentive_resp)
+            SELECT * FROM unnest($1::text[], $2::float8[], $3::float8[])
+            ON CONFLICT(cust_id) DO UPDATE SET
+                cashback_earned=EXCLUDED.cashback_earned,
+                incentive_resp=EXCLUDED.incentive_resp,
+                updated_at=NOW()
+            ''', cust_ids, [s.cashback for s in states], [s.resp for s in states])
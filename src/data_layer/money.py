@@ -0,0 +1,51 @@
+import math
+from decimal import ROUND_HALF_UP, Decimal
+
+
+# Minor units: money stored as integer 1/10000ths, the same precision as NUMERIC(20,4)
+SCALE = 10000
+DIGITS = 4
+MINOR_SQL = 'BIGINT'
+DECIMAL_SQL = 'NUMERIC(20,4)'
+
+_QUANTUM = Decimal(1).scaleb(-DIGITS)
+NOISE_DIGITS = 6
+
+
+# float, int, str or Decimal amount -> int minor units, rounded half away from zero like NUMERIC
+def to_minor(value):
+    if isinstance(value, int):
+        return value * SCALE
+    if isinstance(value, float):
+        # exact for anything with at most 4 decimals below ~9e11, without going through Decimal.
+        # The scaled value is rounded to NOISE_DIGITS first to drop binary representation error
+        # (0.00015 * SCALE == 1.4999999999999998), so a float rounds like the decimal it prints as.
+        minor = math.floor(round(abs(value) * SCALE, NOISE_DIGITS) + 0.5)
+        return -minor if value < 0 else minor
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return int(value.quantize(_QUANTUM, rounding=ROUND_HALF_UP).scaleb(DIGITS))
+
+
+# int minor units -> exact Decimal amount
+def from_minor(value):
+    if value is None:
+        return None
+    return Decimal(value).scaleb(-DIGITS)
+
+
+# Vectorized variants for NumPy columns (generators, backfill, checkpoints)
+def to_minor_array(values):
+    import numpy as np
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu':
+        return values.astype(np.int64) * SCALE
+    values = values.astype(np.float64)
+    # same rounding as to_minor's float path (np.rint would round half to even)
+    minor = np.floor(np.round(np.abs(values) * SCALE, NOISE_DIGITS) + 0.5)
+    return np.copysign(minor, values).astype(np.int64)
+
+
+def from_minor_array(values):
+    import numpy as np
+    return np.asarray(values, dtype=np.int64) / SCALE
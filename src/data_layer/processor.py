@@ -2,127 +2,590 @@ import os
 import logging
 import asyncio
 import uuid
-from datetime import datetime
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from decimal import Decimal
 
 from dotenv import load_dotenv
 
 import asyncpg
 
+from src.data_layer.cache import CACHE_SIZE, BalanceCache
+from src.data_layer.instrumentation import Stats
+from src.data_layer.metrics import MetricsAggregator
+from src.data_layer.money import DECIMAL_SQL, MINOR_SQL, SCALE, from_minor, to_minor
 
-# Logging
+# Logging (configured by src/logging_setup.py; per-entity messages carry a 'sample' key so they can be rate-limited)
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
 
 # Constants
 BONUS_RATE = 0.03
 DECAY_RATE = 0.02
 TARGET_VELOCITY = 0.5
+BATCH_SIZE = 1000
+BULK_CHUNK_SIZE = 10000
+
+HISTORY_FETCH_SIZE = 1000
+PARTITION_MONTHS_AHEAD = 3
+PARTITION_CHECK_INTERVAL = 3600.0   # seconds between checks that the partitions still reach PARTITION_MONTHS_AHEAD
+SCHEMA_VERSION = 4
+SCHEMA_LOCK_ID = 827361   # advisory lock serializing migrations across processes
+# Every table the schema creates, for TRUNCATE-based resets
+TABLES = ['history', 'cust_daily', 'merch_daily', 'merch_daily_pending', 'cust_core', 'freqvol', 'cust_incentives', 'merchant_ledger',
+          'tx_flags', 'customers', 'merchants']
+VIEWS = ['mv_category_daily', 'mv_merchant_totals', 'mv_daily_rejections']   # dashboard aggregates
+CONSOLIDATE_INTERVAL = 1.0
+# Session setting that sends history_rollup()'s merchant rows to merch_daily_pending (set on deferred pools)
+DEFER_ROLLUP_SETTING = 'dc.defer_merchant_rollup'
+
+PAYMENT_QUERY = 'SELECT status, b_old, b_new FROM process_payment($1, $2, $3, $4, $5, $6)'
+HISTORY_SELECT = '''
+SELECT h.history_id, h.customer_id, c.name_full, h.merchant_id, m.category, h.amount, h.time, h.is_rejected, h.b_old, h.b_new
+FROM history h
+LEFT JOIN customers c ON c.customer_id=h.customer_id
+LEFT JOIN merchants m ON m.merchant_id=h.merchant_id
+'''
+HISTORY_MONEY = ['amount', 'b_old', 'b_new']
+
+
+def _to_decimal(value):
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+
+def _add_months(dt, n):
+    y, m = divmod(dt.month - 1 + n, 12)
+    return dt.replace(year=dt.year + y, month=m + 1)
+
+
+# Naive datetimes (the generators produce them) are taken as UTC
+def as_utc(dt):
+    if dt is None or dt.tzinfo is not None:
+        return dt
+    return dt.replace(tzinfo=timezone.utc)
+
+
+# UUIDv7: 48-bit unix milliseconds followed by random bits, so ids sort by creation time
+def new_tr_id():
+    value = (time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), 'big')
+    value = value & ~(0xF << 76) | 0x7 << 76   # version 7
+    value = value & ~(0x3 << 62) | 0x2 << 62   # RFC 4122 variant
+    return uuid.UUID(int=value)
 
 
 class DataProcessor:
-    def __init__(self):
+    # partition_history: create history range-partitioned by month (default from DB_PARTITION_HISTORY)
+    # defer_merchant_credit: payments append to merchant_ledger instead of updating merchants.acc_balance (and their
+    #   merch_daily rollups to merch_daily_pending), and a background task folds both in every consolidate_interval
+    #   seconds (default from DB_DEFER_MERCHANT_CREDIT)
+    # money_minor: store money as BIGINT minor units (1/SCALE) instead of NUMERIC(20,4), default from DB_MONEY_MINOR.
+    #   Callers still pass floats/Decimals; balance_query/merchant_balance and the history readers return
+    #   Decimal either way. The metric tables (cust_core, freqvol,
+    #   cust_incentives) stay NUMERIC in both modes: they hold averages, deviations and velocities that
+    #   MetricsAggregator computes in float, not ledger amounts that have to sum exactly
+    # balance_cache_size: customer balances kept in the read-through cache behind balance_query()
+    # stats_sample_rate: fraction of operations timed by the built-in instrumentation (self.stats)
+    def __init__(self, min_size=1, max_size=10, dsn=None, partition_history=None, defer_merchant_credit=None,
+                 consolidate_interval=CONSOLIDATE_INTERVAL, money_minor=None, balance_cache_size=CACHE_SIZE,
+                 stats_sample_rate=1.0):
 
         load_dotenv()
 
-        self.db_url = f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@{os.getenv('DB_HOST','localhost')}:{os.getenv('DB_PORT','5432')}/{os.getenv('DB_NAME')}"
+        self.db_url = dsn or f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@{os.getenv('DB_HOST','localhost')}:{os.getenv('DB_PORT','5432')}/{os.getenv('DB_NAME')}"
+        self.min_size = min_size
+        self.max_size = max_size
+        if partition_history is None:
+            partition_history = os.getenv('DB_PARTITION_HISTORY', '0').lower() in ('1', 'true', 'yes')
+        self.partition_history = partition_history
+        self._partition_months = set()   # first days of the history partitions this process created
+        self._partition_lock = asyncio.Lock()
+        self._partitioner = None
+        if defer_merchant_credit is None:
+            defer_merchant_credit = os.getenv('DB_DEFER_MERCHANT_CREDIT', '0').lower() in ('1', 'true', 'yes')
+        self.defer_merchant_credit = defer_merchant_credit
+        self.consolidate_interval = consolidate_interval
+        self._consolidator = None
+        if money_minor is None:
+            money_minor = os.getenv('DB_MONEY_MINOR', '0').lower() in ('1', 'true', 'yes')
+        self._set_money_mode(money_minor)
         self.pool = None
+        self.metrics = None
+        self.scorer = None   # optional AnomalyScorer (src/anomaly.py), fed every recorded payment
+        self.balances = BalanceCache(max_size=balance_cache_size)
+        self.stats = Stats(sample_rate=stats_sample_rate)
+        # history rows this process has committed, plus one per wholesale change (reset, incentive cycle);
+        # readers caching derived results (src/data_layer/aggregates.py) compare against it
+        self.watermark = 0
+        # bumped whenever the tables are replaced wholesale (clear_db, template reset, checkpoint restore)
+        self.resets = 0
 
+    # Calling init() again on an initialized processor does nothing, so shared instances can be passed around.
     async def init(self):
+        if self.pool is not None:
+            return
         try:
-            self.pool = await asyncpg.create_pool(dsn=self.db_url, min_size=1, max_size=10)
+            self.pool = await self._create_pool()
             await self._init_db()
+            self.metrics = MetricsAggregator(self, bonus_rate=BONUS_RATE, target_velocity=TARGET_VELOCITY)
+            self.metrics.start()
+            # lambdas, so the gauges follow the pool when reset_from_template() replaces it
+            self.stats.gauge('pool_size', lambda: self.pool.get_size())
+            self.stats.gauge('pool_idle', lambda: self.pool.get_idle_size())
+            self.stats.gauge('pool_in_use', lambda: self.pool.get_size() - self.pool.get_idle_size())
+            self.stats.gauge('pool_max', lambda: self.pool.get_max_size())
+            self.stats.gauge('metrics_queue_depth', self.metrics.queue.qsize)
+            self.stats.gauge('metrics_pending_customers', lambda: len(self.metrics._pending))
+            self.stats.gauge('balance_cache_size', lambda: len(self.balances))
+            self.stats.gauge('balance_cache_hits', lambda: self.balances.hits)
+            self.stats.gauge('balance_cache_misses', lambda: self.balances.misses)
+            if self.defer_merchant_credit:
+                self._consolidator = asyncio.create_task(self._consolidate_loop())
+            if self.partition_history:
+                self._partitioner = asyncio.create_task(self._partition_loop())
         except Exception as e:
             logger.error(f"Failed to initialize DB pool: {e}")
             raise
 
+    # Deferred credit mode defers the merch_daily rollup too (see history_rollup()), through a setting
+    # every connection of the pool carries
+    async def _create_pool(self):
+        settings = {DEFER_ROLLUP_SETTING: 'on'} if self.defer_merchant_credit else None
+        return await asyncpg.create_pool(dsn=self.db_url, min_size=self.min_size, max_size=self.max_size,
+                                         server_settings=settings)
+
+    # to_db/from_db convert at the API boundary: caller amount -> stored value -> Decimal
+    def _set_money_mode(self, minor):
+        self.money_minor = minor
+        self.money_sql = MINOR_SQL if minor else DECIMAL_SQL
+        self.to_db = to_minor if minor else _to_decimal
+        self.from_db = from_minor if minor else (lambda value: value)
+
+    # Pool acquire with instrumentation: records acquire wait, time holding the connection and the
+    # total under "<op>.acquire", "<op>.query" and "<op>" for sampled calls
+    @asynccontextmanager
+    async def acquire(self, op):
+        if not self.stats.sampled():
+            async with self.pool.acquire() as conn:
+                yield conn
+            return
+        t0 = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            t1 = time.perf_counter()
+            try:
+                yield conn
+            finally:
+                t2 = time.perf_counter()
+                self.stats.observe(f'{op}.acquire', t1 - t0)
+                self.stats.observe(f'{op}.query', t2 - t1)
+                self.stats.observe(op, t2 - t0)
+
     # Initialize Database
+    # A current schema costs one single-row read of schema_version; the DDL in _migrate only runs when
+    # the recorded version differs from SCHEMA_VERSION. Bump SCHEMA_VERSION whenever that DDL changes.
     async def _init_db(self):
         async with self.pool.acquire() as conn:
+            if await self._schema_current(conn):
+                # partitions roll forward with the calendar, not with the schema version
+                if self.partition_history:
+                    await self.ensure_history_partitions(conn=conn)
+                return
+            # one process migrates at a time; the others wait, then find the schema current
+            await conn.execute('SELECT pg_advisory_lock($1)', SCHEMA_LOCK_ID)
             try:
-                await conn.execute('CREATE EXTENSION IF NOT EXISTS "pgcrypto";')
+                if not await self._schema_current(conn):
+                    await self._migrate(conn)
+            finally:
+                await conn.execute('SELECT pg_advisory_unlock($1)', SCHEMA_LOCK_ID)
 
-                # Core tables
-                await conn.execute('''
-                CREATE TABLE IF NOT EXISTS customers (
-                    customer_id TEXT PRIMARY KEY,
-                    age INT CHECK(age >= 0) DEFAULT 18,
-                    name_full TEXT NOT NULL,
-                    profession TEXT DEFAULT 'Unknown',
-                    salary NUMERIC(20,4) DEFAULT 0.0,
-                    level INT CHECK(level > 0) DEFAULT 1,
-                    acc_balance NUMERIC(20,4) DEFAULT 0.0,
-                    description TEXT DEFAULT '',
-                    industry TEXT DEFAULT 'General',
-                    behavior TEXT DEFAULT 'Conservative',
-                    created_at TIMESTAMPTZ DEFAULT NOW(),
-                    updated_at TIMESTAMPTZ DEFAULT NOW()
-                );''')
+    # The recorded layout wins over the requested one, as in _migrate
+    async def _schema_current(self, conn):
+        try:
+            row = await conn.fetchrow('SELECT version, partitioned, money_minor FROM schema_version')
+        except asyncpg.UndefinedTableError:
+            return False
+        if row is None or row['version'] != SCHEMA_VERSION:
+            return False
+        if row['partitioned'] != self.partition_history:
+            logger.warning(f"history already exists with partitioned={row['partitioned']}, requested {self.partition_history}; "
+                           f"keeping the existing layout")
+            self.partition_history = row['partitioned']
+        if row['money_minor'] != self.money_minor:
+            logger.warning(f"customers already exists with money_minor={row['money_minor']}, requested {self.money_minor}; "
+                           f"keeping the existing representation")
+            self._set_money_mode(row['money_minor'])
+        return True
 
-                await conn.execute('''
-                CREATE TABLE IF NOT EXISTS merchants (
-                    merchant_id TEXT PRIMARY KEY,
-                    category TEXT DEFAULT 'General',
-                    description TEXT DEFAULT '',
-                    acc_balance NUMERIC(20,4) DEFAULT 0.0,
-                    created_at TIMESTAMPTZ DEFAULT NOW(),
-                    updated_at TIMESTAMPTZ DEFAULT NOW()
-                );''')
+    async def _migrate(self, conn):
+        try:
+            await conn.execute('CREATE EXTENSION IF NOT EXISTS "pgcrypto";')
 
-                await conn.execute('''
+            # Core tables
+            money = self.money_sql
+            await conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS customers (
+                customer_id TEXT PRIMARY KEY,
+                age INT CHECK(age >= 0) DEFAULT 18,
+                name_full TEXT NOT NULL,
+                profession TEXT DEFAULT 'Unknown',
+                salary {money} DEFAULT 0,
+                level INT CHECK(level > 0) DEFAULT 1,
+                acc_balance {money} DEFAULT 0,
+                description TEXT DEFAULT '',
+                industry TEXT DEFAULT 'General',
+                behavior TEXT DEFAULT 'Conservative',
+                created_at TIMESTAMPTZ DEFAULT NOW(),
+                updated_at TIMESTAMPTZ DEFAULT NOW()
+            );''')
+
+            # an existing schema decides the money representation, like the history layout below
+            minor = await conn.fetchval('''
+            SELECT data_type = 'bigint' FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'customers' AND column_name = 'acc_balance'
+            ''')
+            if minor != self.money_minor:
+                logger.warning(f"customers already exists with money_minor={minor}, requested {self.money_minor}; "
+                               f"keeping the existing representation")
+                self._set_money_mode(minor)
+                money = self.money_sql
+
+            await conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS merchants (
+                merchant_id TEXT PRIMARY KEY,
+                category TEXT DEFAULT 'General',
+                description TEXT DEFAULT '',
+                acc_balance {money} DEFAULT 0,
+                created_at TIMESTAMPTZ DEFAULT NOW(),
+                updated_at TIMESTAMPTZ DEFAULT NOW()
+            );''')
+
+            # Time-ordered UUIDv7 keys: inserts append to the right edge of the index instead of scattering
+            await conn.execute('''
+            CREATE OR REPLACE FUNCTION uuid_v7() RETURNS UUID AS $$
+                SELECT encode(set_bit(set_bit(overlay(uuid_send(gen_random_uuid())
+                    PLACING substring(int8send(floor(extract(epoch FROM clock_timestamp()) * 1000)::BIGINT) FROM 3)
+                    FROM 1 FOR 6), 52, 1), 53, 1), 'hex')::UUID;
+            $$ LANGUAGE sql VOLATILE;''')
+
+            if self.partition_history:
+                # Monthly range partitions on time; the default partition catches anything not covered yet
+                await conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS history (
+                    history_id UUID NOT NULL DEFAULT uuid_v7(),
+                    customer_id TEXT REFERENCES customers(customer_id),
+                    merchant_id TEXT REFERENCES merchants(merchant_id),
+                    amount {money} DEFAULT 0,
+                    time TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    is_rejected BOOLEAN DEFAULT FALSE,
+                    b_old {money} DEFAULT 0,
+                    b_new {money} DEFAULT 0,
+                    PRIMARY KEY (history_id, time)
+                ) PARTITION BY RANGE (time);''')
+                await conn.execute('CREATE TABLE IF NOT EXISTS history_default PARTITION OF history DEFAULT;')
+                await conn.execute('CREATE INDEX IF NOT EXISTS history_time_brin ON history USING BRIN(time);')
+            else:
+                await conn.execute(f'''
                 CREATE TABLE IF NOT EXISTS history (
-                    history_id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+                    history_id UUID PRIMARY KEY DEFAULT uuid_v7(),
                     customer_id TEXT REFERENCES customers(customer_id),
                     merchant_id TEXT REFERENCES merchants(merchant_id),
-                    amount NUMERIC(20,4) DEFAULT 0.0,
+                    amount {money} DEFAULT 0,
                     time TIMESTAMPTZ DEFAULT NOW(),
                     is_rejected BOOLEAN DEFAULT FALSE,
-                    b_old NUMERIC(20,4) DEFAULT 0.0,
-                    b_new NUMERIC(20,4) DEFAULT 0.0
+                    b_old {money} DEFAULT 0,
+                    b_new {money} DEFAULT 0
                 );''')
+                await conn.execute('CREATE INDEX IF NOT EXISTS history_time_idx ON history(time);')
 
-                # Metrics tables
-                await conn.execute('''
-                CREATE TABLE IF NOT EXISTS cust_core (
-                    cust_id TEXT PRIMARY KEY REFERENCES customers(customer_id),
-                    avg_daily_bal NUMERIC(20,4) DEFAULT 0.0,
-                    max_bal NUMERIC(20,4) DEFAULT 0.0,
-                    min_bal NUMERIC(20,4) DEFAULT 0.0,
-                    bal_std NUMERIC(20,4) DEFAULT 0.0,
-                    inactive_days INT DEFAULT 0,
-                    updated_at TIMESTAMPTZ DEFAULT NOW()
-                );''')
+            partitioned = await conn.fetchval("SELECT relkind = 'p' FROM pg_class WHERE oid = 'history'::regclass")
+            if partitioned != self.partition_history:
+                logger.warning(f"history already exists with partitioned={partitioned}, requested {self.partition_history}; "
+                               f"keeping the existing layout")
+                self.partition_history = partitioned
 
-                await conn.execute('''
-                CREATE TABLE IF NOT EXISTS freqvol (
-                    cust_id TEXT PRIMARY KEY REFERENCES customers(customer_id),
-                    num_tr_day INT DEFAULT 0,
-                    num_tr_week INT DEFAULT 0,
-                    avg_tr_val NUMERIC(20,4) DEFAULT 0.0,
-                    total_tr_val NUMERIC(20,4) DEFAULT 0.0,
-                    tr_std NUMERIC(20,4) DEFAULT 0.0,
-                    velocity NUMERIC(20,4) DEFAULT 0.0,
-                    updated_at TIMESTAMPTZ DEFAULT NOW()
-                );''')
+            await conn.execute('CREATE INDEX IF NOT EXISTS history_customer_time_idx ON history(customer_id, time);')
+            await conn.execute('CREATE INDEX IF NOT EXISTS history_merchant_time_idx ON history(merchant_id, time);')
 
-                await conn.execute('''
-                CREATE TABLE IF NOT EXISTS cust_incentives (
-                    cust_id TEXT PRIMARY KEY REFERENCES customers(customer_id),
-                    cashback_earned NUMERIC(20,4) DEFAULT 0.0,
-                    decay_loss_cnt INT DEFAULT 0,
-                    incentive_resp NUMERIC(5,4) DEFAULT 1.0,
-                    updated_at TIMESTAMPTZ DEFAULT NOW()
-                );''')
+            # Daily rollups, maintained per insert statement from the transition table,
+            # so analytics can read them instead of scanning raw history
+            await conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS cust_daily (
+                customer_id TEXT REFERENCES customers(customer_id),
+                day DATE,
+                tx_count INT DEFAULT 0,
+                rejected_count INT DEFAULT 0,
+                total_amount {money} DEFAULT 0,
+                PRIMARY KEY (customer_id, day)
+            );''')
 
-                logger.info("Database tables initialized successfully.")
+            await conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS merch_daily (
+                merchant_id TEXT REFERENCES merchants(merchant_id),
+                day DATE,
+                tx_count INT DEFAULT 0,
+                total_amount {money} DEFAULT 0,
+                PRIMARY KEY (merchant_id, day)
+            );''')
+
+            # Deferred merchant rollups: append-only like merchant_ledger, folded into merch_daily by
+            # consolidate_merchant_credits(), so deferred payments never wait on a hot merch_daily row either
+            await conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS merch_daily_pending (
+                merchant_id TEXT,
+                day DATE,
+                tx_count INT DEFAULT 0,
+                total_amount {money} DEFAULT 0
+            );''')
+
+            # ORDER BY keeps the upsert lock order fixed, so concurrent inserts can't deadlock on rollup rows
+            await conn.execute(f'''
+            CREATE OR REPLACE FUNCTION history_rollup() RETURNS TRIGGER AS $$
+            BEGIN
+                INSERT INTO cust_daily(customer_id, day, tx_count, rejected_count, total_amount)
+                SELECT customer_id, time::DATE,
+                       COUNT(*) FILTER (WHERE NOT is_rejected),
+                       COUNT(*) FILTER (WHERE is_rejected),
+                       COALESCE(SUM(amount) FILTER (WHERE NOT is_rejected), 0)
+                FROM new_rows
+                WHERE customer_id IS NOT NULL AND merchant_id IS NOT NULL
+                GROUP BY 1, 2
+                ORDER BY 1, 2
+                ON CONFLICT(customer_id, day) DO UPDATE SET
+                    tx_count = cust_daily.tx_count + EXCLUDED.tx_count,
+                    rejected_count = cust_daily.rejected_count + EXCLUDED.rejected_count,
+                    total_amount = cust_daily.total_amount + EXCLUDED.total_amount;
+
+                IF current_setting('{DEFER_ROLLUP_SETTING}', true) = 'on' THEN
+                    INSERT INTO merch_daily_pending(merchant_id, day, tx_count, total_amount)
+                    SELECT merchant_id, time::DATE, COUNT(*), SUM(amount)
+                    FROM new_rows
+                    WHERE merchant_id IS NOT NULL AND NOT is_rejected
+                    GROUP BY 1, 2;
+                ELSE
+                    INSERT INTO merch_daily(merchant_id, day, tx_count, total_amount)
+                    SELECT merchant_id, time::DATE, COUNT(*), SUM(amount)
+                    FROM new_rows
+                    WHERE merchant_id IS NOT NULL AND NOT is_rejected
+                    GROUP BY 1, 2
+                    ORDER BY 1, 2
+                    ON CONFLICT(merchant_id, day) DO UPDATE SET
+                        tx_count = merch_daily.tx_count + EXCLUDED.tx_count,
+                        total_amount = merch_daily.total_amount + EXCLUDED.total_amount;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;''')
+
+            await conn.execute('''
+            DROP TRIGGER IF EXISTS history_rollup_trg ON history;
+            CREATE TRIGGER history_rollup_trg AFTER INSERT ON history
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION history_rollup();''')
+
+            # Metrics tables: derived statistics, NUMERIC whatever money_minor says
+            await conn.execute('''
+            CREATE TABLE IF NOT EXISTS cust_core (
+                cust_id TEXT PRIMARY KEY REFERENCES customers(customer_id),
+                avg_daily_bal NUMERIC(20,4) DEFAULT 0.0,
+                max_bal NUMERIC(20,4) DEFAULT 0.0,
+                min_bal NUMERIC(20,4) DEFAULT 0.0,
+                bal_std NUMERIC(20,4) DEFAULT 0.0,
+                inactive_days INT DEFAULT 0,
+                updated_at TIMESTAMPTZ DEFAULT NOW()
+            );''')
+
+            await conn.execute('''
+            CREATE TABLE IF NOT EXISTS freqvol (
+                cust_id TEXT PRIMARY KEY REFERENCES customers(customer_id),
+                num_tr_day INT DEFAULT 0,
+                num_tr_week INT DEFAULT 0,
+                avg_tr_val NUMERIC(20,4) DEFAULT 0.0,
+                total_tr_val NUMERIC(20,4) DEFAULT 0.0,
+                tr_std NUMERIC(20,4) DEFAULT 0.0,
+                velocity NUMERIC(20,4) DEFAULT 0.0,
+                updated_at TIMESTAMPTZ DEFAULT NOW()
+            );''')
+
+            await conn.execute('''
+            CREATE TABLE IF NOT EXISTS cust_incentives (
+                cust_id TEXT PRIMARY KEY REFERENCES customers(customer_id),
+                cashback_earned NUMERIC(20,4) DEFAULT 0.0,
+                decay_loss_cnt INT DEFAULT 0,
+                incentive_resp NUMERIC(5,4) DEFAULT 1.0,
+                updated_at TIMESTAMPTZ DEFAULT NOW()
+            );''')
+
+            # Deferred merchant credits: append-only, so payments never wait on a hot merchant row
+            await conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS merchant_ledger (
+                merchant_id TEXT REFERENCES merchants(merchant_id),
+                amount {money} DEFAULT 0,
+                created_at TIMESTAMPTZ DEFAULT NOW()
+            );''')
+            await conn.execute('CREATE INDEX IF NOT EXISTS merchant_ledger_merchant_idx ON merchant_ledger(merchant_id);')
+
+            # Anomaly flags written by the scoring stage (src/anomaly.py)
+            await conn.execute('''
+            CREATE TABLE IF NOT EXISTS tx_flags (
+                history_id UUID,
+                customer_id TEXT,
+                merchant_id TEXT,
+                tx_time TIMESTAMPTZ,
+                score FLOAT8,
+                flagged_at TIMESTAMPTZ DEFAULT NOW()
+            );''')
+            await conn.execute('CREATE INDEX IF NOT EXISTS tx_flags_tx_time_idx ON tx_flags(tx_time);')
+
+            # Dashboard aggregates over the daily rollups (src/data_layer/aggregates.py refreshes them).
+            # Each has a unique index so it can be refreshed CONCURRENTLY, without blocking readers.
+            await conn.execute('''
+            CREATE MATERIALIZED VIEW IF NOT EXISTS mv_category_daily AS
+            SELECT COALESCE(m.category, 'General') AS category, d.day,
+                   SUM(d.tx_count)::BIGINT AS tx_count, SUM(d.total_amount) AS total_amount
+            FROM merch_daily d
+            JOIN merchants m ON m.merchant_id = d.merchant_id
+            GROUP BY 1, 2;''')
+            await conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS mv_category_daily_key ON mv_category_daily(category, day);')
+            await conn.execute('''
+            CREATE MATERIALIZED VIEW IF NOT EXISTS mv_merchant_totals AS
+            SELECT d.merchant_id, COALESCE(m.category, 'General') AS category,
+                   SUM(d.tx_count)::BIGINT AS tx_count, SUM(d.total_amount) AS total_amount, MAX(d.day) AS last_day
+            FROM merch_daily d
+            JOIN merchants m ON m.merchant_id = d.merchant_id
+            GROUP BY d.merchant_id, m.category;''')
+            await conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS mv_merchant_totals_key ON mv_merchant_totals(merchant_id);')
+            await conn.execute('CREATE INDEX IF NOT EXISTS mv_merchant_totals_total_idx ON mv_merchant_totals(total_amount DESC);')
+            await conn.execute('''
+            CREATE MATERIALIZED VIEW IF NOT EXISTS mv_daily_rejections AS
+            SELECT day, SUM(tx_count)::BIGINT AS accepted, SUM(rejected_count)::BIGINT AS rejected
+            FROM cust_daily
+            GROUP BY day;''')
+            await conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS mv_daily_rejections_key ON mv_daily_rejections(day);')
+
+            # Payment function: balance check, debit, credit and history insert in one round trip.
+            # p_time stamps history (simulated time); NULL means NOW(). Older signatures, and the one for
+            # the other money representation, are dropped so calls can't become ambiguous between overloads.
+            other = 'NUMERIC' if self.money_minor else 'BIGINT'
+            await conn.execute('DROP FUNCTION IF EXISTS process_payment(TEXT, TEXT, NUMERIC, UUID);')
+            await conn.execute('DROP FUNCTION IF EXISTS process_payment(TEXT, TEXT, NUMERIC, UUID, TIMESTAMPTZ);')
+            await conn.execute(f'DROP FUNCTION IF EXISTS process_payment(TEXT, TEXT, {other}, UUID, TIMESTAMPTZ, BOOLEAN);')
+            money = 'BIGINT' if self.money_minor else 'NUMERIC'
+            await conn.execute(f'''
+            CREATE OR REPLACE FUNCTION process_payment(p_customer_id TEXT, p_merchant_id TEXT, p_amount {money}, p_tr_id UUID,
+                                                       p_time TIMESTAMPTZ DEFAULT NULL, p_defer BOOLEAN DEFAULT FALSE)
+            RETURNS TABLE(status TEXT, b_old {money}, b_new {money}) AS $$
+            DECLARE
+                v_old {money};
+            BEGIN
+                SELECT c.acc_balance INTO v_old FROM customers c WHERE c.customer_id = p_customer_id FOR NO KEY UPDATE;
+                IF NOT FOUND THEN
+                    RETURN QUERY SELECT 'not_found'::TEXT, NULL::{money}, NULL::{money};
+                    RETURN;
+                END IF;
+
+                IF v_old < p_amount THEN
+                    INSERT INTO history(history_id, customer_id, merchant_id, amount, time, is_rejected, b_old, b_new)
+                    VALUES(p_tr_id, p_customer_id, p_merchant_id, p_amount, COALESCE(p_time, NOW()), TRUE, v_old, v_old);
+                    RETURN QUERY SELECT 'rejected'::TEXT, v_old, v_old;
+                    RETURN;
+                END IF;
+
+                UPDATE customers SET acc_balance = v_old - p_amount, updated_at = NOW() WHERE customer_id = p_customer_id;
+                IF p_defer THEN
+                    INSERT INTO merchant_ledger(merchant_id, amount) VALUES(p_merchant_id, p_amount);
+                ELSE
+                    UPDATE merchants SET acc_balance = acc_balance + p_amount, updated_at = NOW() WHERE merchant_id = p_merchant_id;
+                END IF;
+                INSERT INTO history(history_id, customer_id, merchant_id, amount, time, b_old, b_new)
+                VALUES(p_tr_id, p_customer_id, p_merchant_id, p_amount, COALESCE(p_time, NOW()), v_old, v_old - p_amount);
+                RETURN QUERY SELECT 'accepted'::TEXT, v_old, v_old - p_amount;
+            END;
+            $$ LANGUAGE plpgsql;''')
+
+            if self.partition_history:
+                await self.ensure_history_partitions(conn=conn)
+
+            await conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INT NOT NULL,
+                partitioned BOOLEAN NOT NULL,
+                money_minor BOOLEAN NOT NULL,
+                applied_at TIMESTAMPTZ DEFAULT NOW()
+            );''')
+            async with conn.transaction():
+                await conn.execute('DELETE FROM schema_version')
+                await conn.execute('INSERT INTO schema_version(version, partitioned, money_minor) VALUES($1, $2, $3)',
+                                   SCHEMA_VERSION, self.partition_history, self.money_minor)
+
+            logger.info(f"Database tables initialized successfully (schema version {SCHEMA_VERSION}).")
+        except Exception as e:
+            logger.error(f"DB initialization error: {e}")
+            raise
+
+    # Monthly history partitions covering [start, end) (default: this month and PARTITION_MONTHS_AHEAD more).
+    # Simulations replaying past dates should call this for their simulated range up front.
+    async def ensure_history_partitions(self, start=None, end=None, conn=None):
+        if not self.partition_history:
+            return
+        today = datetime.now(timezone.utc)
+        month = (start or today).replace(day=1, hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone.utc)
+        if end is None:
+            end = _add_months(month, PARTITION_MONTHS_AHEAD + 1)
+        elif end.tzinfo is None:
+            end = end.replace(tzinfo=timezone.utc)
+        if conn is None:
+            async with self.pool.acquire() as conn:
+                return await self.ensure_history_partitions(start, end, conn)
+        while month < end:
+            nxt = _add_months(month, 1)
+            try:
+                await conn.execute(f"CREATE TABLE IF NOT EXISTS history_y{month:%Y}m{month:%m} PARTITION OF history "
+                                   f"FOR VALUES FROM ('{month.isoformat()}') TO ('{nxt.isoformat()}')")
             except Exception as e:
-                logger.error(f"DB initialization error: {e}")
-                raise
+                # typically rows for that month already landed in history_default
+                logger.warning(f"Could not create history partition for {month:%Y-%m}: {e}")
+            self._partition_months.add(month)
+            month = nxt
+
+    # A long-running process would otherwise outrun the months created at init() and send every later
+    # row to history_default. The loop keeps PARTITION_MONTHS_AHEAD months ahead of the clock, and
+    # payments dated past the newest partition (simulated time) roll them forward on the spot.
+    async def _partition_loop(self):
+        while True:
+            await asyncio.sleep(PARTITION_CHECK_INTERVAL)
+            try:
+                await self.ensure_history_partitions()
+            except Exception as e:
+                logger.error(f"History partition roll-forward failed: {e}")
+
+    # Months are tracked as a set, not a high-water mark: a restored checkpoint or a replay can write
+    # months older than the newest partition, and those need partitions as well
+    async def _cover_history(self, earliest, latest=None):
+        if not self.partition_history or not self._partition_months:
+            return
+        first = earliest.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        last = (latest or earliest).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        if self._months_covered(first, last):
+            return
+        async with self._partition_lock:
+            if not self._months_covered(first, last):
+                await self.ensure_history_partitions(first, _add_months(last, PARTITION_MONTHS_AHEAD + 1))
+
+    def _months_covered(self, first, last):
+        month = first
+        while month <= last:
+            if month not in self._partition_months:
+                return False
+            month = _add_months(month, 1)
+        return True
 
     # Core functions
     async def save_customer(self, customer: dict):
+        balance = None
+        # .get: a customer without an id fails in the insert and is logged like any other save error
+        customer_id = customer.get('id')
+        self.balances.begin([customer_id])
         try:
-            async with self.pool.acquire() as conn:
+            async with self.acquire('save_customer') as conn:
                 await conn.execute('''
                 INSERT INTO customers(customer_id, age, name_full, profession, salary, level, acc_balance, description, industry, behavior)
                 VALUES($1,$2,$3,$4,$5,$6,$7,$8,$9,$10)
@@ -139,17 +602,20 @@ class DataProcessor:
                     updated_at=NOW()
                 ''',
                 customer['id'], customer.get('age', 18), customer.get('name_full') or customer.get('name'),
-                customer.get('profession', 'Unknown'), customer.get('salary', 0.0), customer.get('level', 1),
-                customer.get('acc_balance', 0.0), customer.get('description',''), customer.get('industry','General'),
+                customer.get('profession', 'Unknown'), self.to_db(customer.get('salary', 0.0)), customer.get('level', 1),
+                self.to_db(customer.get('acc_balance', 0.0)), customer.get('description',''), customer.get('industry','General'),
                 customer.get('behavior', 'Conservative'))
-                logger.info(f"Customer {customer['id']} saved/updated successfully.")
+                balance = self.to_db(customer.get('acc_balance', 0.0))
+                logger.info(f"Customer {customer['id']} saved/updated successfully.", extra={'sample': 'customer_saved'})
         except Exception as e:
-            logger.error(f"Error saving customer {customer.get('id')}: {e}")
+            logger.error(f"Error saving customer {customer_id}: {e}")
+        finally:
+            self.balances.end({customer_id: balance})
 
     async def save_merchant(self, merchant: dict):
         try:
             merchant_id = merchant.get('merchant_id') or merchant.get('id')
-            async with self.pool.acquire() as conn:
+            async with self.acquire('save_merchant') as conn:
                 await conn.execute('''
                 INSERT INTO merchants(merchant_id, category, description, acc_balance)
                 VALUES($1,$2,$3,$4)
@@ -159,134 +625,545 @@ class DataProcessor:
                     acc_balance=EXCLUDED.acc_balance,
                     updated_at=NOW()
                 ''',
-                merchant_id, merchant.get('category','General'), merchant.get('description',''), merchant.get('acc_balance',0.0))
-                logger.info(f"Merchant {merchant_id} saved/updated successfully.")
+                merchant_id, merchant.get('category','General'), merchant.get('description',''), self.to_db(merchant.get('acc_balance',0.0)))
+                logger.info(f"Merchant {merchant_id} saved/updated successfully.", extra={'sample': 'merchant_saved'})
         except Exception as e:
             logger.error(f"Error saving merchant {merchant_id}: {e}")
 
+    # Bulk loaders
+    # Accept a list of dicts (same shape as save_customer/save_merchant) or a pandas DataFrame.
+    # Rows are streamed chunk by chunk into a temp table with COPY, then upserted with one statement per chunk.
+    # progress(done, total) is called after every chunk.
+    async def save_customers_bulk(self, customers, chunk_size=BULK_CHUNK_SIZE, progress=None):
+        columns = ['customer_id', 'age', 'name_full', 'profession', 'salary', 'level', 'acc_balance', 'description', 'industry', 'behavior']
+        updates = ', '.join(f'{c}=EXCLUDED.{c}' for c in columns[1:])
+        await self._bulk_upsert('customers', columns, updates, customers, self._customer_record, chunk_size, progress,
+                                balance_col=columns.index('acc_balance'))
+
+    async def save_merchants_bulk(self, merchants, chunk_size=BULK_CHUNK_SIZE, progress=None):
+        columns = ['merchant_id', 'category', 'description', 'acc_balance']
+        updates = ', '.join(f'{c}=EXCLUDED.{c}' for c in columns[1:])
+        await self._bulk_upsert('merchants', columns, updates, merchants, self._merchant_record, chunk_size, progress)
+
+    # Bulk upsert of ready-made rows into any table keyed by its first column, e.g. the metric tables.
+    # rows: tuples in `columns` order; updates: the SET list applied to existing keys (updated_at is
+    # always set). Customers and merchants go through save_*_bulk, which keep the balance cache in step.
+    async def bulk_upsert(self, table, columns, updates, rows, chunk_size=BULK_CHUNK_SIZE, progress=None):
+        await self._bulk_upsert(table, columns, updates, rows, tuple, chunk_size, progress)
+
+    def _customer_record(self, customer):
+        return (customer.get('customer_id') or customer['id'], int(customer.get('age', 18)), customer.get('name_full') or customer.get('name'),
+                customer.get('profession', 'Unknown'), self.to_db(customer.get('salary', 0.0)), int(customer.get('level', 1)),
+                self.to_db(customer.get('acc_balance', 0.0)), customer.get('description', ''), customer.get('industry', 'General'),
+                customer.get('behavior', 'Conservative'))
+
+    def _merchant_record(self, merchant):
+        return (merchant.get('merchant_id') or merchant['id'], merchant.get('category', 'General'), merchant.get('description', ''),
+                self.to_db(merchant.get('acc_balance', 0.0)))
+
+    @staticmethod
+    def _iter_chunks(rows, chunk_size):
+        # DataFrames are converted one chunk at a time so memory stays flat
+        if hasattr(rows, 'iloc'):
+            for start in range(0, len(rows), chunk_size):
+                yield rows.iloc[start:start + chunk_size].to_dict('records')
+            return
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    # balance_col: index of the balance in each record, for tables whose balances are cached
+    async def _bulk_upsert(self, table, columns, updates, rows, to_record, chunk_size, progress, balance_col=None):
+        total = len(rows) if hasattr(rows, '__len__') else None
+        done = 0
+        stage = f'{table}_stage'
+        key = columns[0]
+        cols = ', '.join(columns)
+        try:
+            async with self.acquire(f'save_{table}_bulk') as conn:
+                for chunk in self._iter_chunks(rows, chunk_size):
+                    # last row wins for duplicate keys, ON CONFLICT can't touch the same row twice
+                    records = list({rec[0]: rec for rec in map(to_record, chunk)}.values())
+                    written = {}
+                    if balance_col is not None:
+                        self.balances.begin([rec[0] for rec in records])
+                    try:
+                        async with conn.transaction():
+                            await conn.execute(f'CREATE TEMP TABLE IF NOT EXISTS {stage} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS')
+                            await conn.copy_records_to_table(stage, records=records, columns=columns)
+                            await conn.execute(f'''
+                            INSERT INTO {table}({cols})
+                            SELECT {cols} FROM {stage}
+                            ON CONFLICT({key}) DO UPDATE SET
+                                {updates},
+                                updated_at=NOW()
+                            ''')
+                        if balance_col is not None:
+                            written = {rec[0]: rec[balance_col] for rec in records}
+                    finally:
+                        if balance_col is not None:
+                            self.balances.end({rec[0]: written.get(rec[0]) for rec in records})
+                    done += len(chunk)
+                    if progress:
+                        progress(done, total)
+            logger.info(f"Bulk saved {done} rows into {table}.")
+        except Exception as e:
+            logger.error(f"Error bulk saving {table} after {done} rows: {e}")
+            raise
+
     # make transaction
-    async def make_transaction(self, customer_id, merchant_id, amount: float):
-        tr_id = str(uuid.uuid4())
-        async with self.pool.acquire() as conn:
-            async with conn.transaction():
-                try:
-                    cust = await conn.fetchrow('SELECT acc_balance FROM customers WHERE customer_id=$1', customer_id)
-                    if not cust:
-                        logger.warning(f"Customer {customer_id} not found")
-                        return False
-                    if cust['acc_balance'] < amount:
-                        logger.warning(f"Transaction failed: insufficient funds for {customer_id}")
-                        # record rejected transaction
-                        await conn.execute('''
-                        INSERT INTO history(customer_id, merchant_id, amount, is_rejected, b_old, b_new)
-                        VALUES($1,$2,$3,TRUE,$4,$4)
-                        ''', customer_id, merchant_id, amount, cust['acc_balance'])
-                        return False
-
-                    b_old = cust['acc_balance']
-                    b_new = b_old - Decimal(amount)
-
-                    await conn.execute('UPDATE customers SET acc_balance=$1, updated_at=NOW() WHERE customer_id=$2', b_new, customer_id)
-                    await conn.execute('UPDATE merchants SET acc_balance=acc_balance+$1, updated_at=NOW() WHERE merchant_id=$2', amount, merchant_id)
-
-                    await conn.execute('''
-                    INSERT INTO history(history_id, customer_id, merchant_id, amount, b_old, b_new)
-                    VALUES($1,$2,$3,$4,$5,$6)
-                    ''', tr_id, customer_id, merchant_id, amount, b_old, b_new)
-
-                    # Update metrics asynchronously
-                    asyncio.create_task(self.update_metrics(customer_id, amount, b_new))
-
-                    return True
-                except Exception as e:
-                    logger.error(f"Error processing transaction {tr_id}: {e}")
-                    raise
+    # Single round trip through process_payment(). The query text is constant, so asyncpg prepares it
+    # once per connection and reuses the prepared statement from its statement cache afterwards.
+    # at: timestamp recorded in history (e.g. simulated time), default NOW()
+    async def make_transaction(self, customer_id, merchant_id, amount: float, at=None):
+        tr_id = new_tr_id()
+        value = self.to_db(amount)
+        res = None
+        if at is not None:
+            await self._cover_history(as_utc(at))
+        self.balances.begin([customer_id])
+        try:
+            async with self.acquire('make_transaction') as conn:
+                res = await conn.fetchrow(PAYMENT_QUERY, customer_id, merchant_id, value, tr_id, as_utc(at), self.defer_merchant_credit)
+        except Exception as e:
+            logger.error(f"Error processing transaction {tr_id}: {e}")
+            raise
+        finally:
+            # b_new is the committed balance for accepted and rejected payments alike
+            self.balances.end({customer_id: res['b_new'] if res else None})
 
-    # Metrics
+        self.stats.incr(f"tx_{res['status']}")
+        if res['status'] != 'not_found':
+            self.watermark += 1
+        if self.scorer is not None and res['status'] != 'not_found':
+            self.scorer.submit([(tr_id, customer_id, merchant_id, value, as_utc(at) or datetime.now(timezone.utc),
+                                 res['status'] == 'rejected', res['b_old'], res['b_new'])])
+        if res['status'] == 'not_found':
+            logger.warning(f"Customer {customer_id} not found", extra={'sample': 'tx_not_found'})
+            return False
+        if res['status'] == 'rejected':
+            logger.warning(f"Transaction failed: insufficient funds for {customer_id}", extra={'sample': 'tx_rejected'})
+            return False
+
+        await self.update_metrics(customer_id, amount, self.from_db(res['b_new']))
+        return True
+
+    # Batched transactions
+    # Applies payments chunk by chunk: one lock pass, one debit/credit pass and one COPY into history per chunk.
+    # Every payment is still accepted or rejected on its own, in input order. Returns one bool per payment.
+    # A 'time' (or 'date') key on a transaction is recorded in history instead of NOW().
+    async def make_transactions_batch(self, transactions, chunk_size=BATCH_SIZE):
+        transactions = list(transactions)
+        results = []
+        for start in range(0, len(transactions), chunk_size):
+            results.extend(await self._apply_batch(transactions[start:start + chunk_size]))
+        return results
+
+    async def _apply_batch(self, chunk):
+        now = datetime.now(timezone.utc)
+        to_db = self.to_db
+        txs = [(new_tr_id(), tx['customer_id'], tx['merchant_id'], to_db(tx['amount']),
+                as_utc(tx.get('time') or tx.get('date')) or now) for tx in chunk]
+        cust_ids = sorted({t[1] for t in txs})
+        merch_ids = sorted({t[2] for t in txs})
+        await self._cover_history(min(t[4] for t in txs), max(t[4] for t in txs))
+        results = []
+        accepted = []
+        balances = {}
+        committed = False
+        self.balances.begin(cust_ids)
+        try:
+            async with self.acquire('make_transactions_batch') as conn:
+                async with conn.transaction():
+                    try:
+                        # lock rows in a fixed order so concurrent batches can't deadlock. NO KEY UPDATE: only
+                        # balances change, and the metric upserts' foreign key checks (FOR KEY SHARE on the
+                        # same customers, in their own order) must not wait on it
+                        rows = await conn.fetch('SELECT customer_id, acc_balance FROM customers WHERE customer_id = ANY($1::text[]) ORDER BY customer_id FOR NO KEY UPDATE',
+                                                cust_ids)
+                        balances = {r['customer_id']: r['acc_balance'] for r in rows}
+                        # deferred credits don't touch merchant rows, so there is nothing to lock
+                        lock = '' if self.defer_merchant_credit else ' ORDER BY merchant_id FOR NO KEY UPDATE'
+                        rows = await conn.fetch(f'SELECT merchant_id FROM merchants WHERE merchant_id = ANY($1::text[]){lock}',
+                                                merch_ids)
+                        known_merchants = {r['merchant_id'] for r in rows}
+
+                        t_decide = time.perf_counter()
+                        history = []
+                        credits = {}
+                        debited = set()
+                        missing = 0
+                        for tr_id, cust_id, merch_id, amount, at in txs:
+                            b_old = balances.get(cust_id)
+                            if b_old is None or merch_id not in known_merchants:
+                                missing += 1
+                                results.append(False)
+                                continue
+                            if b_old < amount:
+                                # record rejected transaction
+                                history.append((tr_id, cust_id, merch_id, amount, at, True, b_old, b_old))
+                                results.append(False)
+                                continue
+                            b_new = b_old - amount
+                            balances[cust_id] = b_new
+                            debited.add(cust_id)
+                            credits[merch_id] = credits.get(merch_id, 0) + amount
+                            history.append((tr_id, cust_id, merch_id, amount, at, False, b_old, b_new))
+                            accepted.append((cust_id, amount, b_new))
+                            results.append(True)
+
+                        # Python-side cost (money arithmetic, record building) separate from SQL time
+                        self.stats.observe('make_transactions_batch.decide', time.perf_counter() - t_decide)
+                        self.stats.incr('tx_accepted', len(accepted))
+                        self.stats.incr('tx_rejected', len(history) - len(accepted))
+                        self.stats.incr('tx_not_found', missing)
+
+                        if debited:
+                            ids = sorted(debited)
+                            await conn.execute(f'''
+                            UPDATE customers c SET acc_balance=d.acc_balance, updated_at=NOW()
+                            FROM unnest($1::text[], $2::{self.money_sql}[]) AS d(customer_id, acc_balance)
+                            WHERE c.customer_id=d.customer_id
+                            ''', ids, [balances[i] for i in ids])
+                        if credits and self.defer_merchant_credit:
+                            await conn.copy_records_to_table('merchant_ledger', records=list(credits.items()),
+                                                             columns=['merchant_id', 'amount'])
+                        elif credits:
+                            ids = sorted(credits)
+                            await conn.execute(f'''
+                            UPDATE merchants m SET acc_balance=m.acc_balance+d.amount, updated_at=NOW()
+                            FROM unnest($1::text[], $2::{self.money_sql}[]) AS d(merchant_id, amount)
+                            WHERE m.merchant_id=d.merchant_id
+                            ''', ids, [credits[i] for i in ids])
+                        if history:
+                            await conn.copy_records_to_table('history', records=history,
+                                columns=['history_id', 'customer_id', 'merchant_id', 'amount', 'time', 'is_rejected', 'b_old', 'b_new'])
+                        if missing:
+                            logger.warning(f"Batch skipped {missing} transactions with unknown customer or merchant")
+                    except Exception as e:
+                        logger.error(f"Error processing transaction batch of {len(txs)}: {e}")
+                        raise
+            committed = True
+            self.watermark += len(history)
+        finally:
+            # every locked customer's balance is known once the batch commits
+            self.balances.end({c: balances.get(c) if committed else None for c in cust_ids})
 
-    #issues to solve tomorrow
-    #Float and decimal being not compatible with each other
+        if self.scorer is not None and history:
+            self.scorer.submit(history)
+
+        # Hand metrics to the aggregator once the batch is committed
+        if self.money_minor:
+            accepted = [(cust_id, amount / SCALE, b_new / SCALE) for cust_id, amount, b_new in accepted]
+        await self.metrics.record_many(accepted)
+        return results
+
+    # Balances
+    # Read-through: served from the cache when this process already knows the committed balance,
+    # otherwise one query whose result is cached unless a write raced it. None for unknown customers.
+    async def balance_query(self, customer_id):
+        balance = self.balances.get(customer_id)
+        if balance is not None:
+            return self.from_db(balance)
+        generation = self.balances.generation
+        async with self.acquire('balance_query') as conn:
+            balance = await conn.fetchval('SELECT acc_balance FROM customers WHERE customer_id = $1', customer_id)
+        self.balances.fill(customer_id, balance, generation)
+        return self.from_db(balance)
+
+    # Write out anything this process still buffers (nothing here, see MemoryLedger)
+    async def sync(self):
+        pass
+
+    # Balances were changed directly in the database (incentive cycle): drop what we know
+    async def reload_balances(self):
+        self.balances.clear()
+        self.watermark += 1
+
+    # Metrics
+    # Queued to the write-behind aggregator (src/data_layer/metrics.py), written out in batches
+    # Timed part is the wait for queue space, i.e. backpressure from the aggregator
     async def update_metrics(self, cust_id, amount, b_new):
-        amount = Decimal(amount)
-        b_new = Decimal(b_new)
-        async with self.pool.acquire() as conn:
-            try:
-                # --- cust_core ---
-                core = await conn.fetchrow('SELECT * FROM cust_core WHERE cust_id=$1', cust_id)
-                if not core:
-                    await conn.execute('INSERT INTO cust_core(cust_id, avg_daily_bal, max_bal, min_bal, bal_std, inactive_days) VALUES($1,$2,$3,$4,$5,$6)', cust_id, b_new, b_new, b_new, 0.0, 0)
-                else:
-                    avg_daily_bal = (core['avg_daily_bal'] + b_new) / 2
-                    max_bal = max(core['max_bal'], b_new)
-                    min_bal = min(core['min_bal'], b_new)
-                    await conn.execute('UPDATE cust_core SET avg_daily_bal=$1, max_bal=$2, min_bal=$3, updated_at=NOW() WHERE cust_id=$4',
-                                       avg_daily_bal, max_bal, min_bal, cust_id)
-
-                # --- freqvol ---
-                freq = await conn.fetchrow('SELECT * FROM freqvol WHERE cust_id=$1', cust_id)
-                if not freq:
-                    await conn.execute('INSERT INTO freqvol(cust_id, num_tr_day, num_tr_week, avg_tr_val, total_tr_val, velocity) VALUES($1,1,1,$2,$2,$3)',
-                                       cust_id, amount, amount / TARGET_VELOCITY)
-                else:
-                    num_tr_day = freq['num_tr_day'] + 1
-                    num_tr_week = freq['num_tr_week'] + 1
-                    total_tr_val = freq['total_tr_val'] + amount
-                    avg_tr_val = total_tr_val / num_tr_week
-                    velocity = total_tr_val / TARGET_VELOCITY
-                    await conn.execute('UPDATE freqvol SET num_tr_day=$1, num_tr_week=$2, total_tr_val=$3, avg_tr_val=$4, velocity=$5, updated_at=NOW() WHERE cust_id=$6',
-                                       num_tr_day, num_tr_week, total_tr_val, avg_tr_val, velocity, cust_id)
-
-                # --- cust_incentives ---
-                inc = await conn.fetchrow('SELECT * FROM cust_incentives WHERE cust_id=$1', cust_id)
-                bonus = amount * Decimal(BONUS_RATE)
-                if not inc:
-                    await conn.execute('INSERT INTO cust_incentives(cust_id, cashback_earned, decay_loss_cnt, incentive_resp) VALUES($1,$2,0,1.0)',
-                                       cust_id, bonus)
-                else:
-                    cashback = inc['cashback_earned'] + bonus
-                    decay_loss = inc['decay_loss_cnt']
-                    incentive_resp = min(1.0, inc['incentive_resp'] + 0.01)
-                    await conn.execute('UPDATE cust_incentives SET cashback_earned=$1, decay_loss_cnt=$2, incentive_resp=$3, updated_at=NOW() WHERE cust_id=$4',
-                                       cashback, decay_loss, incentive_resp, cust_id)
-
-                logger.info(f"Metrics updated for customer {cust_id}")
-            except Exception as e:
-                logger.error(f"Error updating metrics for customer {cust_id}: {e}")
+        t0 = time.perf_counter()
+        await self.metrics.record(cust_id, amount, b_new)
+        self.stats.observe('update_metrics', time.perf_counter() - t0)
 
     # Fetch history 
     async def get_historical_data(self):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('get_historical_data') as conn:
             try:
-                rows = await conn.fetch('''
-                SELECT h.history_id, h.customer_id, c.name_full, h.merchant_id, m.category, h.amount, h.time, h.is_rejected, h.b_old, h.b_new
-                FROM history h
-                LEFT JOIN customers c ON c.customer_id=h.customer_id
-                LEFT JOIN merchants m ON m.merchant_id=h.merchant_id
-                ORDER BY h.time DESC
-                ''')
-                return [dict(r) for r in rows]
+                rows = await conn.fetch(f'{HISTORY_SELECT} ORDER BY h.time DESC')
+                return self._history_rows(rows)
             except Exception as e:
                 logger.error(f"Failed fetching historical data: {e}")
                 return []
 
+    # Streaming history
+    # Same columns and order as get_historical_data, filtered, read through a server-side cursor
+    # fetch_size rows at a time. Yields dicts, or DataFrame chunks of fetch_size rows with as_frame=True.
+    async def iter_history(self, customer_id=None, merchant_id=None, category=None, start=None, end=None,
+                           is_rejected=None, fetch_size=HISTORY_FETCH_SIZE, as_frame=False):
+        where, args = self._history_filters(customer_id, merchant_id, category, start, end, is_rejected)
+        query = f'{HISTORY_SELECT} {where} ORDER BY h.time DESC, h.history_id DESC'
+        if as_frame:
+            import pandas as pd
+        async with self.acquire('iter_history') as conn:
+            # cursors only live inside a transaction
+            async with conn.transaction():
+                cursor = await conn.cursor(query, *args)
+                while True:
+                    rows = await cursor.fetch(fetch_size)
+                    if not rows:
+                        break
+                    if as_frame:
+                        yield pd.DataFrame(self._history_rows(rows))
+                    else:
+                        for r in self._history_rows(rows):
+                            yield r
+
+    # Keyset pagination on (time, history_id), newest first.
+    # Pass the returned key as `after` to get the next page; key is None on the last page.
+    async def get_history_page(self, customer_id=None, merchant_id=None, category=None, start=None, end=None,
+                               is_rejected=None, after=None, limit=HISTORY_FETCH_SIZE):
+        where, args = self._history_filters(customer_id, merchant_id, category, start, end, is_rejected)
+        if after is not None:
+            args.extend(after)
+            cond = f'(h.time, h.history_id) < (${len(args) - 1}, ${len(args)})'
+            where = f'{where} AND {cond}' if where else f'WHERE {cond}'
+        args.append(limit)
+        query = f'{HISTORY_SELECT} {where} ORDER BY h.time DESC, h.history_id DESC LIMIT ${len(args)}'
+        try:
+            async with self.acquire('get_history_page') as conn:
+                rows = await conn.fetch(query, *args)
+        except Exception as e:
+            logger.error(f"Failed fetching history page: {e}")
+            return [], None
+        page = self._history_rows(rows)
+        key = (page[-1]['time'], page[-1]['history_id']) if len(page) == limit else None
+        return page, key
+
+    # Money columns in currency units whatever the storage, like balance_query
+    def _history_rows(self, rows):
+        if not self.money_minor:
+            return [dict(r) for r in rows]
+        from_db = self.from_db
+        out = []
+        for r in rows:
+            row = dict(r)
+            for col in HISTORY_MONEY:
+                row[col] = from_db(row[col])
+            out.append(row)
+        return out
+
+    @staticmethod
+    def _history_filters(customer_id, merchant_id, category, start, end, is_rejected):
+        conds, args = [], []
+        for cond, value in (('h.customer_id = ${}', customer_id), ('h.merchant_id = ${}', merchant_id),
+                            ('m.category = ${}', category), ('h.time >= ${}', start), ('h.time < ${}', end),
+                            ('h.is_rejected = ${}', is_rejected)):
+            if value is not None:
+                args.append(value)
+                conds.append(cond.format(len(args)))
+        return ('WHERE ' + ' AND '.join(conds)) if conds else '', args
+
+    # Merchant credits
+    # Exact current balance in either mode: consolidated balance plus credits still in the ledger,
+    # read in one statement so a concurrent consolidation can't be counted twice or missed
+    async def merchant_balance(self, merchant_id):
+        async with self.acquire('merchant_balance') as conn:
+            balance = await conn.fetchval('''
+            SELECT m.acc_balance + COALESCE((SELECT SUM(l.amount) FROM merchant_ledger l WHERE l.merchant_id = m.merchant_id), 0)
+            FROM merchants m WHERE m.merchant_id = $1
+            ''', merchant_id)
+        return self.from_db(balance)
+
+    # Fold pending ledger credits into merchants.acc_balance and pending rollups into merch_daily,
+    # atomically; returns merchants updated
+    async def consolidate_merchant_credits(self):
+        async with self.acquire('consolidate_merchant_credits') as conn:
+            async with conn.transaction():
+                result = await conn.execute('''
+                WITH moved AS (
+                    DELETE FROM merchant_ledger RETURNING merchant_id, amount
+                ), totals AS (
+                    SELECT merchant_id, SUM(amount) AS amount FROM moved GROUP BY merchant_id
+                )
+                UPDATE merchants m SET acc_balance = m.acc_balance + t.amount, updated_at = NOW()
+                FROM totals t WHERE m.merchant_id = t.merchant_id
+                ''')
+                await conn.execute('''
+                WITH moved AS (
+                    DELETE FROM merch_daily_pending RETURNING merchant_id, day, tx_count, total_amount
+                )
+                INSERT INTO merch_daily(merchant_id, day, tx_count, total_amount)
+                SELECT merchant_id, day, SUM(tx_count), SUM(total_amount) FROM moved
+                GROUP BY 1, 2
+                ORDER BY 1, 2
+                ON CONFLICT(merchant_id, day) DO UPDATE SET
+                    tx_count = merch_daily.tx_count + EXCLUDED.tx_count,
+                    total_amount = merch_daily.total_amount + EXCLUDED.total_amount
+                ''')
+        return int(result.split()[-1])
+
+    async def _consolidate_loop(self):
+        while True:
+            await asyncio.sleep(self.consolidate_interval)
+            try:
+                await self.consolidate_merchant_credits()
+            except Exception as e:
+                logger.error(f"Merchant credit consolidation failed: {e}")
+
     # Cleanup
     async def close(self):
         try:
-            await self.pool.close()
+            await self.stats.stop_logging()
+            if self.scorer:
+                await self.scorer.close()
+            if self._consolidator:
+                self._consolidator.cancel()
+                await asyncio.gather(self._consolidator, return_exceptions=True)
+                self._consolidator = None
+            if self._partitioner:
+                self._partitioner.cancel()
+                await asyncio.gather(self._partitioner, return_exceptions=True)
+                self._partitioner = None
+            if self.metrics:
+                await self.metrics.close()
+            if self.defer_merchant_credit:
+                await self.consolidate_merchant_credits()
+            if self.pool is not None:
+                await self.pool.close()
         except Exception as e:
             logger.warning(f"Error closing DB pool: {e}")
 
 
     # Clear database (Be careful)
+    # One TRUNCATE for every table: constant time whatever their size, and it takes the history
+    # partitions along. In-process state derived from the tables is dropped with them.
     async def clear_db(self):
         async with self.pool.acquire() as conn:
-            async with conn.transaction():
-                try:
-                    # Delete from dependent tables first
-                    await conn.execute("DELETE history, cust_core, freqvol, cust_incentives RESTART IDENTITY CASCADE;")
-                    # Then core tables
-                    await conn.execute("DELETE customers, merchants RESTART IDENTITY CASCADE;")
-                    logger.info("Database cleared successfully for next test.")
-                except Exception as e:
-                    logger.error(f"Error clearing database: {e}")
-    
+            try:
+                await conn.execute(f"TRUNCATE {', '.join(TABLES)} RESTART IDENTITY CASCADE;")
+                logger.info("Database cleared successfully for next test.")
+            except Exception as e:
+                logger.error(f"Error clearing database: {e}")
+                raise
+        await self._reset_state()
+
+    # The dashboard views are refreshed plainly (not CONCURRENTLY): the tables under them were just replaced
+    async def _reset_state(self):
+        async with self.pool.acquire() as conn:
+            for view in VIEWS:
+                await conn.execute(f'REFRESH MATERIALIZED VIEW {view}')
+        self.resets += 1
+        if self.metrics:
+            await self.metrics.reset()
+        await self.reload_balances()
+
+    # Template snapshots
+    # snapshot_template() copies the current database (e.g. right after seeding the population) into a
+    # template database; reset_from_template() drops the working database and clones it back from the
+    # template, so a run starts from the seeded state without re-seeding. Cloning copies files, so the
+    # cost depends on the template's size, not on how much history the run added.
+    # Both need CREATEDB and exclusive access: the pool is closed for the duration and reopened after,
+    # and other sessions on the working database are terminated (DROP ... WITH (FORCE), PostgreSQL 13+).
+    async def snapshot_template(self, template=None):
+        await self.sync()
+        if self.metrics:
+            await self.metrics.flush()
+        database = await self._current_database()
+        template = template or f'{database}_template'
+        await self._with_pool_closed(database, [
+            f'DROP DATABASE IF EXISTS "{template}"',
+            f'CREATE DATABASE "{template}" TEMPLATE "{database}"',
+        ])
+        logger.info(f"Saved database {database} as template {template}")
+        return template
+
+    async def reset_from_template(self, template=None):
+        database = await self._current_database()
+        template = template or f'{database}_template'
+        if self.metrics:
+            await self.metrics.flush()
+        await self._with_pool_closed(database, [
+            f'DROP DATABASE "{database}" WITH (FORCE)',
+            f'CREATE DATABASE "{database}" TEMPLATE "{template}"',
+        ])
+        # the clone only has the partitions the template had
+        self._partition_months.clear()
+        await self.ensure_history_partitions()
+        await self._reset_state()
+        logger.info(f"Database {database} reset from template {template}")
+
+    async def drop_template(self, template=None):
+        template = template or f'{await self._current_database()}_template'
+        conn = await asyncpg.connect(dsn=self.db_url, database=_maintenance_database(template))
+        try:
+            await conn.execute(f'DROP DATABASE IF EXISTS "{template}"')
+        finally:
+            await conn.close()
+
+    async def _current_database(self):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval('SELECT current_database()')
+
+    # Runs maintenance statements from another database while this process holds no connection.
+    # A failed statement is re-raised once the pool is back; if the pool can't be re-created either,
+    # self.pool is left as None rather than pointing at the closed one.
+    async def _with_pool_closed(self, database, statements):
+        await self.pool.close()
+        error = None
+        try:
+            conn = await asyncpg.connect(dsn=self.db_url, database=_maintenance_database(database))
+            try:
+                for statement in statements:
+                    await conn.execute(statement)
+            finally:
+                await conn.close()
+        except Exception as e:
+            logger.error(f"Template operation on {database} failed: {e}")
+            error = e
+        try:
+            self.pool = await self._create_pool()
+        except Exception as e:
+            self.pool = None
+            logger.error(f"Failed to re-create the DB pool after the template operation on {database}: {e}")
+            if error is None:
+                raise
+        if error is not None:
+            raise error
+
+
+# A database can't be dropped from a session connected to it
+def _maintenance_database(target):
+    return 'template1' if target == 'postgres' else 'postgres'
+
+
+_shared = None
+_shared_lock = None
+
+
+# Process-wide processor: created and initialized on first use, then the same instance (one pool,
+# schema checked once) for every caller. Arguments only matter on the first call.
+async def get_shared_processor(cls=None, **kwargs):
+    global _shared, _shared_lock
+    if _shared_lock is None:
+        _shared_lock = asyncio.Lock()
+    async with _shared_lock:
+        if _shared is None:
+            processor = (cls or DataProcessor)(**kwargs)
+            await processor.init()
+            _shared = processor
+    return _shared
+
+
+async def close_shared_processor():
+    global _shared
+    if _shared is not None:
+        await _shared.close()
+        _shared = None
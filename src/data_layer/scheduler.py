@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+# Constants
+QUEUE_DEPTH = 1000
+BATCH_SIZE = 1
+
+
+# Concurrent transaction scheduler.
+# customer_id is hashed to one of N worker queues, so a customer's payments are applied in submit
+# order while different customers run in parallel. Queues are bounded: submit() waits when a shard
+# is full. With batch_size > 1 a worker applies whatever is queued (up to batch_size) as one batch.
+class TransactionScheduler:
+    def __init__(self, dp, workers=None, queue_depth=QUEUE_DEPTH, batch_size=BATCH_SIZE):
+        self.dp = dp
+        # one worker per pooled connection by default
+        self.workers = workers or dp.max_size
+        self.batch_size = batch_size
+        self.queues = [asyncio.Queue(maxsize=queue_depth) for _ in range(self.workers)]
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = 0
+        self._tasks = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(q)) for q in self.queues]
+
+    # crc32 rather than hash(): stable across processes and runs
+    def shard(self, customer_id):
+        return zlib.crc32(customer_id.encode()) % self.workers
+
+    async def submit(self, customer_id, merchant_id, amount):
+        await self.queues[self.shard(customer_id)].put((customer_id, merchant_id, amount))
+
+    async def _worker(self, queue):
+        while True:
+            items = [await queue.get()]
+            while len(items) < self.batch_size and not queue.empty():
+                items.append(queue.get_nowait())
+            try:
+                if len(items) == 1:
+                    results = [await self.dp.make_transaction(*items[0])]
+                else:
+                    results = await self.dp.make_transactions_batch(
+                        [{'customer_id': c, 'merchant_id': m, 'amount': a} for c, m, a in items])
+                ok = sum(results)
+                self.accepted += ok
+                self.rejected += len(results) - ok
+            except Exception as e:
+                self.errors += len(items)
+                logger.error(f"Scheduler worker failed on {len(items)} transactions: {e}")
+            finally:
+                for _ in items:
+                    queue.task_done()
+
+    # Wait until everything submitted so far has been applied
+    async def drain(self):
+        await asyncio.gather(*(q.join() for q in self.queues))
+
+    async def close(self):
+        await self.drain()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # Convenience: start, push every transaction dict through, drain and return the counts
+    async def run(self, transactions):
+        self.start()
+        for tx in transactions:
+            await self.submit(tx['customer_id'], tx['merchant_id'], tx['amount'])
+        await self.close()
+        return {'accepted': self.accepted, 'rejected': self.rejected, 'errors': self.errors}
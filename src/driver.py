@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from src.data_layer.processor import DataProcessor
+from src.data_layer.scheduler import TransactionScheduler
+from src.logging_setup import setup_logger, stop_logger
+from src.generator import TransactionGenerator, generate_customers, generate_merchants, to_records
+
+
+logger = logging.getLogger(__name__)
+
+# Constants
+SCENARIOS = {
+    '50k': {'customers': 5000, 'merchants': 500, 'transactions': 50000},
+    '5m': {'customers': 500000, 'merchants': 5000, 'transactions': 5000000},
+}
+START_DATE = datetime(2025, 1, 1)
+END_DATE = datetime(2025, 9, 30)
+POOL_PER_WORKER = 4
+BATCH_SIZE = 100
+CHUNK_SIZE = 100000
+
+
+# Multi-process simulation driver.
+# Customers are split into contiguous id ranges, one per worker process. Each worker has its own
+# event loop and DataProcessor pool, seeds its customers and applies its own transaction stream.
+# Merchants are created once by the parent and passed to workers read-only; their balances only
+# change through atomic increments in the database, so sharing them across workers is safe.
+def run_sharded(customers, merchants, transactions, workers=None, seed=None):
+    workers = workers or os.cpu_count()
+    started = time.perf_counter()
+
+    merchant_rows = generate_merchants(merchants, seed=seed)
+    asyncio.run(_setup(merchant_rows))
+
+    shards = []
+    for w in range(workers):
+        lo, hi = customers * w // workers, customers * (w + 1) // workers
+        n_tx = transactions * (w + 1) // workers - transactions * w // workers
+        worker_seed = None if seed is None else seed + w + 1
+        shards.append((w, lo, hi - lo, n_tx, merchant_rows, worker_seed))
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_worker_main, *shard) for shard in shards]
+        for shard, future in zip(shards, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error(f"Worker {shard[0]} failed: {e}")
+                results.append({'worker': shard[0], 'customers': shard[2], 'transactions': shard[3],
+                                'accepted': 0, 'rejected': 0, 'errors': shard[3], 'elapsed': 0.0, 'tps': 0.0})
+
+    elapsed = time.perf_counter() - started
+    summary = {
+        'workers': workers,
+        'customers': customers,
+        'merchants': merchants,
+        'transactions': sum(r['transactions'] for r in results),
+        'accepted': sum(r['accepted'] for r in results),
+        'rejected': sum(r['rejected'] for r in results),
+        'errors': sum(r['errors'] for r in results),
+        'elapsed': elapsed,
+        'tps': transactions / elapsed if elapsed else 0.0,
+        'per_worker': results,
+    }
+    logger.info(f"Sharded run finished: {summary['transactions']} tx on {workers} workers in {elapsed:.1f}s "
+                f"({summary['tps']:.0f} tx/s, {summary['rejected']} rejected, {summary['errors']} errors)")
+    return summary
+
+
+# Schema and merchants are created once, before any worker starts
+async def _setup(merchant_rows):
+    dp = DataProcessor()
+    await dp.init()
+    try:
+        await dp.save_merchants_bulk(merchant_rows)
+    finally:
+        await dp.close()
+
+
+def _worker_main(worker, offset, n_customers, n_tx, merchant_rows, seed):
+    # the parent's listener thread doesn't exist in this process, start our own; pool workers exit
+    # through os._exit, so atexit never runs there and the listener is stopped here
+    setup_logger()
+    try:
+        return asyncio.run(_worker(worker, offset, n_customers, n_tx, merchant_rows, seed))
+    finally:
+        stop_logger()
+
+
+async def _worker(worker, offset, n_customers, n_tx, merchant_rows, seed):
+    started = time.perf_counter()
+    dp = DataProcessor(max_size=POOL_PER_WORKER)
+    await dp.init()
+    try:
+        customers = generate_customers(n_customers, seed=seed, offset=offset)
+        await dp.save_customers_bulk(customers)
+
+        gen = TransactionGenerator(customers, merchant_rows, START_DATE, END_DATE, seed=seed)
+        scheduler = TransactionScheduler(dp, batch_size=BATCH_SIZE)
+        scheduler.start()
+        for cols in gen.chunks(n_tx, chunk_size=CHUNK_SIZE):
+            for tx in to_records(cols):
+                await scheduler.submit(tx['customer_id'], tx['merchant_id'], tx['amount'])
+        await scheduler.close()
+        await dp.metrics.flush()
+    finally:
+        await dp.close()
+
+    elapsed = time.perf_counter() - started
+    return {
+        'worker': worker,
+        'pid': os.getpid(),
+        'customers': n_customers,
+        'transactions': n_tx,
+        'accepted': scheduler.accepted,
+        'rejected': scheduler.rejected,
+        'errors': scheduler.errors,
+        'elapsed': elapsed,
+        'tps': n_tx / elapsed if elapsed else 0.0,
+    }
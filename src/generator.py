@@ -0,0 +1,132 @@
+import numpy as np
+
+
+# Same category heuristics as the original per-row generator in Test2
+CATEGORIES = ['Tech', 'Entertainment', 'Grocery', 'Healthcare', 'Retail']
+CATEGORY_WEIGHTS = np.array([
+    [0.4, 0.3, 0.1, 0.1, 0.1],   # salary > HIGH_SALARY
+    [0.3, 0.4, 0.1, 0.1, 0.1],   # age < YOUNG_AGE
+    [0.2, 0.2, 0.3, 0.2, 0.1],   # everyone else
+])
+HIGH_SALARY = 120000
+YOUNG_AGE = 30
+BEHAVIOR_MULTIPLIER = {'Aggressive': 1.5, 'Moderate': 1.0, 'Conservative': 0.7}
+CHUNK_SIZE = 1_000_000
+
+
+def _column(rows, *keys):
+    # rows is a list of dicts or a DataFrame; first key present wins
+    if hasattr(rows, 'columns'):
+        for key in keys:
+            if key in rows.columns:
+                return rows[key].to_numpy()
+        raise KeyError(keys[0])
+    key = next(k for k in keys if k in rows[0])
+    return np.array([r[key] for r in rows])
+
+
+# Vectorized transaction generator.
+# Customers, categories, merchants, amounts and dates are drawn as whole arrays, so cost is a few
+# NumPy passes per chunk instead of a Python loop per row. Pass a seed for reproducible runs.
+class TransactionGenerator:
+    def __init__(self, customers, merchants, start, end, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.start = np.datetime64(start, 's')
+        self.span = int((end - start).total_seconds())
+
+        self.cust_ids = _column(customers, 'id', 'customer_id')
+        salary = _column(customers, 'salary').astype(float)
+        age = _column(customers, 'age').astype(int)
+        self.cust_group = np.where(salary > HIGH_SALARY, 0, np.where(age < YOUNG_AGE, 1, 2))
+        behavior = _column(customers, 'behavior')
+        self.cust_mult = np.array([BEHAVIOR_MULTIPLIER[b] for b in behavior])
+
+        self.merch_ids = _column(merchants, 'merchant_id', 'id')
+        self.merch_base = _column(merchants, 'acc_balance').astype(float) / 100
+        merch_cat = np.array([CATEGORIES.index(c) for c in _column(merchants, 'category')])
+
+        # merchants grouped by category: pick = order[offset[cat] + U * count[cat]]
+        self.merch_order = np.argsort(merch_cat, kind='stable')
+        self.merch_count = np.bincount(merch_cat, minlength=len(CATEGORIES))
+        self.merch_offset = np.cumsum(self.merch_count) - self.merch_count
+
+        # categories without merchants can't be drawn, renormalize the rest
+        weights = CATEGORY_WEIGHTS * (self.merch_count > 0)
+        if not weights.sum(axis=1).all():
+            raise ValueError("No merchants in any category a customer group can spend in")
+        # dividing by the last column makes it exactly 1.0, so u < 1 never runs off the end
+        cdf = np.cumsum(weights, axis=1)
+        self.cdf = cdf / cdf[:, -1:]
+
+    # One chunk as columnar arrays
+    def generate(self, n):
+        rng = self.rng
+        cust = rng.integers(0, len(self.cust_ids), n)
+
+        u = rng.random(n)
+        cat = (self.cdf[self.cust_group[cust]] <= u[:, None]).sum(axis=1)
+        slot = (rng.random(n) * self.merch_count[cat]).astype(np.int64)
+        merch = self.merch_order[self.merch_offset[cat] + slot]
+
+        amount = np.round(self.merch_base[merch] * self.cust_mult[cust] * rng.uniform(0.8, 1.2, n), 2)
+        date = self.start + rng.integers(0, self.span, n).astype('timedelta64[s]')
+
+        return {
+            'customer_id': self.cust_ids[cust],
+            'merchant_id': self.merch_ids[merch],
+            'amount': amount,
+            'date': date,
+        }
+
+    # Stream n transactions in chunks, as dicts of arrays or DataFrames
+    def chunks(self, n, chunk_size=CHUNK_SIZE, as_frame=False):
+        if as_frame:
+            import pandas as pd
+        done = 0
+        while done < n:
+            cols = self.generate(min(chunk_size, n - done))
+            done += len(cols['amount'])
+            yield pd.DataFrame(cols) if as_frame else cols
+
+
+# Columnar chunk -> list of transaction dicts (the shape DataProcessor batch APIs take)
+def to_records(cols):
+    return [{'customer_id': c, 'merchant_id': m, 'amount': a, 'date': d}
+            for c, m, a, d in zip(cols['customer_id'].tolist(), cols['merchant_id'].tolist(),
+                                  cols['amount'].tolist(), cols['date'].tolist())]
+
+
+# Vectorized population generators, same distributions as Test2.generate_customers/generate_merchants.
+# `offset` shifts the ids so shards of one population can be generated independently.
+def generate_customers(n, seed=None, offset=0):
+    rng = np.random.default_rng(seed)
+    ages = rng.integers(18, 70, n)
+    salaries = rng.integers(20000, 200000, n)
+    balances = rng.integers(1000, 20000, n)
+    industries = rng.choice(['Tech', 'Finance', 'Healthcare', 'Retail', 'Education'], n)
+    behaviors = rng.choice(['Aggressive', 'Moderate', 'Conservative'], n)
+    return [{
+        'id': f'c{offset + i + 1}',
+        'age': age,
+        'name_full': f'c{offset + i + 1}',
+        'profession': '',
+        'salary': float(salary),
+        'level': 1,
+        'acc_balance': float(balance),
+        'description': '',
+        'industry': industry,
+        'behavior': behavior,
+    } for i, (age, salary, balance, industry, behavior) in enumerate(zip(
+        ages.tolist(), salaries.tolist(), balances.tolist(), industries.tolist(), behaviors.tolist()))]
+
+
+def generate_merchants(n, seed=None):
+    rng = np.random.default_rng(seed)
+    categories = rng.choice(['Grocery', 'Tech', 'Entertainment', 'Healthcare', 'Retail'], n)
+    balances = rng.integers(5000, 50000, n)
+    return [{
+        'merchant_id': f'm{i + 1}',
+        'category': category,
+        'description': '',
+        'acc_balance': float(balance),
+    } for i, (category, balance) in enumerate(zip(categories.tolist(), balances.tolist()))]
@@ -1,7 +1,8 @@
+from src.data_layer.money import DIGITS
 from src.data_layer.processor import DataProcessor
-import logging 
-import uuid
-from datetime import datetime 
+import logging
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
 
 BONUS_RATE = 0.03
 DECAY_RATE = 0.02
@@ -17,36 +18,95 @@ logger = logging.getLogger(__name__)
 #If you spend, your money automatically becomes inflation
 #inflation-protected for this year
 
-class Incentive:
-    def __init__(self, customer_id: str, dp: DataProcessor):
-        self.customer_id = customer_id
+# One statement per cycle, for every customer at once:
+#   cashback = BONUS_RATE * accepted spend in the period
+#   decay    = DECAY_RATE * balance * (1 - velocity / TARGET_VELOCITY) when velocity (spend / balance)
+#              is below target, so fully idle money loses DECAY_RATE and money spent at target loses nothing
+# Balances are adjusted in one UPDATE, each adjustment is logged to history (merchant_id NULL,
+# positive cashback row, negative decay row) and decay_loss_cnt is bumped in cust_incentives.
+# $6 is the rounding scale: 4 decimals for NUMERIC money, 0 for minor units, so every adjustment
+# is already representable and the history rows add up to the balance change exactly.
+# The rates and balances are cast to numeric: next to BIGINT balances Postgres would infer the rate
+# parameters as int8, and asyncpg would send 0.02 / 0.5 truncated to 0.
+CYCLE_SQL = '''
+WITH spend AS (
+    SELECT customer_id, SUM(amount) AS spent
+    FROM history
+    WHERE NOT is_rejected AND merchant_id IS NOT NULL AND time >= $1 AND time < $2
+    GROUP BY customer_id
+),
+adj AS (
+    SELECT c.customer_id, c.acc_balance AS b_old,
+           ROUND(COALESCE(s.spent, 0)::numeric * $3::numeric, $6) AS cashback,
+           CASE WHEN c.acc_balance > 0 AND COALESCE(s.spent, 0) < $5::numeric * c.acc_balance::numeric
+                THEN ROUND(c.acc_balance::numeric * $4::numeric
+                           * (1 - COALESCE(s.spent, 0) / ($5::numeric * c.acc_balance::numeric)), $6)
+                ELSE 0 END AS decay
+    FROM customers c
+    LEFT JOIN spend s ON s.customer_id = c.customer_id
+    FOR NO KEY UPDATE OF c
+),
+changed AS (
+    UPDATE customers c SET acc_balance = a.b_old + a.cashback - a.decay, updated_at = NOW()
+    FROM adj a
+    WHERE c.customer_id = a.customer_id AND (a.cashback > 0 OR a.decay > 0)
+),
+cashback_rows AS (
+    INSERT INTO history(customer_id, merchant_id, amount, time, b_old, b_new)
+    SELECT customer_id, NULL, cashback, $2, b_old, b_old + cashback FROM adj WHERE cashback > 0
+),
+decay_rows AS (
+    INSERT INTO history(customer_id, merchant_id, amount, time, b_old, b_new)
+    SELECT customer_id, NULL, -decay, $2, b_old + cashback, b_old + cashback - decay FROM adj WHERE decay > 0
+),
+decay_cnt AS (
+    INSERT INTO cust_incentives(cust_id, decay_loss_cnt)
+    SELECT customer_id, 1 FROM adj WHERE decay > 0
+    ON CONFLICT(cust_id) DO UPDATE SET decay_loss_cnt = cust_incentives.decay_loss_cnt + 1, updated_at = NOW()
+)
+SELECT COUNT(*) AS customers,
+       COUNT(*) FILTER (WHERE cashback > 0) AS cashback_customers,
+       COALESCE(SUM(cashback), 0) AS cashback_total,
+       COUNT(*) FILTER (WHERE decay > 0) AS decayed_customers,
+       COALESCE(SUM(decay), 0) AS decay_total
+FROM adj
+'''
+
+
+# Period-close incentive engine: cashback on consumption and decay on idle money,
+# computed set-based in the database for the whole population in one pass
+class IncentiveEngine:
+    def __init__(self, dp: DataProcessor, bonus_rate=BONUS_RATE, decay_rate=DECAY_RATE,
+                 target_velocity=TARGET_VELOCITY, period_days=PERIOD_DAYS):
         self.dp = dp
-    
-    #apply cashback if consumption happened
-    async def apply_cashback(self, amount: float):
-        if amount <= 0: 
-            return 0
-
-        
-        await cashback = amount * BONUS_RATE
-
-        await tr_id = str(uuid.uuid4())
-        
-        await now = datetime.utcnow().isoformat()
-        
-        await self.dp.add_h_data({
-            'history_id': tr_id,
-            'customer_id': self.customer_id,
-            'merchant_id': None,
-            'amount': cashback,
-            'time': now,
-            'isRejected': False,
-            'b_old': self.dp.balance_query(self.customer_id),
-            'b_new': self.dp.balance_query(self.customer_id) + cashback
-        })
-        # Update customer balance
-        await self.dp.make_transaction(None, self.customer_id, cashback, tr_id, now)  # may need a "source" merchant for bookkeeping
-        return cashback
-
-
-    
\ No newline at end of file
+        self.bonus_rate = Decimal(str(bonus_rate))
+        self.decay_rate = Decimal(str(decay_rate))
+        self.target_velocity = Decimal(str(target_velocity))
+        self.period = timedelta(days=period_days)
+        self.last_close = None
+
+    # Close the period ending at period_end (default now). The period starts at the previous close,
+    # or PERIOD_DAYS earlier on the first cycle.
+    async def run_cycle(self, period_end=None):
+        period_end = period_end or datetime.now(timezone.utc)
+        period_start = self.last_close or period_end - self.period
+        try:
+            # buffered payments must be in history before spend is summed
+            await self.dp.sync()
+            async with self.dp.acquire('incentive_cycle') as conn:
+                row = await conn.fetchrow(CYCLE_SQL, period_start, period_end, self.bonus_rate, self.decay_rate,
+                                          self.target_velocity, 0 if self.dp.money_minor else DIGITS)
+        except Exception as e:
+            logger.error(f"Incentive cycle {period_start} - {period_end} failed: {e}")
+            raise
+        finally:
+            # every balance may have moved
+            await self.dp.reload_balances()
+        self.last_close = period_end
+        summary = dict(row)
+        summary['cashback_total'] = self.dp.from_db(summary['cashback_total'])
+        summary['decay_total'] = self.dp.from_db(summary['decay_total'])
+        logger.info(f"Incentive cycle closed at {period_end}: cashback {summary['cashback_total']} to "
+                    f"{summary['cashback_customers']} customers, decay {summary['decay_total']} from "
+                    f"{summary['decayed_customers']} customers")
+        return summary
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import math
+import time
+from datetime import datetime
+
+import numpy as np
+
+from src.data_layer.processor import DataProcessor
+from src.generator import TransactionGenerator
+
+
+logger = logging.getLogger(__name__)
+
+# Constants
+TARGET_TPS = 1000
+DURATION = 60.0
+MAX_IN_FLIGHT = 256
+WINDOW = 1.0
+SPIN_AHEAD = 0.001          # arrivals due within this are dispatched without sleeping
+# bursty: BURST_FACTOR x rate for BURST_ON seconds out of every BURST_PERIOD, quieter in between
+BURST_PERIOD = 10.0
+BURST_ON = 2.0
+BURST_FACTOR = 3.0
+# diurnal: one compressed day over the run, rate swings +-DIURNAL_SWING around the target
+DIURNAL_SWING = 0.8
+# payday: PAYDAY_FACTOR x rate for PAYDAY_WIDTH seconds at the start of every PAYDAY_PERIOD
+PAYDAY_PERIOD = 30.0
+PAYDAY_WIDTH = 3.0
+PAYDAY_FACTOR = 5.0
+PROFILES = ['poisson', 'bursty', 'diurnal', 'payday']
+START_DATE = datetime(2025, 1, 1)
+END_DATE = datetime(2025, 9, 30)
+
+
+# Instantaneous arrival rate (per second) at offsets t, for each profile.
+# Every profile averages to `rate` over whole periods, so target_tps stays comparable across them.
+def rate_at(profile, rate, t, duration):
+    t = np.asarray(t, dtype=np.float64)
+    if profile == 'poisson':
+        return np.full_like(t, rate)
+    if profile == 'bursty':
+        quiet = (BURST_PERIOD - BURST_ON * BURST_FACTOR) / (BURST_PERIOD - BURST_ON)
+        return rate * np.where(t % BURST_PERIOD < BURST_ON, BURST_FACTOR, quiet)
+    if profile == 'diurnal':
+        # trough at the start, peak half way through
+        return rate * (1.0 - DIURNAL_SWING * np.cos(2 * math.pi * t / duration))
+    if profile == 'payday':
+        base = (PAYDAY_PERIOD - PAYDAY_WIDTH * PAYDAY_FACTOR) / (PAYDAY_PERIOD - PAYDAY_WIDTH)
+        return rate * np.where(t % PAYDAY_PERIOD < PAYDAY_WIDTH, PAYDAY_FACTOR, base)
+    raise ValueError(f"unknown arrival profile: {profile}")
+
+
+def peak_rate(profile, rate):
+    return rate * {'poisson': 1.0, 'bursty': BURST_FACTOR, 'diurnal': 1.0 + DIURNAL_SWING,
+                   'payday': PAYDAY_FACTOR}[profile]
+
+
+# Arrival offsets (seconds from start, sorted) for a non-homogeneous Poisson process, by thinning:
+# draw a homogeneous process at the profile's peak rate and keep each point with
+# probability rate(t) / peak.
+def arrival_times(profile, rate, duration, rng):
+    peak = peak_rate(profile, rate)
+    n = rng.poisson(peak * duration)
+    t = np.sort(rng.uniform(0.0, duration, n))
+    keep = rng.random(n) * peak < rate_at(profile, rate, t, duration)
+    return t[keep]
+
+
+# Open-loop load generator.
+# Payments arrive on a precomputed schedule (arrival_times) whatever the system is doing: a slow
+# response delays nothing but itself. At most max_in_flight payments run at once; arrivals beyond
+# that wait for a slot, and that wait counts. Latency is measured from each payment's intended start
+# time, not from when it was actually sent, so queueing shows up in the percentiles instead of being
+# hidden by coordinated omission.
+# Saturation: arrivals and completions are counted per WINDOW of wall time. Once the backlog
+# (arrived but not yet completed) exceeds max_in_flight, requests are queueing for slots faster than
+# they complete; the first such window is reported as saturated_at_s, and the completion rate from
+# there on as saturation_tps, i.e. the throughput the system tops out at.
+class LoadGenerator:
+    def __init__(self, dp: DataProcessor, customers, merchants, target_tps=TARGET_TPS, duration=DURATION,
+                 profile='poisson', max_in_flight=MAX_IN_FLIGHT, seed=None):
+        if profile not in PROFILES:
+            raise ValueError(f"unknown arrival profile: {profile}")
+        self.dp = dp
+        self.target_tps = target_tps
+        self.duration = duration
+        self.profile = profile
+        self.max_in_flight = max_in_flight
+        self.rng = np.random.default_rng(seed)
+        self.gen = TransactionGenerator(customers, merchants, START_DATE, END_DATE, seed=seed)
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = 0
+
+    async def run(self):
+        arrivals = arrival_times(self.profile, self.target_tps, self.duration, self.rng)
+        n = len(arrivals)
+        cols = self.gen.generate(n)
+        cust = cols['customer_id'].tolist()
+        merch = cols['merchant_id'].tolist()
+        amount = cols['amount'].tolist()
+        latency = np.full(n, np.nan)
+        finished = np.full(n, np.nan)
+        slots = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+        max_lag = 0.0
+
+        async def send(i, intended):
+            try:
+                ok = await self.dp.make_transaction(cust[i], merch[i], amount[i])
+                if ok:
+                    self.accepted += 1
+                else:
+                    self.rejected += 1
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Load generator payment {i} failed: {e}")
+            finally:
+                done = time.perf_counter()
+                latency[i] = done - intended
+                finished[i] = done - started
+                self.dp.stats.observe('loadgen_latency', latency[i])
+                slots.release()
+
+        logger.info(f"Load: {n} payments over {self.duration:.0f}s, {self.profile} arrivals at "
+                    f"{self.target_tps} tx/s target, max {self.max_in_flight} in flight")
+        started = time.perf_counter()
+        for i, offset in enumerate(arrivals.tolist()):
+            intended = started + offset
+            ahead = intended - time.perf_counter()
+            if ahead > SPIN_AHEAD:
+                await asyncio.sleep(ahead)
+            await slots.acquire()
+            max_lag = max(max_lag, time.perf_counter() - intended)
+            task = asyncio.create_task(send(i, intended))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+        # payments the system decided, accepted or rejected; failed ones are not throughput
+        completed = self.accepted + self.rejected
+
+        summary = {
+            'profile': self.profile,
+            'target_tps': self.target_tps,
+            'duration': self.duration,
+            'max_in_flight': self.max_in_flight,
+            'offered': n,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'completed': completed,
+            'elapsed': elapsed,
+            'achieved_tps': completed / elapsed if elapsed else 0.0,
+            'max_dispatch_lag_ms': max_lag * 1000,
+            'latency_ms': _percentiles(latency),
+        }
+        summary.update(self._saturation(arrivals, finished, elapsed))
+        if summary['saturated']:
+            logger.warning(f"Load: saturated after {summary['saturated_at_s']:.0f}s at "
+                           f"{summary['saturation_tps']:.0f} tx/s (target {self.target_tps}, {self.profile})")
+        lat = summary['latency_ms']
+        logger.info(f"Load done: {completed}/{n} payments in {elapsed:.1f}s ({summary['achieved_tps']:.0f} tx/s), "
+                    f"p50 {lat['p50']:.1f} ms, p99 {lat['p99']:.1f} ms, max {lat['max']:.1f} ms, "
+                    f"{self.rejected} rejected, {self.errors} errors")
+        return summary
+
+    def _saturation(self, arrivals, finished, elapsed):
+        windows = max(1, math.ceil(elapsed / WINDOW))
+        offered = np.bincount((arrivals // WINDOW).astype(np.int64), minlength=windows)[:windows]
+        completed = np.bincount((finished // WINDOW).astype(np.int64), minlength=windows)[:windows]
+        backlog = np.cumsum(offered) - np.cumsum(completed)
+        over = np.flatnonzero(backlog > self.max_in_flight)
+        if not len(over):
+            return {'saturated': False, 'saturated_at_s': None, 'saturation_tps': None,
+                    'max_backlog': int(backlog.max())}
+        first = int(over[0])
+        return {
+            'saturated': True,
+            'saturated_at_s': first * WINDOW,
+            'saturation_tps': float(completed[first:].sum() / ((windows - first) * WINDOW)),
+            'max_backlog': int(backlog.max()),
+        }
+
+
+def _percentiles(samples):
+    samples = samples[~np.isnan(samples)] * 1000
+    if not len(samples):
+        return {'p50': math.nan, 'p95': math.nan, 'p99': math.nan, 'p999': math.nan, 'max': math.nan}
+    p50, p95, p99, p999 = np.percentile(samples, [50, 95, 99, 99.9])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'p999': float(p999), 'max': float(samples.max())}
+
+
+# Step the target rate up until the system saturates; returns every run's summary.
+# Balances aren't reset between steps, so keep the population large relative to the load.
+async def sweep(dp: DataProcessor, customers, merchants, rates, duration=DURATION, profile='poisson',
+                max_in_flight=MAX_IN_FLIGHT, seed=None):
+    results = []
+    for i, rate in enumerate(rates):
+        run_seed = None if seed is None else seed + i
+        summary = await LoadGenerator(dp, customers, merchants, rate, duration, profile, max_in_flight, run_seed).run()
+        results.append(summary)
+        if summary['saturated']:
+            logger.info(f"Sweep: saturation between {rates[i - 1] if i else 0} and {rate} tx/s target")
+            break
+    return results
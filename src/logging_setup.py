@@ -1,12 +1,116 @@
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
 
 
-def setup_logger():
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler("app.log"),
-            logging.StreamHandler()
-        ]
-    )
+# Verbosity profiles
+#   level            root level
+#   sample_every     hot-path messages (logged with extra={'sample': key}): log the 1st and every Nth
+#                    per key, 0 = none
+#   summary_interval seconds between aggregate "key: N events" lines for sampled keys
+PROFILES = {
+    'debug': {'level': logging.DEBUG, 'sample_every': 1, 'summary_interval': 60.0},
+    'default': {'level': logging.INFO, 'sample_every': 1000, 'summary_interval': 30.0},
+    'bench': {'level': logging.WARNING, 'sample_every': 0, 'summary_interval': 60.0},
+}
+DEFAULT_PROFILE = 'default'
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_listener = None
+_sampler = None
+_atexit_registered = False
+
+
+# Rate-limits per-entity hot-path messages and replaces them with periodic per-key summaries.
+# Attached to the QueueHandler, so dropped records never reach the queue or the writer thread.
+class SamplingFilter(logging.Filter):
+    def __init__(self, handler, sample_every, summary_interval):
+        super().__init__()
+        self.handler = handler
+        self.sample_every = sample_every
+        self.summary_interval = summary_interval
+        self.counts = {}
+        self.logged = {}
+        self.next_summary = time.monotonic() + summary_interval
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'sample', None)
+        if key is None:
+            return True
+        with self.lock:
+            n = self.counts.get(key, 0) + 1
+            self.counts[key] = n
+            keep = self.sample_every > 0 and (n - 1) % self.sample_every == 0
+            if keep:
+                self.logged[key] = self.logged.get(key, 0) + 1
+            due = time.monotonic() >= self.next_summary
+        if due:
+            self.summarize()
+        return keep
+
+    def summarize(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+            logged, self.logged = self.logged, {}
+            self.next_summary = time.monotonic() + self.summary_interval
+        for key, n in sorted(counts.items()):
+            record = logging.LogRecord('summary', logging.INFO, __file__, 0,
+                                       f"{key}: {n} events ({logged.get(key, 0)} logged)", None, None)
+            self.handler.handle(record)
+
+
+# Logging goes through a QueueHandler; file and console writes happen on the QueueListener thread,
+# off the event loop. profile is one of PROFILES (default: $LOG_PROFILE or 'default').
+def setup_logger(profile=None, log_file="app.log"):
+    global _listener, _sampler, _atexit_registered
+    profile = profile or os.getenv('LOG_PROFILE', DEFAULT_PROFILE)
+    settings = PROFILES[profile]
+
+    stop_logger()
+
+    formatter = logging.Formatter(FORMAT)
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(formatter)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    sampler = SamplingFilter(queue_handler, settings['sample_every'], settings['summary_interval'])
+    queue_handler.addFilter(sampler)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(settings['level'])
+
+    _sampler = sampler
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+    # once per process, however many times the logger is set up again
+    if not _atexit_registered:
+        atexit.register(stop_logger)
+        _atexit_registered = True
+    return _listener
+
+
+# Last summary, then drain the queue and join the writer thread. Safe to call more than once
+# (QueueListener.stop() isn't: on 3.11 a second call fails on the joined thread). Processes that
+# leave through os._exit (pool workers) skip atexit and have to call this themselves.
+def stop_logger():
+    global _listener, _sampler
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    sampler, _sampler = _sampler, None
+    sampler.summarize()
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import logging
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from src.data_layer.processor import DataProcessor, as_utc
+
+
+logger = logging.getLogger(__name__)
+
+# Constants
+BATCH_SIZE = 1000
+DAYS_PER_WEEK = 7
+
+TX = 0
+CALLBACK = 1
+
+
+# Discrete-event simulation clock.
+# Events sit in a heap ordered by simulated timestamp and are replayed in time order without any
+# wall-clock sleeps. Transactions are stamped with their simulated time in history and applied in
+# batches; a batch never spans a day boundary, so day hooks (and week hooks every 7th day, counted
+# from the start date) see exactly the payments that happened before them.
+# Hooks are async callables taking the boundary time: hook(at).
+class SimEngine:
+    def __init__(self, dp: DataProcessor, start, batch_size=BATCH_SIZE):
+        self.dp = dp
+        self.now = as_utc(start)
+        self.batch_size = batch_size
+        self.next_day = self.now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        self.days = 0
+        self.accepted = 0
+        self.rejected = 0
+        self._heap = []
+        self._seq = itertools.count()
+        self._day_hooks = []
+        self._week_hooks = []
+
+    def on_day(self, hook):
+        self._day_hooks.append(hook)
+
+    def on_week(self, hook):
+        self._week_hooks.append(hook)
+
+    def schedule(self, at, customer_id, merchant_id, amount):
+        heapq.heappush(self._heap, (as_utc(at), next(self._seq), TX, (customer_id, merchant_id, amount)))
+
+    # Transaction dicts with a 'date' (or 'time') key, as produced by the generators.
+    # Bulk variant: extend then heapify once instead of pushing one by one.
+    def schedule_many(self, transactions):
+        for tx in transactions:
+            self._heap.append((as_utc(tx.get('date') or tx.get('time')), next(self._seq), TX,
+                               (tx['customer_id'], tx['merchant_id'], tx['amount'])))
+        heapq.heapify(self._heap)
+
+    # Arbitrary one-off event: await callback(at) at simulated time `at`
+    def schedule_callback(self, at, callback):
+        heapq.heappush(self._heap, (as_utc(at), next(self._seq), CALLBACK, callback))
+
+    # Resumable position: clock, days elapsed (keeps week hooks aligned) and running totals.
+    # Take it from a week hook (registered last) so no boundary hook is left to run.
+    def state(self):
+        return {'now': self.now.isoformat(), 'next_day': self.next_day.isoformat(), 'days': self.days,
+                'accepted': self.accepted, 'rejected': self.rejected}
+
+    def restore(self, state):
+        self.now = datetime.fromisoformat(state['now'])
+        self.next_day = datetime.fromisoformat(state['next_day'])
+        self.days = state['days']
+        self.accepted = state['accepted']
+        self.rejected = state['rejected']
+
+    # Transactions still queued, as columns in the generators' layout (see src/generator.py)
+    def pending(self):
+        txs = sorted(e for e in self._heap if e[2] == TX)
+        return {
+            'customer_id': np.array([e[3][0] for e in txs], dtype=str),
+            'merchant_id': np.array([e[3][1] for e in txs], dtype=str),
+            'amount': np.array([e[3][2] for e in txs], dtype=np.float64),
+            'date': np.array([e[0].replace(tzinfo=None) for e in txs], dtype='datetime64[us]'),
+        }
+
+    async def run(self, until=None):
+        until = as_utc(until)
+        started = time.perf_counter()
+        processed = 0
+        batch = []
+        while self._heap:
+            at = self._heap[0][0]
+            if until is not None and at >= until:
+                break
+            if at >= self.next_day:
+                await self._apply(batch)
+                await self._close_day()
+                continue
+
+            at, _, kind, payload = heapq.heappop(self._heap)
+            self.now = at
+            processed += 1
+            if kind == TX:
+                customer_id, merchant_id, amount = payload
+                batch.append({'customer_id': customer_id, 'merchant_id': merchant_id, 'amount': amount, 'time': at})
+                if len(batch) >= self.batch_size:
+                    await self._apply(batch)
+            else:
+                await self._apply(batch)
+                await payload(at)
+        await self._apply(batch)
+
+        # fire the remaining boundaries up to the end of the simulated period
+        while until is not None and self.next_day <= until:
+            await self._close_day()
+
+        elapsed = time.perf_counter() - started
+        logger.info(f"Simulated {processed} events over {self.days} days in {elapsed:.1f}s "
+                    f"({self.accepted} accepted, {self.rejected} rejected)")
+        return {'events': processed, 'days': self.days, 'accepted': self.accepted,
+                'rejected': self.rejected, 'elapsed': elapsed}
+
+    async def _apply(self, batch):
+        if not batch:
+            return
+        results = await self.dp.make_transactions_batch(batch)
+        ok = sum(results)
+        self.accepted += ok
+        self.rejected += len(results) - ok
+        batch.clear()
+
+    async def _close_day(self):
+        self.now = self.next_day
+        self.next_day += timedelta(days=1)
+        self.days += 1
+        for hook in self._day_hooks:
+            await hook(self.now)
+        if self.days % DAYS_PER_WEEK == 0:
+            for hook in self._week_hooks:
+                await hook(self.now)
@@ -0,0 +1,75 @@
+import logging
+from datetime import datetime
+
+import numpy as np
+
+from src.generator import (BEHAVIOR_MULTIPLIER, CATEGORIES, CATEGORY_WEIGHTS, TransactionGenerator,
+                           generate_customers, generate_merchants, to_records)
+
+logger = logging.getLogger(__name__)
+
+START_DATE = datetime(2025, 1, 1)
+END_DATE = datetime(2025, 3, 31)
+N = 200000
+
+
+# Transaction generator, no database: same seed -> same stream, and the drawn categories, merchants,
+# amounts and dates follow the heuristics it replaced (per-group category weights, amount around the
+# merchant's base scaled by behavior, dates inside the window).
+class Test10:
+    def testing(self):
+        try:
+            customers = generate_customers(300, seed=5)
+            merchants = generate_merchants(40, seed=5)
+            assert customers == generate_customers(300, seed=5)
+            assert merchants == generate_merchants(40, seed=5)
+            assert generate_customers(2, seed=5, offset=10)[1]['id'] == 'c12'
+
+            a = TransactionGenerator(customers, merchants, START_DATE, END_DATE, seed=11).generate(1000)
+            b = TransactionGenerator(customers, merchants, START_DATE, END_DATE, seed=11).generate(1000)
+            c = TransactionGenerator(customers, merchants, START_DATE, END_DATE, seed=12).generate(1000)
+            assert all(np.array_equal(a[k], b[k]) for k in a)
+            assert not np.array_equal(a['amount'], c['amount'])
+
+            gen = TransactionGenerator(customers, merchants, START_DATE, END_DATE, seed=3)
+            cols = gen.generate(N)
+            cust = {c['id']: c for c in customers}
+            merch = {m['merchant_id']: m for m in merchants}
+
+            # category shares per customer group
+            group = np.array([0 if cust[c]['salary'] > 120000 else 1 if cust[c]['age'] < 30 else 2
+                              for c in cols['customer_id'].tolist()])
+            cat = np.array([CATEGORIES.index(merch[m]['category']) for m in cols['merchant_id'].tolist()])
+            for g in range(3):
+                share = np.bincount(cat[group == g], minlength=len(CATEGORIES)) / (group == g).sum()
+                assert np.abs(share - CATEGORY_WEIGHTS[g]).max() < 0.02, (g, share)
+
+            # amount = merchant base * behavior multiplier * U(0.8, 1.2), rounded to cents
+            base = np.array([merch[m]['acc_balance'] / 100 * BEHAVIOR_MULTIPLIER[cust[c]['behavior']]
+                             for c, m in zip(cols['customer_id'].tolist(), cols['merchant_id'].tolist())])
+            assert np.all(cols['amount'] >= np.round(base * 0.8, 2) - 0.01)
+            assert np.all(cols['amount'] <= np.round(base * 1.2, 2) + 0.01)
+
+            assert cols['date'].min() >= np.datetime64(START_DATE, 's')
+            assert cols['date'].max() < np.datetime64(END_DATE, 's')
+            assert len(set(cols['customer_id'].tolist())) == len(customers)
+
+            # chunked streaming yields the requested total; records keep the columns
+            assert sum(len(ch['amount']) for ch in gen.chunks(2500, chunk_size=1000)) == 2500
+            records = to_records(gen.generate(3))
+            assert len(records) == 3 and set(records[0]) == {'customer_id', 'merchant_id', 'amount', 'date'}
+
+            # categories without merchants are renormalized away
+            tech_only = [dict(m, category='Tech') for m in merchants]
+            cols = TransactionGenerator(customers, tech_only, START_DATE, END_DATE, seed=1).generate(100)
+            assert len(cols['merchant_id']) == 100
+
+            logger.info("Test10.testing(): all checks passed")
+        except Exception as e:
+            logger.error(f"Issue found: {e}")
+            raise
+
+
+if __name__ == "__main__":
+    test = Test10()
+    test.testing()
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import random
+import zlib
+
+from src.data_layer.scheduler import TransactionScheduler
+
+logger = logging.getLogger(__name__)
+
+
+# Stands in for DataProcessor: records the order payments are applied in and how many of one
+# customer's payments are running at once; each payment yields to the loop a random number of times
+class _Processor:
+    max_size = 4
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.applied = []
+        self.running = {}
+        self.overlap = 0
+        self.batches = 0
+
+    async def _apply(self, customer_id, merchant_id, amount):
+        self.running[customer_id] = self.running.get(customer_id, 0) + 1
+        self.overlap = max(self.overlap, self.running[customer_id])
+        for _ in range(self.rng.randint(0, 3)):
+            await asyncio.sleep(0)
+        self.running[customer_id] -= 1
+        if merchant_id == 'm_broken':
+            raise RuntimeError("payment failed")
+        self.applied.append((customer_id, amount))
+        return amount < 100
+
+    async def make_transaction(self, customer_id, merchant_id, amount):
+        return await self._apply(customer_id, merchant_id, amount)
+
+    async def make_transactions_batch(self, txs):
+        self.batches += 1
+        return [await self._apply(tx['customer_id'], tx['merchant_id'], tx['amount']) for tx in txs]
+
+
+# Scheduler, no database: one customer's payments apply in submit order and never overlap, shards
+# are crc32-stable, batch mode groups queued payments, and failures are counted rather than lost.
+class Test11:
+    def testing(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        try:
+            rng = random.Random(6)
+            dp = _Processor(rng)
+            txs = [{'customer_id': f'c{rng.randint(0, 20)}', 'merchant_id': 'm1', 'amount': i} for i in range(300)]
+
+            sched = TransactionScheduler(dp)
+            assert sched.workers == dp.max_size
+            assert sched.shard('c7') == zlib.crc32(b'c7') % 4
+            assert {sched.shard(f'c{i}') for i in range(100)} == set(range(4))
+            counts = await sched.run(txs)
+            assert counts == {'accepted': 100, 'rejected': 200, 'errors': 0}
+            assert dp.overlap == 1
+            for cust in {tx['customer_id'] for tx in txs}:
+                applied = [a for c, a in dp.applied if c == cust]
+                assert applied == [tx['amount'] for tx in txs if tx['customer_id'] == cust], cust
+
+            # batch mode: queued payments for a shard go through as batches, order still kept
+            dp = _Processor(rng)
+            sched = TransactionScheduler(dp, workers=2, batch_size=16)
+            counts = await sched.run(txs)
+            assert counts['accepted'] + counts['rejected'] == len(txs)
+            assert dp.batches < len(txs)
+            for cust in {tx['customer_id'] for tx in txs}:
+                assert [a for c, a in dp.applied if c == cust] == [tx['amount'] for tx in txs if tx['customer_id'] == cust]
+
+            # a failing payment is counted as an error, the worker keeps going
+            dp = _Processor(rng)
+            sched = TransactionScheduler(dp, workers=1)
+            counts = await sched.run([{'customer_id': 'c1', 'merchant_id': 'm_broken', 'amount': 1},
+                                      {'customer_id': 'c1', 'merchant_id': 'm1', 'amount': 2}])
+            assert counts == {'accepted': 1, 'rejected': 0, 'errors': 1}
+            assert sched._tasks == []
+
+            logger.info("Test11.testing(): all checks passed")
+        except Exception as e:
+            logger.error(f"Issue found: {e}")
+            raise
+
+
+if __name__ == "__main__":
+    test = Test11()
+    test.testing()
@@ -0,0 +1,90 @@
+import atexit
+import logging
+import os
+import tempfile
+
+from src import logging_setup
+from src.logging_setup import PROFILES, SamplingFilter, setup_logger, stop_logger
+
+logger = logging.getLogger(__name__)
+
+
+# Collects what the filter lets through plus the summary records it emits
+class _Handler:
+    def __init__(self):
+        self.records = []
+
+    def handle(self, record):
+        self.records.append(record)
+
+
+def _record(msg, sample=None):
+    record = logging.LogRecord('hot', logging.INFO, __file__, 0, msg, None, None)
+    if sample is not None:
+        record.sample = sample
+    return record
+
+
+# Logging setup, no database: each profile's sampling rate, per key; unsampled records always pass;
+# summaries report every event; setting up again / stopping twice is harmless and atexit is
+# registered once.
+class Test12:
+    def testing(self):
+        try:
+            for name, settings in PROFILES.items():
+                every = settings['sample_every']
+                handler = _Handler()
+                sampler = SamplingFilter(handler, every, 3600.0)
+                kept = [sampler.filter(_record(f"payment {i}", 'payment')) for i in range(2500)]
+                expected = [every > 0 and i % every == 0 for i in range(2500)]
+                assert kept == expected, name
+                assert sampler.filter(_record("not sampled"))
+                assert sum(sampler.filter(_record("other", 'reject')) for _ in range(3)) == (1 if every > 1 else 3 if every else 0)
+                sampler.summarize()
+                lines = sorted(r.getMessage() for r in handler.records)
+                assert lines == [f"payment: 2500 events ({sum(expected)} logged)",
+                                 f"reject: 3 events ({1 if every > 1 else 3 if every else 0} logged)"], name
+                sampler.summarize()
+                assert len(handler.records) == 2   # counts restart after a summary
+
+            # a due summary goes out with the record that crosses the interval
+            handler = _Handler()
+            sampler = SamplingFilter(handler, 10, 0.0)
+            assert sampler.filter(_record("first", 'payment'))
+            assert [r.getMessage() for r in handler.records] == ["payment: 1 events (1 logged)"]
+
+            registered = []
+            register = atexit.register
+            atexit.register = registered.append
+            root = logging.getLogger()
+            handlers, level = root.handlers[:], root.level
+            try:
+                with tempfile.TemporaryDirectory() as tmp:
+                    log_file = os.path.join(tmp, 'app.log')
+                    setup_logger('default', log_file)
+                    setup_logger('bench', log_file)
+                    assert root.level == logging.WARNING
+                    logging.getLogger('bench').warning("written by the listener thread")
+                    stop_logger()
+                    stop_logger()   # what atexit does after an explicit stop
+                    assert logging_setup._listener is None
+                    with open(log_file) as f:
+                        assert "written by the listener thread" in f.read()
+                    assert registered.count(stop_logger) <= 1
+            finally:
+                atexit.register = register
+                for handler in root.handlers[:]:
+                    root.removeHandler(handler)
+                for handler in handlers:
+                    root.addHandler(handler)
+                root.setLevel(level)
+
+            logger.info("Test12.testing(): all checks passed")
+        except Exception as e:
+            logger.error(f"Issue found: {e}")
+            raise
+
+
+if __name__ == "__main__":
+    test = Test12()
+    test.testing()
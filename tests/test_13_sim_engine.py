@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from src.sim_engine import SimEngine
+
+logger = logging.getLogger(__name__)
+
+START = datetime(2025, 1, 1, 6, tzinfo=timezone.utc)
+
+
+# Stands in for DataProcessor: logs each batch into the shared event log; payments of 100 or more
+# are rejected
+class _Processor:
+    def __init__(self, log):
+        self.log = log
+
+    async def make_transactions_batch(self, txs):
+        self.log.append(('batch', [tx['time'] for tx in txs]))
+        return [tx['amount'] < 100 for tx in txs]
+
+
+# Simulation clock, no database: payments replay in time order in batches that never cross a day,
+# day hooks then week hooks (every 7th day) fire at each boundary after that day's payments,
+# callbacks see everything before them applied, and state()/pending() resume where it stopped.
+class Test13:
+    def testing(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        try:
+            log = []
+            sim = SimEngine(_Processor(log), START, batch_size=3)
+
+            async def day(at):
+                log.append(('day', at))
+
+            async def week(at):
+                log.append(('week', at))
+
+            async def callback(at):
+                log.append(('callback', at))
+
+            sim.on_day(day)
+            sim.on_week(week)
+            # 10 days, 4 payments a day, scheduled out of order; one callback mid-day 3
+            times = [START + timedelta(days=d, hours=h) for d in range(10) for h in (0, 3, 6, 9)]
+            sim.schedule_many([{'customer_id': 'c1', 'merchant_id': 'm1', 'amount': 10 if i % 4 else 150,
+                                'date': at.replace(tzinfo=None)} for i, at in reversed(list(enumerate(times)))])
+            sim.schedule_callback(START + timedelta(days=2, hours=4), callback)
+            until = START.replace(hour=0) + timedelta(days=8)
+            summary = await sim.run(until=until)
+
+            # boundaries: 8 day hooks, the week hook right after the 7th
+            midnights = [START.replace(hour=0) + timedelta(days=d) for d in range(1, 9)]
+            assert [at for kind, at in log if kind == 'day'] == midnights
+            assert [at for kind, at in log if kind == 'week'] == [midnights[6]]
+            assert log[log.index(('day', midnights[6])) + 1] == ('week', midnights[6])
+            assert summary['days'] == 8 and sim.days == 8 and sim.now == until
+
+            # every payment before `until`, in time order, batches of at most 3 within one day,
+            # each day's batches before that day's hook
+            applied = [at for kind, ats in log if kind == 'batch' for at in ats]
+            assert applied == [at for at in times if at < until]
+            for i, (kind, ats) in enumerate(log):
+                if kind != 'batch':
+                    continue
+                assert 1 <= len(ats) <= 3 and len({at.date() for at in ats}) == 1
+                boundary = next(e for e in log[i:] if e[0] == 'day')
+                assert max(ats) < boundary[1]
+            # the callback comes after the payments before it, ahead of the ones after it
+            k = log.index(('callback', START + timedelta(days=2, hours=4)))
+            assert log[k - 1][1][-1] == START + timedelta(days=2, hours=3)
+            assert log[k + 1][1][0] == START + timedelta(days=2, hours=6)
+            assert (summary['accepted'], summary['rejected']) == (24, 8)
+
+            # resume: state plus pending transactions continue the same run in a fresh engine
+            pending = sim.pending()
+            assert len(pending['amount']) == 8
+            resumed = SimEngine(_Processor(log), START, batch_size=3)
+            resumed.restore(sim.state())
+            resumed.on_day(day)
+            resumed.on_week(week)
+            resumed.schedule_many([{'customer_id': c, 'merchant_id': m, 'amount': a, 'date': d}
+                                   for c, m, a, d in zip(pending['customer_id'].tolist(), pending['merchant_id'].tolist(),
+                                                         pending['amount'].tolist(), pending['date'].tolist())])
+            del log[:]
+            summary = await resumed.run(until=START.replace(hour=0) + timedelta(days=14))
+            assert [at for kind, ats in log if kind == 'batch' for at in ats] == times[-8:]
+            assert [at for kind, at in log if kind == 'week'] == [START.replace(hour=0) + timedelta(days=14)]
+            assert summary['days'] == 14 and summary['accepted'] == 30 and summary['rejected'] == 10
+
+            logger.info("Test13.testing(): all checks passed")
+        except Exception as e:
+            logger.error(f"Issue found: {e}")
+            raise
+
+
+if __name__ == "__main__":
+    test = Test13()
+    test.testing()
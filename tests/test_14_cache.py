@@ -0,0 +1,110 @@
+import logging
+
+from src.data_layer.cache import BalanceCache, ResultCache
+
+logger = logging.getLogger(__name__)
+
+
+# Caches, no database. BalanceCache only ever holds a committed balance no older than this
+# process's last write: fills that raced a write are refused, overlapping writes drop the entry
+# instead of guessing their commit order, and clear() wins over writes already in flight.
+# ResultCache serves an entry exactly while its version holds, then only within ttl and max_lag.
+class Test14:
+    def testing(self):
+        try:
+            cache = BalanceCache(max_size=3)
+
+            # miss, fill, hit
+            assert cache.get('c1') is None
+            cache.fill('c1', 100, cache.generation)
+            assert cache.get('c1') == 100
+            assert (cache.hits, cache.misses) == (1, 1)
+
+            # a read that started before a write can't fill after it
+            gen = cache.generation
+            cache.begin(['c2'])
+            cache.fill('c2', 50, gen)
+            cache.end({'c2': 40})
+            cache.fill('c2', 50, gen)
+            assert cache.get('c2') == 40
+
+            # nor during one, even with a fresh generation
+            cache.begin(['c3'])
+            cache.fill('c3', 70, cache.generation)
+            assert cache.get('c3') is None
+            cache.end({'c3': 60})
+            assert cache.get('c3') == 60
+
+            # overlapping writes to one customer: neither result is stored
+            cache.begin(['c1'])
+            cache.begin(['c1'])
+            cache.end({'c1': 90})
+            cache.end({'c1': 80})
+            assert cache.get('c1') is None
+            cache.begin(['c1'])
+            cache.end({'c1': 75})
+            assert cache.get('c1') == 75   # the overlap is forgotten once both are done
+
+            # failed write: outcome unknown, entry dropped
+            cache.begin(['c2'])
+            cache.end({'c2': None})
+            assert cache.get('c2') is None
+
+            # clear() while a write is in flight: that write doesn't store what it saw
+            cache.begin(['c3'])
+            cache.clear()
+            cache.end({'c3': 10})
+            assert len(cache) == 0 and cache.get('c3') is None
+
+            # invalidate bumps the generation, so an older read can't fill it back
+            cache.fill('c4', 5, cache.generation)
+            gen = cache.generation
+            cache.invalidate('c4')
+            cache.fill('c4', 5, gen)
+            assert cache.get('c4') is None
+
+            # bounded LRU
+            for key in ('a', 'b', 'c'):
+                cache.fill(key, 1, cache.generation)
+            cache.get('a')
+            cache.fill('d', 1, cache.generation)
+            assert cache.get('b') is None and cache.get('a') == 1 and len(cache) == 3
+            assert cache.snapshot()['size'] == 3
+
+            results = ResultCache(max_size=2, ttl=5.0, max_lag=10)
+            assert results.get('q', 1) == (False, None)
+            results.put('q', [1], 1)
+            assert results.get('q', 1) == (True, [1])
+            assert results.get('q', 10) == (True, [1])    # 9 versions behind, within ttl
+            assert results.get('q', 11) == (False, None)  # too far behind: dropped
+            assert results.get('q', 1) == (False, None)
+
+            # past the ttl only the exact version is served (stored_at pushed back instead of sleeping)
+            results.put('q', [2], 20)
+            value, version, stored_at = results._data['q']
+            results._data['q'] = (value, version, stored_at - 6.0)
+            assert results.get('q', 20) == (True, [2])
+            assert results.get('q', 21) == (False, None)
+
+            exact = ResultCache(max_lag=0)
+            exact.put('q', [3], 5)
+            assert exact.get('q', 6) == (False, None)
+
+            results.put('a', 1, 1)
+            results.put('b', 2, 1)
+            results.get('a', 1)
+            results.put('c', 3, 1)
+            assert results.get('b', 1) == (False, None) and results.get('a', 1) == (True, 1) and len(results) == 2
+            results.clear()
+            assert len(results) == 0
+            assert results.snapshot()['hits'] == results.hits
+
+            logger.info("Test14.testing(): all checks passed")
+        except Exception as e:
+            logger.error(f"Issue found: {e}")
+            raise
+
+
+if __name__ == "__main__":
+    test = Test14()
+    test.testing()
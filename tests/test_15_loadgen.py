@@ -0,0 +1,82 @@
+import asyncio
+import logging
+
+import numpy as np
+
+from src.data_layer.instrumentation import Stats
+from src.generator import generate_customers, generate_merchants
+from src.loadgen import (BURST_FACTOR, BURST_ON, BURST_PERIOD, PAYDAY_PERIOD, PROFILES, LoadGenerator,
+                         arrival_times, peak_rate, rate_at)
+
+logger = logging.getLogger(__name__)
+
+RATE = 500
+DURATION = 60.0
+
+
+# Stands in for DataProcessor: every 10th payment fails, every 3rd is rejected
+class _Processor:
+    def __init__(self):
+        self.stats = Stats()
+        self.calls = 0
+
+    async def make_transaction(self, customer_id, merchant_id, amount):
+        self.calls += 1
+        call = self.calls
+        await asyncio.sleep(0)
+        if call % 10 == 0:
+            raise RuntimeError("payment failed")
+        return call % 3 != 0
+
+
+# Open-loop load generator, no database: every profile averages to the target rate and stays under
+# its peak, thinning reproduces the profile's shape and size, and a run reports throughput from the
+# payments that completed, not the ones offered.
+class Test15:
+    def testing(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        try:
+            t = np.linspace(0.0, DURATION, 600001)[:-1]
+            for profile in PROFILES:
+                rates = rate_at(profile, RATE, t, DURATION)
+                assert abs(rates.mean() - RATE) < RATE * 1e-3, profile
+                assert rates.max() <= peak_rate(profile, RATE) + 1e-9 and rates.min() >= 0, profile
+
+                rng = np.random.default_rng(23)
+                arrivals = arrival_times(profile, RATE, DURATION, rng)
+                assert np.all(np.diff(arrivals) >= 0) and arrivals[0] >= 0 and arrivals[-1] < DURATION
+                # Poisson count: sd sqrt(RATE * DURATION) ~ 173
+                assert abs(len(arrivals) - RATE * DURATION) < 5 * np.sqrt(RATE * DURATION), (profile, len(arrivals))
+                assert np.array_equal(arrivals, arrival_times(profile, RATE, DURATION, np.random.default_rng(23)))
+
+            # bursty: BURST_FACTOR x the target inside bursts
+            arrivals = arrival_times('bursty', RATE, DURATION, np.random.default_rng(1))
+            in_burst = (arrivals % BURST_PERIOD < BURST_ON).sum() / (DURATION / BURST_PERIOD * BURST_ON)
+            assert abs(in_burst / RATE - BURST_FACTOR) < 0.1
+            # diurnal: quiet start, busy middle
+            arrivals = arrival_times('diurnal', RATE, DURATION, np.random.default_rng(2))
+            assert (arrivals < 6).sum() * 3 < ((arrivals >= 27) & (arrivals < 33)).sum()
+            assert len(arrival_times('payday', RATE, PAYDAY_PERIOD, np.random.default_rng(3))) > 0
+
+            # a short run: achieved throughput counts decided payments only
+            dp = _Processor()
+            gen = LoadGenerator(dp, generate_customers(50, seed=1), generate_merchants(10, seed=1),
+                                target_tps=400, duration=0.5, max_in_flight=8, seed=4)
+            summary = await gen.run()
+            assert summary['accepted'] + summary['rejected'] + summary['errors'] == summary['offered'] == dp.calls
+            assert summary['errors'] == dp.calls // 10 > 0
+            assert summary['completed'] == summary['accepted'] + summary['rejected']
+            assert summary['achieved_tps'] == summary['completed'] / summary['elapsed']
+            assert summary['latency_ms']['p50'] >= 0 and not summary['saturated']
+
+            logger.info("Test15.testing(): all checks passed")
+        except Exception as e:
+            logger.error(f"Issue found: {e}")
+            raise
+
+
+if __name__ == "__main__":
+    test = Test15()
+    test.testing()
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+from benchmarks.local_pg import LocalPostgres
+from src.data_layer.checkpoint import Checkpointer, load_table, read_history, read_manifest
+from src.data_layer.money import SCALE
+from src.data_layer.processor import DataProcessor
+from src.incentive import IncentiveEngine
+
+logger = logging.getLogger(__name__)
+
+
+# Checkpoint round trip in a throwaway local cluster: save() writes .npy columns that load_table /
+# read_history read back without a database (money as int64 minor units, NULL masks for the
+# incentive rows' missing merchant), and restore() puts the database back as it was at save time,
+# with the caller's state and stream arrays.
+class Test16:
+    def testing(self):
+        pg = LocalPostgres()
+        try:
+            pg.start()
+        except RuntimeError as e:
+            pg.stop()
+            pytest.skip(f"needs a local PostgreSQL: {e}")
+        try:
+            asyncio.run(self.run(pg.dsn))
+        finally:
+            pg.stop()
+
+    async def run(self, dsn):
+        dp = DataProcessor(dsn=dsn)
+        await dp.init()
+        try:
+            await dp.save_customers_bulk([{'id': f'c{i}', 'name_full': f'C{i}', 'acc_balance': 100 + i} for i in range(3)])
+            await dp.save_merchants_bulk([{'merchant_id': 'm1', 'category': 'Tech', 'acc_balance': 10}])
+            at = datetime(2025, 2, 3, 12, tzinfo=timezone.utc)
+            results = await dp.make_transactions_batch([
+                {'customer_id': 'c0', 'merchant_id': 'm1', 'amount': 12.34, 'time': at},
+                {'customer_id': 'c1', 'merchant_id': 'm1', 'amount': 500, 'time': at + timedelta(hours=1)},
+                {'customer_id': 'c2', 'merchant_id': 'm1', 'amount': 0.01, 'time': at + timedelta(days=1)},
+            ])
+            assert results == [True, False, True]
+            await IncentiveEngine(dp).run_cycle(at + timedelta(days=7))
+            await dp.metrics.flush()
+
+            balances = {c: await dp.balance_query(c) for c in ('c0', 'c1', 'c2')}
+            history = sorted((r['time'], r['customer_id'], r['merchant_id'], r['amount'], r['is_rejected'])
+                             for r in await dp.get_historical_data())
+            async with dp.pool.acquire() as conn:
+                daily = [tuple(r) for r in await conn.fetch('SELECT * FROM cust_daily ORDER BY customer_id, day')]
+
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'ckpt')
+                stream = {'amount': np.array([1.5, 2.5]), 'customer_id': np.array(['c1', 'c2'])}
+                await Checkpointer(dp, chunk_rows=2).save(path, {'week': 1}, stream)
+                assert not os.path.exists(path + '.tmp')
+
+                # offline readers
+                manifest = read_manifest(path)
+                assert manifest['tables']['history']['rows'] == len(history)
+                customers = load_table(path, 'customers')
+                assert customers['customer_id'].tolist() == ['c0', 'c1', 'c2']
+                assert [Decimal(int(v)) / SCALE for v in customers['acc_balance']] == list(balances.values())
+                columns = load_table(path, 'history')
+                assert np.all(np.diff(columns['time']) >= np.timedelta64(0))   # chronological
+                frame = read_history(path, as_frame=True)
+                assert len(frame) == len(history)
+                assert sorted(frame['amount'].round(4).tolist()) == sorted(float(h[3]) for h in history)
+                assert frame['merchant_id'].isna().sum() == sum(h[2] is None for h in history) > 0
+
+                # changes after the save are undone by restore
+                assert await dp.make_transaction('c0', 'm1', 1)
+                await dp.save_customer({'id': 'c_new', 'name_full': 'New', 'acc_balance': 5})
+                manifest, arrays = await Checkpointer(dp, chunk_rows=2).restore(path)
+                assert manifest['state'] == {'week': 1}
+                assert np.array_equal(arrays['amount'], stream['amount'])
+                assert arrays['customer_id'].tolist() == ['c1', 'c2']
+
+            assert {c: await dp.balance_query(c) for c in ('c0', 'c1', 'c2')} == balances
+            assert await dp.balance_query('c_new') is None
+            assert sorted((r['time'], r['customer_id'], r['merchant_id'], r['amount'], r['is_rejected'])
+                          for r in await dp.get_historical_data()) == history
+            async with dp.pool.acquire() as conn:
+                assert [tuple(r) for r in await conn.fetch('SELECT * FROM cust_daily ORDER BY customer_id, day')] == daily
+            # the rollup trigger is back on after the restore
+            assert await dp.make_transaction('c2', 'm1', 1, at=at)
+            async with dp.pool.acquire() as conn:
+                assert await conn.fetchval("SELECT tx_count FROM cust_daily WHERE customer_id = 'c2' AND day = $1", at.date()) == 1
+
+            logger.info("Test16.testing(): all checks passed")
+        except Exception as e:
+            logger.error(f"Issue found: {e}")
+            raise
+        finally:
+            await dp.close()
+
+
+if __name__ == "__main__":
+    test = Test16()
+    test.testing()
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import os
+import tempfile
+from datetime import datetime, timezone
+
+import pytest
+
+from benchmarks.local_pg import LocalPostgres
+from src.data_layer.checkpoint import Checkpointer
+from src.data_layer.processor import DataProcessor
+
+logger = logging.getLogger(__name__)
+
+
+# Partitioned history in a throwaway local cluster. init() creates partitions around today, so a
+# replay of past dates (here: resumed from a checkpoint ending in February 2025) writes months older
+# than the newest partition; each of them must still get its own partition instead of history_default,
+# for single payments and for a batch spanning several months.
+class Test17:
+    def testing(self):
+        pg = LocalPostgres()
+        try:
+            pg.start()
+        except RuntimeError as e:
+            pg.stop()
+            pytest.skip(f"needs a local PostgreSQL: {e}")
+        try:
+            asyncio.run(self.run(pg.dsn))
+        finally:
+            pg.stop()
+
+    async def run(self, dsn):
+        dp = DataProcessor(dsn=dsn, partition_history=True)
+        await dp.init()
+        try:
+            assert dp.partition_history
+            await dp.save_customers_bulk([{'id': 'c1', 'name_full': 'C1', 'acc_balance': 1000}])
+            await dp.save_merchants_bulk([{'merchant_id': 'm1', 'category': 'Tech'}])
+            feb = datetime(2025, 2, 10, tzinfo=timezone.utc)
+            await dp.ensure_history_partitions(feb, feb)
+            assert await dp.make_transaction('c1', 'm1', 1, at=feb)
+
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'ckpt')
+                await Checkpointer(dp).save(path)
+                await Checkpointer(dp).restore(path)
+
+            jun = datetime(2025, 6, 15, tzinfo=timezone.utc)
+            assert await dp.make_transaction('c1', 'm1', 1, at=jun)
+            batch = [{'customer_id': 'c1', 'merchant_id': 'm1', 'amount': 1, 'time': datetime(2025, m, 3, tzinfo=timezone.utc)}
+                     for m in (3, 5)]
+            assert all(await dp.make_transactions_batch(batch))
+
+            async with dp.pool.acquire() as conn:
+                rows = await conn.fetch('SELECT tableoid::regclass::text AS part, time FROM history ORDER BY time')
+            assert [(r['part'], r['time'].month) for r in rows] == [
+                ('history_y2025m02', 2), ('history_y2025m03', 3), ('history_y2025m05', 5), ('history_y2025m06', 6)]
+
+            logger.info("Test17.testing(): all checks passed")
+        except Exception as e:
+            logger.error(f"Issue found: {e}")
+            raise
+        finally:
+            await dp.close()
+
+
+if __name__ == "__main__":
+    test = Test17()
+    test.testing()
@@ -1,17 +1,21 @@
 import asyncio
 import logging
 from datetime import datetime
-from src.data_layer.processor import DataProcessor
+from src.data_layer.processor import DataProcessor, get_shared_processor
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 class Test1:
+    # processor: reuse an existing (initialized) processor; default is the process-wide shared one
+    def __init__(self, processor: DataProcessor = None):
+        self.dp = processor
+
     async def testing(self):
         try:
             print("running Test1.testing()")
-            dp = DataProcessor()
-            await dp.init()  # initialize pool + tables
+            dp = self.dp or await get_shared_processor()
+            await dp.init()  # no-op when already initialized
 
             # Save 1 customer
             await dp.save_customer({
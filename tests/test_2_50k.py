@@ -1,12 +1,13 @@
 import asyncio
 import numpy as np
 import pandas as pd
-import random
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
-import uuid
 
 from src.data_layer.processor import DataProcessor
+from src.generator import TransactionGenerator, to_records
+from src.incentive import IncentiveEngine
+from src.sim_engine import SimEngine
 
 logger = logging.getLogger(__name__)
 
@@ -15,20 +16,25 @@ NUM_MERCHANTS = 500
 NUM_TRANSACTIONS = 50000
 START_DATE = datetime(2025, 1, 1)
 END_DATE = datetime(2025, 9, 30)
+CHECKPOINT_WEEKS = 4
 
 class Test2:
 
-    def __init__(self, processor: DataProcessor):
+    # population and transaction counts default to the 50k scenario
+    # checkpoint_dir: save the simulation state there every checkpoint_weeks simulated weeks (run(resume=True) picks it up)
+    # anomaly: score payments with src.anomaly.AnomalyScorer during the replay (needs scikit-learn)
+    def __init__(self, processor: DataProcessor, seed=None, customers=NUM_CUSTOMERS, merchants=NUM_MERCHANTS,
+                 transactions=NUM_TRANSACTIONS, checkpoint_dir=None, checkpoint_weeks=CHECKPOINT_WEEKS, anomaly=False):
         self.dp = processor
-        
-
-    # ------------------- Helpers -------------------
-    def weighted_choice(self, choices, weights, size=1):
-        return np.random.choice(choices, size=size, p=np.array(weights)/np.sum(weights))
-
-    def random_dates(self, start, end, n):
-        delta = end - start
-        return [start + timedelta(seconds=np.random.randint(0, int(delta.total_seconds()))) for _ in range(n)]
+        self.seed = seed
+        self.num_customers = customers
+        self.num_merchants = merchants
+        self.num_transactions = transactions
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_weeks = checkpoint_weeks
+        self.anomaly = anomaly
+        self.scorer = None
+        self.rng_state = None
 
     # ------------------- Generate Customers -------------------
     def generate_customers(self, n):
@@ -69,73 +75,128 @@ class Test2:
         return merchants
 
     # ------------------- Generate Transactions -------------------
-
-
+    # Vectorized, see src/generator.py
     def generate_transactions(self, customers, merchants, num_tx):
-        transactions = []
-        
-        # Build merchant dictionary by category
-        merchant_dict = {}
-        for m in merchants:
-            if m['category'] not in merchant_dict:
-                merchant_dict[m['category']] = []
-            merchant_dict[m['category']].append(m['merchant_id'])
-        
-        #t = True
-        
-        for _ in range(num_tx):
-            # Pick a random customer from the list
-            cust = random.choice(customers)  # cust is a dict
-            
-            # Select merchant category based on heuristics
-            if cust['salary'] > 120000:
-                weights = {'Tech':0.4,'Entertainment':0.3,'Grocery':0.1,'Healthcare':0.1,'Retail':0.1}
-            elif cust['age'] < 30:
-                weights = {'Tech':0.3,'Entertainment':0.4,'Grocery':0.1,'Healthcare':0.1,'Retail':0.1}
-            else:
-                weights = {'Tech':0.2,'Entertainment':0.2,'Grocery':0.3,'Healthcare':0.2,'Retail':0.1}
-
-            category = self.weighted_choice(list(weights.keys()), list(weights.values()))[0]
-            merchant_id = np.random.choice(merchant_dict[category])
-
-            # Transaction amount
-            base = next(m['acc_balance'] for m in merchants if m['merchant_id']==merchant_id)/100
-            multiplier = {'Aggressive': 1.5, 'Moderate': 1.0, 'Conservative': 0.7}[cust['behavior']] #9 means behavior
-            amount = float(np.round(base * multiplier * np.random.uniform(0.8,1.2),2))
-
-            date = self.random_dates(START_DATE, END_DATE, 1)[0]
-
-            transactions.append({
-                'customer_id': cust['id'],
-                'merchant_id': merchant_id,
-                'amount': amount,
-                'date': date
-            })
-        
-        return transactions
+        gen = TransactionGenerator(customers, merchants, START_DATE, END_DATE, seed=self.seed)
+        cols = gen.generate(num_tx)
+        self.rng_state = gen.rng.bit_generator.state
+        return to_records(cols)
 
-    # ------------------- Run Test2 -------------------
-    async def run(self):
+    # ------------------- Seed customers and merchants -------------------
+    async def populate(self):
         logger.info("Generating customers and merchants...")
-        customers = self.generate_customers(NUM_CUSTOMERS)
-        merchants = self.generate_merchants(NUM_MERCHANTS)
-
-        logger.info("Generating transactions...")
-        transactions = self.generate_transactions(customers, merchants, NUM_TRANSACTIONS)
+        if self.seed is not None:
+            np.random.seed(self.seed)
+        customers = self.generate_customers(self.num_customers)
+        merchants = self.generate_merchants(self.num_merchants)
         await self.dp.init()
         # Save all to PostgreSQL via DataProcessor
         logger.info("Saving customers to DB...")
-        for c in customers:
-            await self.dp.save_customer(c)
+        await self.dp.save_customers_bulk(customers)
         logger.info("Saving merchants to DB...")
-        for m in merchants:
-            await self.dp.save_merchant(m)
-        logger.info("Running transactions...")
-        for tx in transactions:
-            await self.dp.make_transaction(tx['customer_id'], tx['merchant_id'], tx['amount'])
-
-        logger.info("Test2 completed: 50k transactions simulated!")
-
-
-
+        await self.dp.save_merchants_bulk(merchants)
+        return customers, merchants
 
+    # ------------------- Run Test2 -------------------
+    # resume: continue from the checkpoint in checkpoint_dir instead of generating a new population
+    async def run(self, resume=False):
+        sim = SimEngine(self.dp, START_DATE)
+        if resume:
+            await self.dp.init()
+            await self.restore(sim)
+            # the restore only covers the months already in the checkpoint
+            await self.dp.ensure_history_partitions(START_DATE, END_DATE)
+            if self.anomaly:
+                await self.start_scoring(sim.now)
+        else:
+            customers, merchants = await self.populate()
+            logger.info("Generating transactions...")
+            transactions = self.generate_transactions(customers, merchants, self.num_transactions)
+            await self.dp.ensure_history_partitions(START_DATE, END_DATE)
+            sim.schedule_many(transactions)
+        logger.info("Running transactions...")
+        # replayed in simulated time: history gets the generated dates, metrics roll over daily/weekly
+        # and the incentive cycle closes every week
+        incentives = IncentiveEngine(self.dp)
+        sim.on_day(self.dp.metrics.close_day)
+        sim.on_week(self.dp.metrics.close_week)
+        sim.on_week(incentives.run_cycle)
+        if self.anomaly:
+            sim.on_week(self.start_scoring)
+        if self.checkpoint_dir:
+            # last week hook, so the checkpoint sees the closed week and the incentive cycle
+            sim.on_week(lambda at: self.checkpoint(sim))
+        try:
+            summary = await sim.run(until=END_DATE)
+        finally:
+            await self.stop_scoring()
+        await self.dp.metrics.flush()
+
+        logger.info(f"Test2 completed: {self.num_transactions} transactions simulated! ({summary['accepted']} accepted, {summary['rejected']} rejected over {summary['days']} simulated days)")
+
+    # ------------------- Anomaly scoring -------------------
+    # The model is fitted on history, so scoring starts at the first week boundary (or right away on
+    # resume, where the restored history is already there); payments before that aren't scored
+    async def start_scoring(self, at):
+        if self.scorer is not None:
+            return
+        from src.anomaly import AnomalyScorer
+
+        scorer = AnomalyScorer(self.dp, seed=self.seed)
+        await scorer.start()
+        self.scorer = scorer
+        logger.info(f"Anomaly scoring started at simulated {at:%Y-%m-%d}")
+
+    async def stop_scoring(self):
+        if self.scorer is None:
+            return
+        await self.scorer.close()
+        self.scorer = None
+        counters = self.dp.stats.counters
+        logger.info(f"Anomaly scoring: {counters.get('anomaly_scored', 0)} scored, {counters.get('anomaly_flagged', 0)} flagged, {counters.get('anomaly_dropped', 0)} dropped")
+
+    # ------------------- Checkpoint / resume -------------------
+    # Database tables plus what's left of the transaction stream, the simulation clock and RNG states
+    async def checkpoint(self, sim):
+        if sim.days % (7 * self.checkpoint_weeks):
+            return
+        from src.data_layer.checkpoint import Checkpointer
+
+        legacy = np.random.get_state()
+        state = {
+            'seed': self.seed,
+            'transactions': self.num_transactions,
+            'sim': sim.state(),
+            'rng': {'numpy': [legacy[0], legacy[1].tolist(), *legacy[2:]], 'generator': self.rng_state},
+        }
+        await Checkpointer(self.dp).save(self.checkpoint_dir, state, sim.pending())
+
+    async def restore(self, sim):
+        from src.data_layer.checkpoint import Checkpointer
+
+        manifest, pending = await Checkpointer(self.dp).restore(self.checkpoint_dir)
+        state = manifest['state']
+        name, keys, *rest = state['rng']['numpy']
+        np.random.set_state((name, np.array(keys, dtype=np.uint32), *rest))
+        self.rng_state = state['rng']['generator']
+        self.num_transactions = state['transactions']
+        sim.restore(state['sim'])
+        sim.schedule_many(to_records(pending))
+        logger.info(f"Resumed at simulated {sim.now:%Y-%m-%d} (day {sim.days}), {len(pending['amount'])} transactions left")
+
+    # ------------------- Open-loop load -------------------
+    # Real time instead of simulated time: payments arrive at target_tps (see src/loadgen.py);
+    # with sweep_to, the target is stepped up from target_tps until the system saturates
+    async def run_load(self, target_tps, duration, profile='poisson', max_in_flight=None, sweep_to=None):
+        from src.loadgen import MAX_IN_FLIGHT, LoadGenerator, sweep
+
+        customers, merchants = await self.populate()
+        max_in_flight = max_in_flight or MAX_IN_FLIGHT
+        if sweep_to:
+            rates = list(range(target_tps, sweep_to + 1, target_tps))
+            results = await sweep(self.dp, customers, merchants, rates, duration, profile, max_in_flight, self.seed)
+        else:
+            results = [await LoadGenerator(self.dp, customers, merchants, target_tps, duration, profile,
+                                           max_in_flight, self.seed).run()]
+        await self.dp.metrics.flush()
+        return results
@@ -0,0 +1,52 @@
+import asyncio
+import logging
+from src.data_layer.processor import DataProcessor
+
+logger = logging.getLogger(__name__)
+
+class Test3:
+    def testing(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        try:
+            dp = DataProcessor()
+            await dp.init()
+
+            await dp.save_customer({'id': 'c_batch', 'name_full': 'Batch', 'acc_balance': 150})
+            await dp.save_merchant({'merchant_id': 'm_batch', 'category': 'Retail', 'acc_balance': 0})
+
+            # second payment can't be covered, third one still can
+            results = await dp.make_transactions_batch([
+                {'customer_id': 'c_batch', 'merchant_id': 'm_batch', 'amount': 100},
+                {'customer_id': 'c_batch', 'merchant_id': 'm_batch', 'amount': 100},
+                {'customer_id': 'c_batch', 'merchant_id': 'm_batch', 'amount': 40},
+                {'customer_id': 'c_missing', 'merchant_id': 'm_batch', 'amount': 1},
+            ])
+            assert results == [True, False, True, False]
+
+            async with dp.pool.acquire() as conn:
+                cust = await conn.fetchval('SELECT acc_balance FROM customers WHERE customer_id=$1', 'c_batch')
+                merch = await conn.fetchval('SELECT acc_balance FROM merchants WHERE merchant_id=$1', 'm_batch')
+                rejected = await conn.fetchval('SELECT COUNT(*) FROM history WHERE customer_id=$1 AND is_rejected', 'c_batch')
+            assert float(cust) == 10.0
+            assert float(merch) == 140.0
+            assert rejected >= 1
+
+            # cached balance follows the batch; a single payment updates it again
+            assert float(await dp.balance_query('c_batch')) == 10.0
+            hits = dp.balances.hits
+            assert await dp.make_transaction('c_batch', 'm_batch', 5)
+            assert float(await dp.balance_query('c_batch')) == 5.0
+            assert dp.balances.hits == hits + 1
+            assert await dp.balance_query('c_missing') is None
+
+            logger.info("Test3.testing(): all checks passed")
+        except Exception as e:
+            logger.error(f"Issue found: {e}")
+            raise
+
+
+if __name__ == "__main__":
+    test = Test3()
+    test.testing()
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+
+import numpy as np
+
+from src.data_layer.ledger import MemoryLedger
+from src.data_layer.money import to_minor
+
+logger = logging.getLogger(__name__)
+
+
+# Records what the ledger hands to the aggregator instead of queueing it
+class _Metrics:
+    def __init__(self):
+        self.items = []
+
+    async def record_many(self, items):
+        self.items.extend(items)
+
+
+class _Scorer:
+    def __init__(self):
+        self.rows = []
+
+    def submit(self, rows):
+        self.rows.extend(rows)
+
+
+# The vectorized round-based path must decide exactly like DataProcessor._apply_batch, which walks
+# the batch in input order: reject when the balance before the payment is below the amount,
+# otherwise debit the customer and credit the merchant. No database needed, the ledger's arrays
+# are set up directly and nothing is synced.
+class Test4:
+    def testing(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        try:
+            rng = np.random.default_rng(7)
+            ledger = MemoryLedger(dsn='postgresql://unused/none')
+            ledger.metrics = _Metrics()
+            ledger.scorer = _Scorer()
+            ledger.cust_ids = [f'c{i}' for i in range(5)]
+            ledger.merch_ids = [f'm{i}' for i in range(3)]
+            ledger.cust_index = {c: i for i, c in enumerate(ledger.cust_ids)}
+            ledger.merch_index = {m: i for i, m in enumerate(ledger.merch_ids)}
+            ledger.cust_bal = np.array([to_minor(v) for v in (100, 50, 0, 1000, 75.5)], dtype=np.int64)
+            ledger.merch_bal = np.zeros(3, dtype=np.int64)
+            ledger._cust_dirty = np.zeros(5, dtype=bool)
+            ledger._merch_dirty = np.zeros(3, dtype=bool)
+
+            # few customers, many payments: every customer repeats several times within the batch
+            txs = [{'customer_id': f'c{rng.integers(0, 5)}', 'merchant_id': f'm{rng.integers(0, 3)}',
+                    'amount': float(rng.integers(1, 80))} for _ in range(200)]
+            txs.append({'customer_id': 'c_missing', 'merchant_id': 'm0', 'amount': 1.0})
+
+            # reference: sequential, as DataProcessor applies a batch
+            cust = {c: int(b) for c, b in zip(ledger.cust_ids, ledger.cust_bal)}
+            merch = {m: 0 for m in ledger.merch_ids}
+            expected = []
+            for tx in txs:
+                amount = to_minor(tx['amount'])
+                b_old = cust.get(tx['customer_id'])
+                if b_old is None or b_old < amount:
+                    expected.append(False)
+                    continue
+                cust[tx['customer_id']] = b_old - amount
+                merch[tx['merchant_id']] += amount
+                expected.append(True)
+
+            results = await ledger.make_transactions_batch(txs)
+            assert results == expected
+            assert ledger.cust_bal.tolist() == [cust[c] for c in ledger.cust_ids]
+            assert ledger.merch_bal.tolist() == [merch[m] for m in ledger.merch_ids]
+            # one history row per known payment, accepted or not
+            assert ledger._h_len == len(txs) - 1
+            assert len(ledger.metrics.items) == sum(expected)
+            # the scorer gets the same rows, rejected ones flagged, with the ids that will be written
+            assert [not row[5] for row in ledger.scorer.rows] == expected[:-1]
+            assert len({row[0] for row in ledger.scorer.rows}) == len(txs) - 1
+
+            # another batch refilling the buffer while a sync runs: the append waits for room again
+            small = MemoryLedger(dsn='postgresql://unused/none', history_capacity=8)
+            syncs = []
+
+            async def sync():
+                syncs.append(small._h_len)
+                small._h_len = 7 if len(syncs) == 1 else 0
+
+            small.sync = sync
+            small._h_len = 6
+            idx = np.arange(4)
+            zeros = np.zeros(4, dtype=np.int64)
+            hi, lo = np.zeros(4, dtype=np.uint64), np.zeros(4, dtype=np.uint64)
+            await small._append_history(idx, zeros, zeros, zeros, zeros, np.zeros(4, dtype=bool), zeros, zeros, hi, lo)
+            assert syncs == [6, 7] and small._h_len == 4
+
+            logger.info("Test4.testing(): all checks passed")
+        except Exception as e:
+            logger.error(f"Issue found: {e}")
+            raise
+
+
+if __name__ == "__main__":
+    test = Test4()
+    test.testing()
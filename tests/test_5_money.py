@@ -0,0 +1,46 @@
+import logging
+from decimal import Decimal
+
+import numpy as np
+
+from src.data_layer.money import SCALE, from_minor, from_minor_array, to_minor, to_minor_array
+
+logger = logging.getLogger(__name__)
+
+
+# Minor-unit conversions: every input type rounds half away from zero, like NUMERIC(20,4),
+# and the array variants agree with the scalar ones
+class Test5:
+    def testing(self):
+        try:
+            ties = [0.00015, -0.00015, 0.00025, -0.00025, 1.00005, -2.50005]
+            for v in ties:
+                expected = to_minor(Decimal(str(v)))
+                assert to_minor(v) == expected, f"{v}: {to_minor(v)} != {expected}"
+                assert to_minor(str(v)) == expected
+            assert to_minor(0.00015) == 2 and to_minor(-0.00015) == -2
+            assert to_minor_array(ties).tolist() == [to_minor(v) for v in ties]
+
+            assert to_minor(12) == 12 * SCALE
+            assert to_minor(123.4567) == 1234567
+            assert to_minor(Decimal('0.00004')) == 0
+            assert to_minor_array(np.array([1, -3], dtype=np.int32)).tolist() == [SCALE, -3 * SCALE]
+
+            rng = np.random.default_rng(3)
+            amounts = np.round(rng.uniform(-1e6, 1e6, 1000), 4)
+            minor = to_minor_array(amounts)
+            assert minor.tolist() == [to_minor(v) for v in amounts.tolist()]
+            assert [from_minor(m) for m in minor.tolist()] == [Decimal(str(v)).quantize(Decimal('0.0001'))
+                                                              for v in amounts.tolist()]
+            assert np.array_equal(from_minor_array(minor), amounts)
+            assert from_minor(None) is None
+
+            logger.info("Test5.testing(): all checks passed")
+        except Exception as e:
+            logger.error(f"Issue found: {e}")
+            raise
+
+
+if __name__ == "__main__":
+    test = Test5()
+    test.testing()
@@ -0,0 +1,61 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+
+from benchmarks.local_pg import LocalPostgres
+from src.data_layer.processor import DataProcessor
+from src.incentive import IncentiveEngine
+
+logger = logging.getLogger(__name__)
+
+
+# Incentive cycle on minor-unit money (BIGINT balances), in a throwaway local cluster so the
+# representation isn't decided by an existing schema. With DECAY_RATE 0.02 and TARGET_VELOCITY 0.5:
+#   idle:    1000 -> decay 1000 * 0.02 = 20                                -> 980
+#   spender: 1000, spends 100 -> 900, cashback 3,
+#            decay 900 * 0.02 * (1 - 100 / (0.5 * 900)) = 14              -> 889
+class Test6:
+    def testing(self):
+        pg = LocalPostgres()
+        try:
+            pg.start()
+        except RuntimeError as e:
+            pg.stop()
+            pytest.skip(f"needs a local PostgreSQL: {e}")
+        try:
+            asyncio.run(self.run(pg.dsn))
+        finally:
+            pg.stop()
+
+    async def run(self, dsn):
+        dp = DataProcessor(dsn=dsn, money_minor=True)
+        await dp.init()
+        try:
+            assert dp.money_minor
+            await dp.save_customer({'id': 'c_idle', 'name_full': 'Idle', 'acc_balance': 1000})
+            await dp.save_customer({'id': 'c_spender', 'name_full': 'Spender', 'acc_balance': 1000})
+            await dp.save_merchant({'merchant_id': 'm_inc', 'category': 'Retail', 'acc_balance': 0})
+            period_end = datetime.now(timezone.utc)
+            assert await dp.make_transaction('c_spender', 'm_inc', 100, at=period_end - timedelta(days=1))
+
+            summary = await IncentiveEngine(dp).run_cycle(period_end)
+            assert summary['decayed_customers'] == 2
+            assert summary['decay_total'] == Decimal(34)
+            assert summary['cashback_total'] == Decimal(3)
+            assert await dp.balance_query('c_idle') == Decimal(980)
+            assert await dp.balance_query('c_spender') == Decimal(889)
+
+            logger.info("Test6.testing(): all checks passed")
+        except Exception as e:
+            logger.error(f"Issue found: {e}")
+            raise
+        finally:
+            await dp.close()
+
+
+if __name__ == "__main__":
+    test = Test6()
+    test.testing()
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+
+import pytest
+
+from benchmarks.local_pg import LocalPostgres
+from src.data_layer.aggregates import DashboardAggregates
+from src.data_layer.processor import DataProcessor
+
+logger = logging.getLogger(__name__)
+
+STATS_WAIT = 10.0   # seconds to wait for another process's statistics to be flushed
+
+
+# Dashboard aggregates against a throwaway local cluster:
+# - views follow this process's payments on refresh, results are cached until the next one
+# - payments from another processor (another process, as far as the views know) trigger a refresh
+# - a query in flight across a refresh doesn't answer callers arriving after it
+# - clear_db empties the views and drops cached results at once
+class Test7:
+    def testing(self):
+        pg = LocalPostgres()
+        try:
+            pg.start()
+        except RuntimeError as e:
+            pg.stop()
+            pytest.skip(f"needs a local PostgreSQL: {e}")
+        try:
+            asyncio.run(self.run(pg.dsn))
+        finally:
+            pg.stop()
+
+    async def run(self, dsn):
+        dp = DataProcessor(dsn=dsn)
+        await dp.init()
+        dash = DashboardAggregates(dp, refresh_interval=3600)
+        try:
+            await dp.save_customers_bulk([{'id': f'c{i}', 'name_full': f'C{i}', 'acc_balance': 1000} for i in range(4)])
+            await dp.save_merchants_bulk([{'merchant_id': 'm_food', 'category': 'Grocery'},
+                                          {'merchant_id': 'm_tech', 'category': 'Tech'}])
+            await dash.start()
+            assert await dash.category_totals() == []
+
+            await dp.make_transactions_batch([{'customer_id': 'c0', 'merchant_id': 'm_food', 'amount': 10},
+                                              {'customer_id': 'c1', 'merchant_id': 'm_tech', 'amount': 30},
+                                              {'customer_id': 'c2', 'merchant_id': 'm_tech', 'amount': 5000}])
+            assert await dash.refresh()
+            totals = {r['category']: (r['tx_count'], r['total_amount']) for r in await dash.category_totals()}
+            assert totals == {'Grocery': (1, 10.0), 'Tech': (1, 30.0)}
+            hits = dp.stats.counters.get('dashboard_cache_hit', 0)
+            await dash.category_totals()
+            assert dp.stats.counters['dashboard_cache_hit'] == hits + 1
+            rejections = await dash.rejection_rates()
+            assert rejections[0]['accepted'] == 2 and rejections[0]['rejected'] == 1
+            assert not await dash.refresh()
+
+            # another processor's payments: only the database knows about them
+            other = DataProcessor(dsn=dsn)
+            await other.init()
+            assert await other.make_transaction('c3', 'm_food', 15)
+            await other.close()   # exiting backends flush their statistics
+            deadline = time.monotonic() + STATS_WAIT
+            while not await dash.refresh():
+                assert time.monotonic() < deadline, "refresh never saw the other processor's payment"
+                await asyncio.sleep(0.2)
+            top = {r['merchant_id']: r['total_amount'] for r in await dash.top_merchants()}
+            assert top == {'m_tech': 30.0, 'm_food': 25.0}
+
+            # started before a refresh, joined after it: the second caller runs its own query
+            early = asyncio.create_task(dash.top_merchants(limit=1))
+            await asyncio.sleep(0)
+            assert await dash.refresh(force=True)
+            late = await dash.top_merchants(limit=1)
+            assert late == await early and len(dash._inflight) == 0
+
+            await dp.clear_db()
+            assert await dash.category_totals() == []
+            assert await dash.top_merchants() == []
+
+            logger.info("Test7.testing(): all checks passed")
+        except Exception as e:
+            logger.error(f"Issue found: {e}")
+            raise
+        finally:
+            await dash.close()
+            await dp.close()
+
+
+if __name__ == "__main__":
+    test = Test7()
+    test.testing()
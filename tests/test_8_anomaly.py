@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+from benchmarks.local_pg import LocalPostgres
+from src.data_layer.processor import DataProcessor
+
+logger = logging.getLogger(__name__)
+
+CUSTOMERS = 50
+HISTORY = 3000
+
+
+# Anomaly scoring end to end, in a throwaway local cluster: fit an IsolationForest on synthetic
+# history (small daytime payments), then pay a batch through the processor with the scorer attached.
+# Every payment gets scored; the one huge night-time payment draining its customer's balance is flagged.
+class Test8:
+    def testing(self):
+        pytest.importorskip('sklearn')
+        pg = LocalPostgres()
+        try:
+            pg.start()
+        except RuntimeError as e:
+            pg.stop()
+            pytest.skip(f"needs a local PostgreSQL: {e}")
+        try:
+            asyncio.run(self.run(pg.dsn))
+        finally:
+            pg.stop()
+
+    async def run(self, dsn):
+        from src.anomaly import AnomalyScorer
+
+        dp = DataProcessor(dsn=dsn)
+        await dp.init()
+        # training points at the edges of a narrow history score close to the outlier, so the
+        # threshold is looser than the default CONTAMINATION
+        scorer = AnomalyScorer(dp, seed=7, flush_interval=0.05, contamination=0.05)
+        try:
+            rng = np.random.default_rng(7)
+            await dp.save_customers_bulk([{'id': f'c{i}', 'name_full': f'C{i}', 'acc_balance': 1000000}
+                                          for i in range(CUSTOMERS)])
+            await dp.save_customer({'id': 'c_target', 'name_full': 'Target', 'acc_balance': 1000})
+            await dp.save_merchants_bulk([{'merchant_id': f'm{i}', 'category': 'Grocery'} for i in range(5)])
+            start = datetime(2025, 3, 3, tzinfo=timezone.utc)
+            await dp.ensure_history_partitions(start, start + timedelta(days=30))
+            history = [{'customer_id': f'c{rng.integers(0, CUSTOMERS)}', 'merchant_id': f'm{rng.integers(0, 5)}',
+                        'amount': float(rng.integers(5, 50)),
+                        'time': start + timedelta(days=int(rng.integers(0, 20)), hours=int(rng.integers(9, 18)))}
+                       for _ in range(HISTORY)]
+            assert all(await dp.make_transactions_batch(history))
+            await dp.metrics.flush()
+
+            await scorer.start()
+            assert dp.scorer is scorer
+            at = start + timedelta(days=25, hours=12)
+            batch = [{'customer_id': f'c{i}', 'merchant_id': 'm0', 'amount': 20.0, 'time': at} for i in range(20)]
+            batch.append({'customer_id': 'c_target', 'merchant_id': 'm0', 'amount': 990.0,
+                          'time': at.replace(hour=3)})
+            assert all(await dp.make_transactions_batch(batch))
+            await scorer.drain()
+
+            assert dp.stats.counters['anomaly_scored'] == len(batch)
+            assert dp.stats.counters.get('anomaly_dropped', 0) == 0
+            async with dp.pool.acquire() as conn:
+                flagged = [r['customer_id'] for r in await conn.fetch('SELECT customer_id FROM tx_flags')]
+            assert 'c_target' in flagged
+            assert len(flagged) < len(batch) // 2
+
+            logger.info("Test8.testing(): all checks passed")
+        except Exception as e:
+            logger.error(f"Issue found: {e}")
+            raise
+        finally:
+            await scorer.close()
+            await dp.close()
+
+
+if __name__ == "__main__":
+    test = Test8()
+    test.testing()
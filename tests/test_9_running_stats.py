@@ -0,0 +1,63 @@
+import logging
+import math
+
+import numpy as np
+
+from src.data_layer.metrics import RunningStats
+
+logger = logging.getLogger(__name__)
+
+
+# The aggregator folds per-flush deltas into seeded state with RunningStats.merge; folding any split
+# of a series has to give what one pass over it gives (and what numpy says), including empty parts.
+class Test9:
+    def testing(self):
+        try:
+            rng = np.random.default_rng(4)
+            xs = rng.lognormal(3, 1, 1000)
+
+            single = RunningStats()
+            for x in xs:
+                single.add(float(x))
+            assert single.n == len(xs)
+            assert math.isclose(single.mean, xs.mean(), rel_tol=1e-9)
+            assert math.isclose(single.std, xs.std(), rel_tol=1e-9)
+            assert (single.lo, single.hi) == (xs.min(), xs.max())
+
+            # uneven chunks, some empty, folded left to right
+            cuts = [0, 0, 1, 17, 17, 400, 999, 1000]
+            merged = RunningStats()
+            for a, b in zip(cuts, cuts[1:]):
+                part = RunningStats()
+                for x in xs[a:b]:
+                    part.add(float(x))
+                merged.merge(part)
+            assert merged.n == single.n
+            assert math.isclose(merged.mean, single.mean, rel_tol=1e-9)
+            assert math.isclose(merged.m2, single.m2, rel_tol=1e-9)
+            assert (merged.lo, merged.hi) == (single.lo, single.hi)
+
+            # seeded state the way the aggregator rebuilds it from freqvol (no min/max), then a delta
+            seeded = RunningStats(500, float(xs[:500].mean()), float(xs[:500].var()) * 500)
+            delta = RunningStats()
+            for x in xs[500:]:
+                delta.add(float(x))
+            seeded.merge(delta)
+            assert math.isclose(seeded.mean, single.mean, rel_tol=1e-9)
+            assert math.isclose(seeded.std, single.std, rel_tol=1e-9)
+
+            # copies don't share state
+            copy = single.copy()
+            copy.add(1e6)
+            assert single.n == len(xs) and copy.n == len(xs) + 1
+            assert RunningStats().std == 0.0
+
+            logger.info("Test9.testing(): all checks passed")
+        except Exception as e:
+            logger.error(f"Issue found: {e}")
+            raise
+
+
+if __name__ == "__main__":
+    test = Test9()
+    test.testing()